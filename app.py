@@ -2,9 +2,46 @@ import streamlit as st
 import pandas as pd
 from datetime import date
 import os
-import re
-from fpdf import FPDF
-import base64
+import html
+import json
+import secrets
+import shutil
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Optional, Sequence
+
+from archivio import (
+    LUNGHEZZA_MIN_RICERCA,
+    ORDINI_CONTATTI,
+    STATI_DOC,
+    TIPI_CONTATTO,
+    ArchivioDocumenti,
+    NumeroDuplicato,
+)
+from calcoli import (
+    MESI_LABEL,
+    VALORI_RIEPILOGO,
+    ALIQUOTE_IVA,
+    NATURE_IVA,
+    formato_eur,
+    riepilogo_fattura,
+    riepilogo_periodi,
+    righe_fattura,
+    tabella_righe,
+)
+from fattura_xml import (
+    genera_xml_in_blocco,
+    nome_file_xml,
+    progressivo_invio,
+    xml_fattura,
+)
+from esportazione import FORMATI_REGISTRO, scrivi_pacchetto, scrivi_registro
+from invio_sdi import CURSORE_NOTIFICHE, CodaInvii, ErroreInvio, TrasportoOpenapi
+from pacchetto_ade import importa_pacchetto
+from pdf_fattura import CachePdf, genera_pdf_in_blocco, nome_file_pdf
+from sdi_simulato import TrasportoSimulato
 
 # ==========================
 # CONFIGURAZIONE PAGINA
@@ -17,8 +54,43 @@ st.set_page_config(
 
 PRIMARY_BLUE = "#1f77b4"
 
-PDF_DIR = "fatture_pdf"
-os.makedirs(PDF_DIR, exist_ok=True)
+# Paginazione "Lista documenti" e "Rubrica"
+DIMENSIONI_PAGINA = [10, 25, 50, 100]
+DIMENSIONE_PAGINA_DEFAULT = 25
+
+# Contatti proposti per pagina nei selettori del cliente (ricerca in rubrica)
+CONTATTI_PER_PAGINA = 20
+
+# PDF nella cartella "static" accanto ad app.py: con server.enableStaticServing
+# (.streamlit/config.toml) il server li serve direttamente come file, con
+# richieste Range ed ETag, senza passare dal websocket della sessione
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+PDF_DIR = os.path.join(STATIC_DIR, "pdf")
+XML_DIR = os.path.join(STATIC_DIR, "xml")
+EXPORT_DIR = os.path.join(STATIC_DIR, "export")
+
+# I pacchetti esportati restano scaricabili per questo tempo (secondi)
+DURATA_EXPORT = 3600
+
+# Righe lette dall'archivio per blocco negli export dei registri
+BLOCCO_REGISTRO = 10_000
+
+# Spazio massimo dei PDF in cache (oltre si eliminano i meno usati)
+LIMITE_CACHE_PDF = 500 * 1024 * 1024
+
+ARCHIVIO_DB = "archivio_fatture.db"
+
+# Invio SdI tramite Openapi (OPENAPI_TOKEN; OPENAPI_URL per la sandbox), oppure
+# SDI_TRASPORTO=simulato per l'intermediario locale di prova (UUID "SIM-...")
+SDI_TRASPORTO = os.environ.get("SDI_TRASPORTO", "openapi")
+OPENAPI_TOKEN = os.environ.get("OPENAPI_TOKEN", "")
+OPENAPI_URL = os.environ.get("OPENAPI_URL", TrasportoOpenapi.URL)
+# invii contemporanei (e connessioni HTTP tenute aperte) e limite
+# dell'intermediario in richieste al secondo
+INVII_CONCORRENTI = int(os.environ.get("SDI_CONCORRENZA", "4"))
+INVII_AL_SECONDO = float(os.environ.get("SDI_AL_SECONDO", "5"))
+# secondi tra due letture delle notifiche SdI quando non ce ne sono di nuove
+INTERVALLO_NOTIFICHE = float(os.environ.get("SDI_INTERVALLO_NOTIFICHE", "60"))
 
 # ==========================
 # DATI EMITTENTE
@@ -34,56 +106,101 @@ EMITTENTE = {
 }
 
 # ==========================
-# STATO DI SESSIONE
+# ARCHIVIO DOCUMENTI (persistente, condiviso tra sessioni)
 # ==========================
-COLONNE_DOC = [
-    "Tipo",
-    "Numero",
-    "Data",
-    "Controparte",
-    "Imponibile",
-    "IVA",
-    "Importo",
-    "TipoXML",
-    "Stato",
-    "UUID",
-    "PDF",
-]
+@st.cache_resource
+def apri_archivio() -> ArchivioDocumenti:
+    return ArchivioDocumenti(ARCHIVIO_DB)
 
-CLIENTI_COLONNE = [
-    "Denominazione",
-    "PIVA",
-    "CF",
-    "Indirizzo",
-    "CAP",
-    "Comune",
-    "Provincia",
-    "CodiceDestinatario",
-    "PEC",
-    "Tipo",
-]
 
-if "documenti_emessi" not in st.session_state:
-    st.session_state.documenti_emessi = pd.DataFrame(columns=COLONNE_DOC)
-else:
-    for col in COLONNE_DOC:
-        if col not in st.session_state.documenti_emessi.columns:
-            st.session_state.documenti_emessi[col] = (
-                0.0 if col in ["Imponibile", "IVA", "Importo"] else ""
-            )
+@st.cache_resource
+def apri_cache_pdf() -> CachePdf:
+    return CachePdf(PDF_DIR, LIMITE_CACHE_PDF)
+
+
+def prepara_invio(doc_id: int) -> tuple:
+    """(nome file, XML FatturaPA) del documento; gira nel thread della coda di invio."""
+    df = archivio.documenti_per_id([doc_id])
+    if df.empty:
+        raise ErroreInvio("documento eliminato")
+    row = df.iloc[0]
+    if row["Tipo"] != "Emessa":
+        raise ErroreInvio("solo le fatture emesse si inviano allo SdI")
+    if row["UUID"]:
+        raise ErroreInvio(f"già inviato (UUID {row['UUID']})")
+    progressivo = progressivo_invio(doc_id)
+    return nome_file_xml(EMITTENTE, progressivo), xml_fattura(
+        progressivo, dati_documento(row)
+    )
+
+
+def esito_invio(doc_id: int, uuid: str, errore: str) -> None:
+    # gli errori restano nello stato della coda: il documento non cambia
+    if uuid:
+        archivio.registra_invio(doc_id, uuid)
 
-if "clienti" not in st.session_state:
-    st.session_state.clienti = pd.DataFrame(columns=CLIENTI_COLONNE)
-else:
-    for col in CLIENTI_COLONNE:
-        if col not in st.session_state.clienti.columns:
-            st.session_state.clienti[col] = ""
 
+@st.cache_resource
+def apri_coda_invii():
+    """Coda di invio condivisa tra sessioni; None se l'invio non è configurato."""
+    if SDI_TRASPORTO == "simulato":
+        trasporto = TrasportoSimulato()
+    elif OPENAPI_TOKEN:
+        trasporto = TrasportoOpenapi(
+            OPENAPI_TOKEN, OPENAPI_URL, connessioni=INVII_CONCORRENTI
+        )
+    else:
+        return None
+    coda = CodaInvii(
+        trasporto,
+        prepara_invio,
+        esito_invio,
+        concorrenza=INVII_CONCORRENTI,
+        al_secondo=INVII_AL_SECONDO,
+    )
+    # stati dalle notifiche SdI (RC, NS, MC, DT...), con lo stesso trasporto
+    coda.avvia_notifiche(
+        lambda: archivio.cursore(CURSORE_NOTIFICHE),
+        lambda stati, valore: archivio.applica_notifiche(
+            stati, CURSORE_NOTIFICHE, valore
+        ),
+        intervallo=INTERVALLO_NOTIFICHE,
+    )
+    return coda
+
+
+archivio = apri_archivio()
+cache_pdf = apri_cache_pdf()
+coda_invii = apri_coda_invii()
+
+
+# Dati derivati condivisi tra sessioni, in cache per versione dell'archivio
+# (cambia a ogni scrittura, anche di altri processi): finché nessuno scrive,
+# ogni esecuzione rilegge solo il numero di versione
+@st.cache_data(max_entries=64)
+def conteggi_mensili(versione: int, anno: int) -> dict:
+    return archivio.conteggi_mensili(anno)
+
+
+@st.cache_data(max_entries=64)
+def riepilogo_emesse(
+    versione: int, anno_da: int, anno_a: int, per_cliente: bool
+) -> pd.DataFrame:
+    chiavi = ["Anno", "Controparte"] if per_cliente else ["Anno"]
+    return riepilogo_periodi(
+        archivio.totali_mensili(anno_da, anno_a, per_cliente=per_cliente), chiavi
+    )
+
+
+# ==========================
+# STATO DI SESSIONE
+# ==========================
 if "righe_correnti" not in st.session_state:
     st.session_state.righe_correnti = []
 
-if "cliente_corrente_label" not in st.session_state:
-    st.session_state.cliente_corrente_label = "NUOVO"
+# id del cliente in rubrica, oppure "NUOVO"
+if "cliente_corrente_id" not in st.session_state:
+    st.session_state.cliente_corrente_id = "NUOVO"
 
 if "pagina_corrente" not in st.session_state:
     st.session_state.pagina_corrente = "Dashboard"
@@ -92,440 +209,1001 @@ if "pagina_corrente" not in st.session_state:
 # ==========================
 # FUNZIONI DI SUPPORTO
 # ==========================
-def _format_val_eur(val: float) -> str:
-    return (
-        f"{val:,.2f}"
-        .replace(",", "X")
-        .replace(".", ",")
-        .replace("X", ".")
-    )
+def _format_cent_eur(cent: int) -> str:
+    return formato_eur(cent / 100)
 
 
-def mostra_anteprima_pdf(pdf_bytes: bytes, altezza: int = 600) -> None:
-    b64_pdf = base64.b64encode(pdf_bytes).decode("utf-8")
-    pdf_display = f"""
-<iframe src="data:application/pdf;base64,{b64_pdf}"
-        width="100%" height="{altezza}" type="application/pdf">
-</iframe>
-"""
-    st.markdown(pdf_display, unsafe_allow_html=True)
+def url_statico(percorso: str) -> str:
+    """URL di un file in STATIC_DIR servito come file statico (/app/static/...)."""
+    base = st.get_option("server.baseUrlPath").strip("/")
+    relativo = os.path.relpath(percorso, STATIC_DIR).replace(os.sep, "/")
+    return "/" + "/".join(p for p in [base, "app/static", relativo] if p)
 
 
-def get_next_invoice_number() -> str:
-    year = date.today().year
-    prefix = f"FT{year}"
-    df = st.session_state.documenti_emessi
-    seq = 1
-    if not df.empty:
-        mask = df["Numero"].astype(str).str.startswith(prefix)
-        if mask.any():
-            existing = df.loc[mask, "Numero"].astype(str)
-            max_seq = 0
-            for num in existing:
-                m = re.search(rf"{prefix}(\d+)$", num)
-                if m:
-                    s = int(m.group(1))
-                    if s > max_seq:
-                        max_seq = s
-            seq = max_seq + 1
-    return f"{prefix}{seq:03d}"
-
-
-def crea_riepilogo_fatture_emesse(df: pd.DataFrame) -> None:
+def mostra_anteprima_pdf(pdf_path: str, altezza: int = 600) -> None:
+    """
+    Anteprima per riferimento: il browser scarica il PDF dall'URL statico
+    (a pezzi, con cache HTTP). Senza servizio statico il file passa dal
+    media server di Streamlit, comunque fuori dal websocket.
+    """
+    if st.get_option("server.enableStaticServing"):
+        st.iframe(url_statico(pdf_path), height=altezza)
+    else:
+        st.iframe(Path(pdf_path), height=altezza)
+
+
+def mostra_download(
+    percorso: str,
+    nome_file: str,
+    etichetta: str,
+    key: str,
+    mime: str = "application/pdf",
+) -> None:
+    """Link di download di un file in STATIC_DIR (download_button se il servizio statico è spento)."""
+    if st.get_option("server.enableStaticServing"):
+        st.markdown(
+            f'<a href="{url_statico(percorso)}" download="{html.escape(nome_file)}">'
+            f"{html.escape(etichetta)}</a>",
+            unsafe_allow_html=True,
+        )
+    else:
+        with open(percorso, "rb") as f:
+            st.download_button(
+                etichetta,
+                data=f.read(),
+                file_name=nome_file,
+                mime=mime,
+                key=key,
+            )
+
+
+def mostra_scheda_documento(
+    row: pd.Series, piva_cf: str = "", selezionato: bool = False
+) -> None:
+    """
+    Scheda di un documento in "Lista documenti" (vista tipo Effatta).
+    Solo testo: nessun widget per riga, le azioni passano dalla selezione.
+    """
+    tipo_xml = row["TipoXML"] if pd.notna(row["TipoXML"]) else "TD01"
+    tipo_label = f"{tipo_xml} - FATTURA"
+    controparte = row.get("Controparte", "")
+    stato_corrente = row["Stato"] if pd.notna(row["Stato"]) else "Creazione"
+
+    st.markdown("---")
+    col_icon, col_info, col_imp, col_stato = st.columns([0.6, 4, 1.6, 1.4])
+
+    # ICONA A SINISTRA (PDF / B2B)
+    with col_icon:
+        if selezionato:
+            st.markdown("▶")
+        if tipo_xml == "TD01" and piva_cf:
+            st.markdown("🟥 **B2B**")
+        else:
+            st.markdown("📄")
+
+    # BLOCCO CENTRALE
+    with col_info:
+        info_lines = []
+        info_lines.append(f"**{tipo_label}**")
+        info_lines.append(f"{row['Numero']} del {row['Data'].strftime('%d/%m/%Y')}")
+        info_lines.append("")
+        info_lines.append("**INVIATO A**")
+        info_lines.append(controparte)
+        if piva_cf:
+            info_lines.append(f"P.IVA/C.F. {piva_cf}")
+        info_lines.append("CAUSALE")
+        info_lines.append(row["Causale"] or "SERVIZIO")
+        st.markdown("  \n".join(info_lines))
+
+    # IMPORTO + ESIGIBILITÀ
+    with col_imp:
+        st.markdown("**IMPORTO (EUR)**")
+        st.markdown(_format_cent_eur(int(row["Importo"])))
+        st.markdown("**ESIGIBILITÀ IVA**")
+        st.markdown("IMMEDIATA")
+
+    # STATO
+    with col_stato:
+        st.markdown("**Stato**")
+        st.markdown(stato_corrente)
+
+
+@st.fragment
+def mostra_azioni_documento(doc_id: int) -> None:
+    """
+    Stato e menu azioni del documento selezionato (un solo blocco di widget).
+    È un frammento: cambiare lo stato o usare un'azione riesegue solo questo
+    blocco, che rilegge il documento dall'archivio; le schede dell'elenco si
+    aggiornano alla successiva esecuzione completa. Duplica ed Elimina
+    cambiano l'elenco e rieseguono tutta la pagina.
+    """
+    df = archivio.documenti_per_id([doc_id])
     if df.empty:
-        st.info("Nessuna fattura emessa per creare il riepilogo.")
+        st.rerun()
+    row = df.iloc[0]
+    stato_corrente = row["Stato"] if pd.notna(row["Stato"]) else "Creazione"
+
+    col_stato, col_menu = st.columns([1.4, 1.8])
+
+    # STATO: salvato alla modifica; il widget riparte sempre dall'archivio,
+    # che può essere cambiato in background (es. esito dell'invio SdI)
+    with col_stato:
+        chiave_stato = f"stato_{doc_id}"
+        st.session_state[chiave_stato] = stato_corrente
+        st.selectbox(
+            "Stato",
+            STATI_DOC,
+            key=chiave_stato,
+            on_change=lambda: archivio.aggiorna_stato(
+                doc_id, st.session_state[chiave_stato]
+            ),
+        )
+
+    # MENU A TENDINA AZIONI
+    with col_menu:
+        st.markdown("**Azioni**")
+        with st.popover("▼", use_container_width=True):
+            st.markdown("**Seleziona azione**")
+
+            # Visualizza
+            if st.button("👁 Visualizza", key=f"vis_{doc_id}"):
+                pdf_path = percorso_pdf_documento(doc_id, row)
+                if pdf_path:
+                    st.markdown("Anteprima PDF:")
+                    mostra_anteprima_pdf(pdf_path, altezza=400)
+
+            # Scarica pacchetto: XML + PDF + indice del solo documento
+            if st.button("📦 Scarica pacchetto", key=f"pac_{doc_id}"):
+                esporta_pacchetto(
+                    [archivio.documenti_per_id([doc_id])],
+                    1,
+                    f"fattura_{row['Numero']}",
+                    key=f"dlpac_{doc_id}",
+                )
+
+            # Scarica PDF fattura
+            if st.button("📄 Scarica PDF fattura", key=f"fatt_{doc_id}"):
+                pdf_path = percorso_pdf_documento(doc_id, row)
+                if pdf_path:
+                    mostra_download(
+                        pdf_path,
+                        nome_file_pdf(row["Numero"]),
+                        "📥 Download PDF",
+                        key=f"dl_{doc_id}",
+                    )
+
+            # Scarica XML FatturaPA
+            if st.button("🧾 Scarica XML FatturaPA", key=f"xml_{doc_id}"):
+                try:
+                    xml_bytes = xml_fattura(progressivo_invio(doc_id), dati_documento(row))
+                except ValueError as exc:
+                    st.error(f"XML non generato: {exc}")
+                else:
+                    st.download_button(
+                        "📥 Download XML",
+                        data=xml_bytes,
+                        file_name=nome_file_xml(EMITTENTE, progressivo_invio(doc_id)),
+                        mime="application/xml",
+                        key=f"dlxml_{doc_id}",
+                    )
+
+            # Scarica PDF proforma (placeholder)
+            if st.button("📑 Scarica PDF proforma", key=f"prof_{doc_id}"):
+                st.info("Funzione 'PDF proforma' non ancora implementata.")
+
+            # Modifica (placeholder)
+            if st.button("✏️ Modifica", key=f"mod_{doc_id}"):
+                st.info("Funzione modifica non ancora implementata in questa versione.")
+
+            # Duplica
+            if st.button("🧬 Duplica", key=f"dup_{doc_id}"):
+                # la copia è una bozza mai inviata: senza UUID dell'intermediario
+                # (lo assegna il nuovo invio) e nello stato iniziale
+                nuova_riga = row.to_dict()
+                nuova_riga["Numero"] = ""
+                nuova_riga["PDF"] = ""
+                nuova_riga["UUID"] = ""
+                nuova_riga["Stato"] = STATI_DOC[0]
+                # la copia fissa l'anagrafica attuale del cliente, non quella
+                # dell'originale
+                nuova_riga["Cessionario"] = ""
+                nuova_riga["Data"] = str(date.today())
+                # con le righe: totali, PDF e XML della copia si calcolano da qui
+                righe_doc = archivio.righe([doc_id])
+                nuovo_id = archivio.inserisci_documento(
+                    nuova_riga, righe=righe_doc if not righe_doc.empty else None
+                )
+                nuovo_num = archivio.documento(nuovo_id)["Numero"]
+                st.session_state.esito_lista = (
+                    "success",
+                    f"Fattura duplicata come {nuovo_num}.",
+                )
+                st.rerun()
+
+            # Elimina
+            if st.button("🗑 Elimina", key=f"del_{doc_id}"):
+                archivio.elimina_documento(doc_id)
+                st.session_state.esito_lista = ("warning", "Fattura eliminata.")
+                st.rerun()
+
+            # Invia: in coda, l'esito arriva in background
+            if st.button("📨 Invia", key=f"inv_{doc_id}"):
+                if coda_invii is None:
+                    st.error("Invio SdI non configurato: impostare OPENAPI_TOKEN.")
+                elif row["UUID"]:
+                    st.info(f"Fattura già inviata (UUID {row['UUID']}).")
+                elif coda_invii.accoda([doc_id]):
+                    st.success("Fattura in coda di invio.")
+                else:
+                    st.info("Fattura già in coda di invio.")
+
+
+def mostra_invio_multiplo(df: pd.DataFrame, etichette: dict) -> None:
+    """Selezione multipla delle fatture della pagina non ancora inviate e invio in blocco."""
+    if coda_invii is None:
+        return
+    in_attesa = coda_invii.stato()["in_attesa"]
+    da_inviare = [
+        doc_id
+        for doc_id, r in df.iterrows()
+        if r["Tipo"] == "Emessa" and not r["UUID"] and doc_id not in in_attesa
+    ]
+    if not da_inviare:
         return
+    # la selezione resta valida solo per i documenti ancora inviabili della pagina
+    st.session_state.lista_invio_sel = [
+        d for d in st.session_state.get("lista_invio_sel", []) if d in da_inviare
+    ]
+    col_multi, col_tutte, col_invia = st.columns([4, 1.2, 2])
+    with col_tutte:
+        st.button(
+            "Tutta la pagina",
+            key="inv_tutte",
+            on_click=lambda: st.session_state.update(lista_invio_sel=da_inviare),
+        )
+    with col_multi:
+        scelti = st.multiselect(
+            "Da inviare allo SdI",
+            da_inviare,
+            format_func=etichette.get,
+            key="lista_invio_sel",
+            placeholder="Seleziona le fatture da inviare",
+        )
+    with col_invia:
+        st.button(
+            f"📨 Invia selezionate ({len(scelti)})",
+            key="inv_sel",
+            disabled=not scelti,
+            on_click=_invia_selezionate,
+            args=({d: etichette[d] for d in scelti},),
+        )
 
-    df = df.copy()
-    df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
-    anni = sorted(df["Data"].dt.year.dropna().unique())
-    if not anni:
-        st.info("Nessuna data valida sulle fatture emesse.")
+
+def _invia_selezionate(etichette: dict) -> None:
+    coda_invii.accoda(etichette)
+    st.session_state.lista_invio_sel = []
+    # lotto seguito dal pannello di avanzamento, documento per documento
+    st.session_state.invio_lotto = etichette
+
+
+def mostra_invii() -> None:
+    """
+    Avanzamento della coda di invio. Finché ci sono documenti in attesa un
+    frammento si aggiorna da solo; a coda vuota si ricarica la pagina per
+    mostrare gli stati aggiornati.
+    """
+    if coda_invii is None:
+        return
+    stato = coda_invii.stato()
+    if stato["errore_notifiche"]:
+        st.warning(f"Lettura notifiche SdI non riuscita: {stato['errore_notifiche']}")
+    if stato["in_attesa"]:
+        st.fragment(_pannello_invii, run_every=1)()
+        return
+    lotto = st.session_state.get("invio_lotto")
+    if lotto:
+        _esiti_lotto(lotto)
+        st.button(
+            "Chiudi esito invio",
+            key="chiudi_lotto",
+            on_click=lambda: st.session_state.pop("invio_lotto", None),
+        )
         return
+    errori = stato["errori"]
+    if errori:
+        with st.expander(f"⚠️ {len(errori)} invii non riusciti"):
+            st.dataframe(
+                pd.DataFrame({"Documento": list(errori), "Errore": list(errori.values())}),
+                use_container_width=True,
+                hide_index=True,
+            )
 
-    anno_default = date.today().year
-    if anno_default not in anni:
-        anno_default = anni[-1]
-    idx_default = list(anni).index(anno_default)
-    anno_sel = st.selectbox(
-        "Anno", anni, index=idx_default, key="anno_riepilogo_emesse"
+
+def _pannello_invii() -> None:
+    stato = coda_invii.stato()
+    if not stato["in_attesa"]:
+        st.rerun()
+    st.info(
+        f"📨 Invio SdI in corso: {len(stato['in_attesa'])} in coda, "
+        f"{stato['inviati']} inviati, {len(stato['errori'])} non riusciti."
     )
+    lotto = st.session_state.get("invio_lotto")
+    if lotto:
+        _esiti_lotto(lotto)
 
-    df_anno = df[df["Data"].dt.year == anno_sel]
-
-    mesi_label = [
-        "Gennaio",
-        "Febbraio",
-        "Marzo",
-        "Aprile",
-        "Maggio",
-        "Giugno",
-        "Luglio",
-        "Agosto",
-        "Settembre",
-        "Ottobre",
-        "Novembre",
-        "Dicembre",
-    ]
 
-    rows = []
+def riepilogo_righe(righe: list) -> dict:
+    """
+    riepilogo_fattura delle righe dell'editor, ricalcolato solo se cambiano
+    quantità, prezzi, aliquote o nature: confrontare una tupla di valori
+    costa molto meno del calcolo (e dell'hash di st.cache_data) con migliaia
+    di righe, e scrivere una descrizione non ricalcola nulla.
+    """
+    chiave = tuple((r["qta"], r["prezzo"], r["iva"], r.get("natura", "")) for r in righe)
+    memo = st.session_state.get("riepilogo_righe")
+    if memo is None or memo[0] != chiave:
+        memo = (chiave, riepilogo_fattura(righe))
+        st.session_state.riepilogo_righe = memo
+    return memo[1]
+
+
+@st.fragment
+def mostra_righe_fattura() -> None:
+    """
+    Editor delle righe con totali e riepilogo IVA. È un frammento: aggiungere,
+    modificare o eliminare una riga riesegue solo questo blocco, non la
+    pagina (rubrica, numerazione, intestazione). Le righe restano in
+    st.session_state.righe_correnti per il salvataggio.
+    """
+    st.markdown("### Righe fattura")
+    # aggiunta ed eliminazione nei callback: valgono già in questa esecuzione
+    st.button(
+        "➕ Aggiungi riga",
+        on_click=lambda: st.session_state.righe_correnti.append(
+            {"desc": "", "qta": 1.0, "prezzo": 0.0, "iva": 22, "natura": ""}
+        ),
+    )
+
+    for i, r in enumerate(st.session_state.righe_correnti):
+        c1, c2, c3, c4, c5, c6 = st.columns([4, 1, 1, 1, 1.2, 0.5])
+        with c1:
+            r["desc"] = st.text_input("Descrizione", r["desc"], key=f"desc_{i}")
+        with c2:
+            r["qta"] = st.number_input(
+                "Q.tà", min_value=0.0, value=r["qta"], key=f"qta_{i}"
+            )
+        with c3:
+            r["prezzo"] = st.number_input(
+                "Prezzo", min_value=0.0, value=r["prezzo"], key=f"prz_{i}"
+            )
+        with c4:
+            r["iva"] = st.selectbox(
+                "IVA%",
+                ALIQUOTE_IVA,
+                index=ALIQUOTE_IVA.index(r["iva"]),
+                key=f"iva_{i}",
+            )
+        with c5:
+            # Natura solo per le righe senza imposta (obbligatoria in FatturaPA)
+            natura = st.selectbox(
+                "Natura",
+                ["", *NATURE_IVA],
+                format_func=lambda n: f"{n} - {NATURE_IVA[n]}" if n else "—",
+                key=f"nat_{i}",
+                disabled=r["iva"] != 0,
+            )
+            r["natura"] = natura if r["iva"] == 0 else ""
+        with c6:
+            st.button(
+                "🗑️",
+                key=f"del_{i}",
+                on_click=st.session_state.righe_correnti.pop,
+                args=(i,),
+            )
+
+    conti = riepilogo_righe(st.session_state.righe_correnti)
+    col_t1, col_t2, col_t3 = st.columns(3)
+    col_t1.metric("Imponibile", f"EUR {_format_cent_eur(conti['imponibile'])}")
+    col_t2.metric("IVA", f"EUR {_format_cent_eur(conti['iva'])}")
+    col_t3.metric("Totale", f"EUR {_format_cent_eur(conti['totale'])}")
+    if len(conti["riepiloghi"]) > 1:
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "IVA %": formato_eur(aliquota),
+                        "Natura": natura,
+                        "Imponibile": _format_cent_eur(imponibile),
+                        "Imposta": _format_cent_eur(imposta),
+                    }
+                    for aliquota, natura, imponibile, imposta in conti["riepiloghi"]
+                ]
+            ),
+            hide_index=True,
+        )
+
+
+def _esiti_lotto(lotto: dict) -> None:
+    esiti = coda_invii.esiti(lotto)
+    fatti = sum(not e.startswith("in coda") for e in esiti.values())
+    st.progress(fatti / len(lotto), text=f"{fatti} / {len(lotto)} fatture del lotto")
+    st.dataframe(
+        pd.DataFrame(
+            {"Fattura": list(lotto.values()), "Esito": [esiti.get(d, "") for d in lotto]}
+        ),
+        use_container_width=True,
+        hide_index=True,
+    )
+
 
-    for m in range(1, 13):
-        df_m = df_anno[df_anno["Data"].dt.month == m]
-        imp_tot = df_m["Importo"].sum()
-        imp_imp = df_m["Imponibile"].sum()
-        iva_tot = df_m["IVA"].sum()
-        rows.append(
+def dati_fattura_documento(
+    row: pd.Series, cliente: dict, righe: Optional[pd.DataFrame] = None
+) -> dict:
+    """
+    Dati della fattura di un documento in archivio, nella forma degli
+    argomenti di genera_pdf_fattura (usati anche per l'XML), con le righe
+    registrate. I documenti salvati senza righe hanno come dettaglio una
+    riga unica con causale e imponibile, con l'aliquota di ALIQUOTE_IVA più
+    vicina al rapporto IVA/imponibile (il rapporto esatto, es. 21,99, non
+    è un'aliquota valida).
+    """
+    imponibile = int(row["Imponibile"])
+    iva = int(row["IVA"])
+    if righe is not None and not righe.empty:
+        dettaglio = righe_fattura(righe)
+    else:
+        rapporto = iva * 100 / imponibile if imponibile else 0.0
+        aliquota = min(ALIQUOTE_IVA, key=lambda a: abs(a - rapporto))
+        dettaglio = [
             {
-                "Periodo": mesi_label[m - 1],
-                "Importo a pagare": _format_val_eur(imp_tot),
-                "Imponibile": _format_val_eur(imp_imp),
-                "IVA": _format_val_eur(iva_tot),
+                "desc": row["Causale"] or "SERVIZIO",
+                "qta": 1,
+                "prezzo": imponibile / 100,
+                "iva": aliquota,
             }
-        )
+        ]
+    return {
+        "numero": row["Numero"],
+        "data_f": row["Data"].date(),
+        "emittente": EMITTENTE,
+        "cliente": cliente,
+        "righe": dettaglio,
+        "imponibile": imponibile / 100,
+        "iva": iva / 100,
+        "totale": int(row["Importo"]) / 100,
+        "tipo_xml_codice": row["TipoXML"] if pd.notna(row["TipoXML"]) else "TD01",
+        "modalita_pagamento": row["ModalitaPagamento"],
+        "note": row["Causale"],
+    }
 
-    trimestri = {
-        "1° Trimestre": [1, 2, 3],
-        "2° Trimestre": [4, 5, 6],
-        "3° Trimestre": [7, 8, 9],
-        "4° Trimestre": [10, 11, 12],
+
+def cliente_documento(row: pd.Series) -> dict:
+    """
+    Cessionario del documento come fissato al salvataggio (le modifiche
+    successive alla rubrica non cambiano le fatture emesse); senza, la sola
+    controparte.
+    """
+    if pd.notna(row["Cessionario"]) and row["Cessionario"]:
+        return json.loads(row["Cessionario"])
+    return {"Denominazione": row["Controparte"]}
+
+
+def dati_documento(row: pd.Series) -> dict:
+    """Dati della fattura di una riga di documenti() (indice = id documento)."""
+    return dati_fattura_documento(
+        row, cliente_documento(row), archivio.righe([row.name])
+    )
+
+
+def percorso_pdf_documento(doc_id: int, row: pd.Series) -> str:
+    """
+    PDF del documento dalla cache per contenuto: quello registrato se
+    corrisponde ai dati attuali (stessa impronta) ed è ancora in cache,
+    altrimenti rigenerato e registrato. "" (con errore a video) se la
+    generazione fallisce.
+    """
+    try:
+        pdf_path, _ = cache_pdf.percorso(dati_documento(row))
+    except Exception as exc:
+        st.error(f"PDF non generato: {exc}")
+        return ""
+    if pdf_path != row["PDF"]:
+        archivio.aggiorna_documento(doc_id, {"PDF": pdf_path})
+    return pdf_path
+
+
+def dati_documenti(df: pd.DataFrame) -> dict:
+    """{id: dati della fattura} per più documenti, righe lette con una query."""
+    righe = dict(tuple(archivio.righe(df.index).groupby("DocumentoId")))
+    return {
+        doc_id: dati_fattura_documento(row, cliente_documento(row), righe.get(doc_id))
+        for doc_id, row in df.iterrows()
     }
 
-    for nome, months in trimestri.items():
-        df_q = df_anno[df_anno["Data"].dt.month.isin(months)]
-        imp_tot = df_q["Importo"].sum()
-        imp_imp = df_q["Imponibile"].sum()
-        iva_tot = df_q["IVA"].sum()
-        rows.append(
+
+def _mostra_errori(df: pd.DataFrame, errori: dict, cosa: str) -> None:
+    if errori:
+        st.error(
+            f"{len(errori)} {cosa} non generati:  \n"
+            + "  \n".join(
+                f"{df.loc[doc_id, 'Numero']}: {msg}" for doc_id, msg in errori.items()
+            )
+        )
+
+
+def voci_pacchetto(df: pd.DataFrame) -> list:
+    """
+    Voci di scrivi_pacchetto per un lotto di documenti. I PDF mancanti o non
+    più validi si generano (in parallelo) e si registrano prima di scrivere.
+    """
+    dati = dati_documenti(df)
+    pdf = {d: p for d, p in df["PDF"].items() if cache_pdf.valido(p, dati[d])}
+    mancanti = {d: dati[d] for d in dati if d not in pdf}
+    if mancanti:
+        generati, riusati, _ = genera_pdf_in_blocco(mancanti, cache_pdf)
+        archivio.registra_pdf({**generati, **riusati})
+        pdf.update(generati)
+        pdf.update(riusati)
+    voci = []
+    for doc_id, row in df.iterrows():
+        cliente = dati[doc_id]["cliente"]
+        voci.append(
             {
-                "Periodo": nome,
-                "Importo a pagare": _format_val_eur(imp_tot),
-                "Imponibile": _format_val_eur(imp_imp),
-                "IVA": _format_val_eur(iva_tot),
+                "doc_id": doc_id,
+                "dati": dati[doc_id],
+                "pdf": pdf.get(doc_id, ""),
+                "indice": {
+                    "Numero": row["Numero"],
+                    "Data": row["Data"].strftime("%d/%m/%Y"),
+                    "Cliente": row["Controparte"],
+                    "PIVA/CF": cliente.get("PIVA") or cliente.get("CF", ""),
+                    "Causale": row["Causale"],
+                    "Imponibile": _format_cent_eur(int(row["Imponibile"])),
+                    "IVA": _format_cent_eur(int(row["IVA"])),
+                    "Importo": _format_cent_eur(int(row["Importo"])),
+                    "Stato": row["Stato"] if pd.notna(row["Stato"]) else "",
+                    "UUID": row["UUID"],
+                },
             }
         )
+    return voci
 
-    imp_tot = df_anno["Importo"].sum()
-    imp_imp = df_anno["Imponibile"].sum()
-    iva_tot = df_anno["IVA"].sum()
-    rows.append(
-        {
-            "Periodo": "Annuale",
-            "Importo a pagare": _format_val_eur(imp_tot),
-            "Imponibile": _format_val_eur(imp_imp),
-            "IVA": _format_val_eur(iva_tot),
-        }
+
+def percorso_export(nome: str, estensione: str) -> str:
+    """
+    Nuovo file in EXPORT_DIR, con suffisso casuale (il link non si indovina).
+    Gli export più vecchi di DURATA_EXPORT vengono eliminati.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for f in os.scandir(EXPORT_DIR):
+        if f.stat().st_mtime < time.time() - DURATA_EXPORT:
+            os.remove(f.path)
+    return os.path.join(EXPORT_DIR, f"{nome}_{secrets.token_hex(8)}.{estensione}")
+
+
+def esporta_pacchetto(lotti, totale: int, nome: str, key: str) -> None:
+    """
+    Pacchetto ZIP (XML, PDF, indice CSV) dai lotti di documenti, scritto su
+    file nella cartella statica e scaricato da lì: il browser lo legge dal
+    server in streaming, senza passare dalla sessione.
+    """
+    zip_path = percorso_export(nome, "zip")
+    barra = st.progress(0.0, text=f"0 / {totale} documenti")
+    stato = {"fatti": 0}
+
+    def con_avanzamento():
+        for df in lotti:
+            yield voci_pacchetto(df)
+            stato["fatti"] += len(df)
+            barra.progress(
+                min(1.0, stato["fatti"] / totale),
+                text=f"{stato['fatti']} / {totale} documenti",
+            )
+
+    esportati, errori = scrivi_pacchetto(zip_path, con_avanzamento())
+    st.success(f"Pacchetto pronto: {esportati} documenti.")
+    if errori:
+        st.error(
+            f"{len(errori)} documenti senza XML/PDF (vedi indice.csv):  \n"
+            + "  \n".join(f"id {d}: {msg}" for d, msg in errori.items())
+        )
+    mostra_download(
+        zip_path, f"{nome}.zip", "📥 Scarica pacchetto", key=key, mime="application/zip"
     )
 
-    df_riep = pd.DataFrame(rows)
-    st.markdown("### Prospetto riepilogativo fatture emesse")
-    st.dataframe(df_riep, use_container_width=True, hide_index=True)
 
+def esporta_registro(blocchi, totale: int, nome: str, formato: str) -> None:
+    """
+    Registro (DataFrame a blocchi dall'archivio) in CSV, XLSX o Parquet,
+    scritto su file nella cartella statica e scaricato da lì.
+    """
+    estensione = FORMATI_REGISTRO[formato]
+    percorso = percorso_export(nome, estensione)
+    barra = st.progress(0.0, text=f"0 / {totale} righe")
+    stato = {"fatte": 0}
+
+    def con_avanzamento():
+        for df in blocchi:
+            yield df
+            stato["fatte"] += len(df)
+            barra.progress(
+                min(1.0, stato["fatte"] / totale), text=f"{stato['fatte']} / {totale} righe"
+            )
+
+    try:
+        righe = scrivi_registro(percorso, con_avanzamento(), estensione)
+    except ValueError as exc:
+        st.error(str(exc))
+        return
+    st.success(f"Registro pronto: {righe} righe.")
+    mostra_download(
+        percorso,
+        f"{nome}.{estensione}",
+        "📥 Scarica registro",
+        key="dl_registro",
+        mime="application/octet-stream",
+    )
 
-# ==========================
-# GENERAZIONE PDF FATTURA
-# ==========================
-def genera_pdf_fattura(
-    numero: str,
-    data_f: date,
-    cliente: dict,
-    righe: list,
-    imponibile: float,
-    iva: float,
-    totale: float,
-    tipo_xml_codice: str = "TD01",
-    modalita_pagamento: str = "",
-    note: str = "",
-) -> bytes:
+
+def scegli_contatto(
+    etichetta: str, chiave: str, fisse: dict, tipi: Sequence[str] = TIPI_CONTATTO
+):
     """
-    PDF di cortesia con layout tipo Effatta.
+    Selettore di un contatto senza leggere tutta la rubrica: la ricerca usa
+    l'indice della rubrica e si legge una pagina di CONTATTI_PER_PAGINA
+    risultati. fisse {valore: etichetta} precede i contatti (es. "NUOVO");
+    la scelta resta in st.session_state[chiave] e tra le opzioni anche
+    quando è fuori dalla pagina mostrata.
     """
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-
-    row_height = 6
-
-    # -------------------------
-    # INTESTAZIONE EMITTENTE
-    # -------------------------
-    pdf.set_font("Helvetica", "B", 14)
-    pdf.cell(0, 8, EMITTENTE["Denominazione"], ln=1)
-
-    pdf.set_font("Helvetica", "", 9)
-    pdf.cell(0, 5, EMITTENTE["Indirizzo"], ln=1)
-    pdf.cell(
-        0,
-        5,
-        f'{EMITTENTE["CAP"]} {EMITTENTE["Comune"]} ({EMITTENTE["Provincia"]}) IT',
-        ln=1,
+    col_cerca, col_pag, col_pos = st.columns([3, 1, 2])
+    with col_cerca:
+        testo = st.text_input(
+            f"Cerca {etichetta.lower()}",
+            placeholder="Denominazione, P.IVA o comune",
+            key=f"{chiave}_cerca",
+        ).strip()
+    n_contatti = archivio.conta_contatti(testo, tipi)
+    n_pagine = max(1, -(-n_contatti // CONTATTI_PER_PAGINA))
+    if st.session_state.get(f"{chiave}_pagina", 1) > n_pagine:
+        st.session_state[f"{chiave}_pagina"] = 1
+    with col_pag:
+        n_pag = st.number_input(
+            "Pagina", min_value=1, max_value=n_pagine, step=1, key=f"{chiave}_pagina"
+        )
+    with col_pos:
+        st.caption(f"{n_contatti} contatti · pagina {n_pag} di {n_pagine}")
+
+    pagina = archivio.contatti(
+        testo,
+        tipi,
+        limite=CONTATTI_PER_PAGINA,
+        offset=(n_pag - 1) * CONTATTI_PER_PAGINA,
     )
-    pdf.cell(0, 5, f'CODICE FISCALE {EMITTENTE["CF"]}', ln=1)
-    pdf.cell(0, 5, f'PARTITA IVA {EMITTENTE["PIVA"]}', ln=1)
-
-    # -------------------------
-    # BLOCCO CLIENTE A DESTRA
-    # -------------------------
-    current_y = pdf.get_y()
-    pdf.set_xy(120, current_y)
-
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.cell(0, 5, "Spett.le", ln=1)
-
-    pdf.set_x(120)
-    pdf.set_font("Helvetica", "B", 10)
-    pdf.cell(0, 5, cliente.get("Denominazione", ""), ln=1)
-
-    pdf.set_font("Helvetica", "", 9)
-    indirizzo_cli = cliente.get("Indirizzo", "")
-    if indirizzo_cli:
-        pdf.set_x(120)
-        pdf.cell(0, 5, indirizzo_cli, ln=1)
-
-    pdf.set_x(120)
-    pdf.cell(
-        0,
-        5,
-        f"{cliente.get('CAP','')} {cliente.get('Comune','')} ({cliente.get('Provincia','')}) IT",
-        ln=1,
+    nomi = dict(fisse)
+    scelto = st.session_state.get(chiave, next(iter(fisse)))
+    if scelto not in nomi and scelto not in pagina.index:
+        contatto = archivio.cliente(scelto)
+        if contatto is None:
+            scelto = next(iter(fisse))
+        else:
+            nomi[scelto] = contatto["Denominazione"]
+    nomi.update(pagina["Denominazione"].to_dict())
+    opzioni = list(nomi)
+    scelto = st.selectbox(
+        etichetta, opzioni, index=opzioni.index(scelto), format_func=nomi.get
     )
+    st.session_state[chiave] = scelto
+    return scelto
+
 
-    if cliente.get("PIVA"):
-        pdf.set_x(120)
-        pdf.cell(0, 5, f"P.IVA {cliente.get('PIVA','')}", ln=1)
-    elif cliente.get("CF"):
-        pdf.set_x(120)
-        pdf.cell(0, 5, f"CF {cliente.get('CF','')}", ln=1)
-
-    pdf.ln(6)
-
-    # -------------------------
-    # DATI DOCUMENTO / TRASMISSIONE
-    # -------------------------
-    left_x = 10
-    right_x = 110
-    col_width = 90
-
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-
-    pdf.set_xy(left_x, pdf.get_y())
-    pdf.cell(col_width, row_height, "DATI DOCUMENTO", border=1, ln=0, fill=True)
-    pdf.set_xy(right_x, pdf.get_y())
-    pdf.cell(col_width, row_height, "DATI TRASMISSIONE", border=1, ln=1, fill=True)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "", 8)
-
-    def row_left(label: str, value: str):
-        pdf.set_x(left_x)
-        pdf.cell(col_width * 0.25, row_height, label, border=1)
-        pdf.cell(col_width * 0.75, row_height, value, border=1, ln=0)
-
-    def row_right(label: str, value: str, last: bool = True):
-        pdf.set_x(right_x)
-        pdf.cell(col_width * 0.35, row_height, label, border=1)
-        pdf.cell(col_width * 0.65, row_height, value, border=1, ln=1 if last else 0)
-
-    tipo_map = {
-        "TD01": "TD01 FATTURA - B2B",
-        "TD02": "TD02 ACCONTO/ANTICIPO SU FATTURA",
-        "TD04": "TD04 NOTA DI CREDITO",
-        "TD05": "TD05 NOTA DI DEBITO",
+def mostra_rubrica(tipi: list) -> None:
+    """
+    Rubrica a pagine: ricerca, ordinamento e paginazione li fa il database,
+    qui arriva solo la pagina visibile. Se la ricerca non trova nulla si
+    propongono i contatti con nomi simili.
+    """
+    if not tipi:
+        st.info("Seleziona clienti e/o fornitori da mostrare.")
+        return
+    col_cerca, col_ordine, col_verso = st.columns([3, 1.5, 1])
+    with col_cerca:
+        testo = st.text_input(
+            "Cerca",
+            placeholder="Denominazione, P.IVA o comune",
+            key="rubrica_cerca",
+        ).strip()
+    with col_ordine:
+        ordine = st.selectbox("Ordina per", ORDINI_CONTATTI, key="rubrica_ordine")
+    with col_verso:
+        decrescente = st.toggle("Decrescente", key="rubrica_decrescente")
+
+    n_contatti = archivio.conta_contatti(testo, tipi)
+    if not n_contatti:
+        simili = archivio.contatti_simili(testo, tipi) if testo else None
+        if simili is not None and not simili.empty:
+            st.info(f"Nessun contatto per “{testo}”. Forse cercavi:")
+            st.dataframe(simili, use_container_width=True)
+        elif testo:
+            st.info(f"Nessun contatto per “{testo}”.")
+        else:
+            st.info("Nessun contatto in rubrica.")
+        return
+
+    col_dim, col_pag, col_pos = st.columns([1, 1, 4])
+    with col_dim:
+        dim_pagina = st.selectbox(
+            "Contatti per pagina",
+            DIMENSIONI_PAGINA,
+            index=DIMENSIONI_PAGINA.index(DIMENSIONE_PAGINA_DEFAULT),
+            key="rubrica_dim_pagina",
+        )
+    n_pagine = max(1, -(-n_contatti // dim_pagina))
+    if st.session_state.get("rubrica_pagina", 1) > n_pagine:
+        st.session_state.rubrica_pagina = 1
+    with col_pag:
+        n_pag = st.number_input(
+            "Pagina", min_value=1, max_value=n_pagine, step=1, key="rubrica_pagina"
+        )
+    with col_pos:
+        st.caption(f"{n_contatti} contatti · pagina {n_pag} di {n_pagine}")
+
+    st.dataframe(
+        archivio.contatti(
+            testo,
+            tipi,
+            ordine=ordine,
+            decrescente=decrescente,
+            limite=dim_pagina,
+            offset=(n_pag - 1) * dim_pagina,
+        ),
+        use_container_width=True,
+    )
+
+
+def mostra_esportazione() -> None:
+    """
+    Filtri per periodo, cliente e stato; creazione del pacchetto ZIP o del
+    registro (emesse o ricevute) in CSV, XLSX o Parquet.
+    """
+    oggi = date.today()
+    col_periodo, col_cliente, col_stati = st.columns([2, 2, 3])
+    with col_periodo:
+        periodo = st.date_input(
+            "Periodo", value=(date(oggi.year, 1, 1), oggi), format="DD/MM/YYYY"
+        )
+    with col_cliente:
+        cliente_id = scegli_contatto(
+            "Cliente", "export_cliente", {None: "Tutti"}, tipi=TIPI_CONTATTO[:1]
+        )
+    with col_stati:
+        stati = st.multiselect("Stato", STATI_DOC, placeholder="Tutti")
+
+    if len(periodo) != 2:
+        st.info("Seleziona data iniziale e finale del periodo.")
+        return
+    filtri = {
+        "da": periodo[0].isoformat(),
+        "a": periodo[1].isoformat(),
+        "cliente_id": cliente_id,
+        "stati": stati,
     }
-    tipo_label = tipo_map.get(tipo_xml_codice, tipo_xml_codice)
-
-    row_left("TIPO", tipo_label)
-    row_right("CODICE DESTINATARIO", cliente.get("CodiceDestinatario", "0000000"))
-
-    row_left("NUMERO", str(numero))
-    row_right("PEC DESTINATARIO", cliente.get("PEC", ""))
-
-    row_left("DATA", data_f.strftime("%d/%m/%Y"))
-    row_right("DATA INVIO", "")
-
-    causale = note.strip() if note else "SERVIZIO"
-    row_left("CAUSALE", causale)
-    row_right("IDENTIFICATIVO SDI", "")
-
-    pdf.ln(2)
-
-    # -------------------------
-    # DETTAGLIO DOCUMENTO
-    # -------------------------
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, "DETTAGLIO DOCUMENTO", border=1, ln=1, fill=True)
-
-    pdf.set_font("Helvetica", "B", 8)
-    headers = ["#", "DESCRIZIONE", "U.M.", "PREZZO", "QTA", "TOTALE", "IVA %", "RIT.", "NAT."]
-    widths = [8, 78, 10, 28, 12, 28, 12, 10, 14]
-
-    pdf.set_x(10)
-    for h, w in zip(headers, widths):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "", 8)
-
-    righe_locali = righe if righe else [{"desc": "", "qta": 0, "prezzo": 0.0, "iva": 22}]
-
-    for idx, r in enumerate(righe_locali, start=1):
-        desc = (r.get("desc") or "").replace("\n", " ").strip()
-        if len(desc) > 70:
-            desc = desc[:67] + "..."
-        qta = float(r.get("qta", 0) or 0)
-        prezzo = float(r.get("prezzo", 0.0) or 0.0)
-        iva_r = float(r.get("iva", 22) or 0.0)
-        totale_riga = qta * prezzo
-
-        pdf.set_x(10)
-        pdf.cell(widths[0], row_height, str(idx), border=1, align="C")
-        pdf.cell(widths[1], row_height, desc, border=1)
-        pdf.cell(widths[2], row_height, "", border=1, align="C")
-        pdf.cell(widths[3], row_height, _format_val_eur(prezzo), border=1, align="R")
-        pdf.cell(widths[4], row_height, f"{qta:.2f}", border=1, align="R")
-        pdf.cell(widths[5], row_height, _format_val_eur(totale_riga), border=1, align="R")
-        pdf.cell(widths[6], row_height, f"{iva_r:.2f}", border=1, align="R")
-        pdf.cell(widths[7], row_height, "", border=1, align="C")
-        pdf.cell(widths[8], row_height, "", border=1, align="C")
-        pdf.ln(row_height)
-
-    # -------------------------
-    # IMPORTI A SINISTRA
-    # -------------------------
-    pdf.ln(2)
-    pdf.set_x(10)
-    pdf.set_font("Helvetica", "", 8)
-
-    pdf.cell(40, row_height, "IMPORTO", border=1)
-    pdf.cell(50, row_height, _format_val_eur(imponibile), border=1, ln=1, align="R")
-
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "TOTALE IMPONIBILE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(imponibile), border=1, ln=1, align="R")
-
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "IVA (SU IMPONIBILE)", border=1)
-    pdf.cell(50, row_height, _format_val_eur(iva), border=1, ln=1, align="R")
-
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "IMPORTO TOTALE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(totale), border=1, ln=1, align="R")
-
-    pdf.set_x(10)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.cell(40, row_height, "NETTO A PAGARE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(totale), border=1, ln=1, align="R")
-
-    # -------------------------
-    # RIEPILOGHI IVA
-    # -------------------------
-    pdf.ln(3)
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, "RIEPILOGHI", border=1, ln=1, fill=True)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "B", 8)
-    riepi_headers = [
-        "IVA %",
-        "NAT.",
-        "RIFERIMENTO NORMATIVO",
-        "IMPONIBILE",
-        "IMPOSTA",
-        "ESIG. IVA",
-        "ARROT.",
-        "SPESE ACC.",
-        "TOTALE",
-    ]
-    riepi_w = [14, 14, 40, 24, 20, 20, 14, 24, 24]
-
-    pdf.set_x(10)
-    for h, w in zip(riepi_headers, riepi_w):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_font("Helvetica", "", 8)
-    pdf.set_x(10)
-    pdf.cell(riepi_w[0], row_height, "22,00", border=1, align="R")
-    pdf.cell(riepi_w[1], row_height, "", border=1)
-    pdf.cell(riepi_w[2], row_height, "", border=1)
-    pdf.cell(riepi_w[3], row_height, _format_val_eur(imponibile), border=1, align="R")
-    pdf.cell(riepi_w[4], row_height, _format_val_eur(iva), border=1, align="R")
-    pdf.cell(riepi_w[5], row_height, "IMMEDIATA", border=1, align="C")
-    pdf.cell(riepi_w[6], row_height, "0,00", border=1, align="R")
-    pdf.cell(riepi_w[7], row_height, "0,00", border=1, align="R")
-    pdf.cell(riepi_w[8], row_height, _format_val_eur(totale), border=1, align="R")
-    pdf.ln(4)
-
-    # -------------------------
-    # MODALITÀ DI PAGAMENTO
-    # -------------------------
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-
-    pdf.set_x(10)
-    pdf.cell(
-        190 - 20,
-        row_height,
-        "MODALITA' DI PAGAMENTO ACCETTATE: PAGAMENTO COMPLETO",
-        border=1,
-        ln=1,
-        fill=True,
+    totale = archivio.conta_filtrati(**filtri)
+    st.caption(f"{totale} fatture emesse nel periodo selezionato.")
+    if totale and st.button("📦 Crea pacchetto ZIP", key="crea_export"):
+        esporta_pacchetto(
+            archivio.documenti_filtrati(**filtri),
+            totale,
+            f"fatture_{periodo[0]:%Y%m%d}_{periodo[1]:%Y%m%d}",
+            key="dl_export",
+        )
+
+    st.markdown("#### Registro")
+    col_registro, col_formato = st.columns(2)
+    with col_registro:
+        registro = st.radio(
+            "Registro", ["Fatture emesse", "Fatture ricevute"], horizontal=True
+        )
+    with col_formato:
+        formato = st.radio("Formato", list(FORMATI_REGISTRO), horizontal=True)
+    suffisso = f"{periodo[0]:%Y%m%d}_{periodo[1]:%Y%m%d}"
+    if registro == "Fatture emesse":
+        blocchi = (
+            df.drop(columns=["PDF", "Cessionario"])
+            for df in archivio.documenti_filtrati(**filtri, blocco=BLOCCO_REGISTRO)
+        )
+        nome = f"registro_emesse_{suffisso}"
+    else:
+        # per le ricevute vale solo il periodo
+        totale = archivio.conta_ricevute_filtrate(filtri["da"], filtri["a"])
+        blocchi = archivio.ricevute_filtrate(
+            filtri["da"], filtri["a"], blocco=BLOCCO_REGISTRO
+        )
+        nome = f"registro_ricevute_{suffisso}"
+        st.caption(f"{totale} fatture ricevute nel periodo selezionato.")
+    if totale and st.button("📊 Esporta registro", key="crea_registro"):
+        esporta_registro(blocchi, totale, nome, formato)
+
+
+def mostra_blocco_mese(anno: int, mese: int) -> None:
+    """PDF di cortesia e XML FatturaPA di tutte le fatture emesse del mese."""
+    with st.expander("🖨 Genera documenti del mese in blocco"):
+        col_pdf, col_xml = st.columns(2)
+        with col_pdf:
+            genera_pdf = st.button("Genera / aggiorna PDF", key="pdf_blocco")
+        with col_xml:
+            genera_xml = st.button("Genera XML FatturaPA (ZIP)", key="xml_blocco")
+
+        df = None
+        if genera_pdf or genera_xml:
+            df = archivio.documenti(anno, mese)
+            df = df[df["Tipo"] == "Emessa"]
+            if df.empty:
+                st.info("Nessuna fattura emessa nel mese selezionato.")
+                return
+        if genera_pdf:
+            genera_pdf_mese(df)
+        if genera_xml:
+            genera_xml_mese(df, anno, mese)
+
+
+def genera_pdf_mese(df: pd.DataFrame) -> None:
+    """
+    PDF in parallelo. Quelli già in cache con gli stessi dati non vengono
+    rigenerati.
+    """
+    # PDF registrato ancora valido: stessa impronta dei dati attuali
+    lavori = dati_documenti(df)
+    aggiornati = pd.Series(
+        [cache_pdf.valido(p, lavori[d]) for d, p in df["PDF"].items()],
+        index=df.index,
+        dtype=bool,
+    )
+    df = df[~aggiornati]
+    if df.empty:
+        st.info("Tutti i PDF del mese sono già aggiornati.")
+        return
+
+    lavori = {d: lavori[d] for d in df.index}
+    barra = st.progress(0.0, text=f"0 / {len(lavori)} PDF")
+    generati, riusati, errori = genera_pdf_in_blocco(
+        lavori,
+        cache_pdf,
+        avanzamento=lambda fatti, totale: barra.progress(
+            fatti / totale, text=f"{fatti} / {totale} PDF"
+        ),
     )
+    archivio.registra_pdf(
+        {
+            doc_id: percorso
+            for doc_id, percorso in {**generati, **riusati}.items()
+            if percorso != df.loc[doc_id, "PDF"]
+        }
+    )
+
+    st.success(
+        f"{len(generati)} PDF generati, "
+        f"{int(aggiornati.sum()) + len(riusati)} già aggiornati."
+    )
+    _mostra_errori(df, errori, "PDF")
+
 
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "B", 8)
-
-    pdf.set_x(10)
-    pag_headers = ["MODALITA'", "DETTAGLI", "DATA RIF. TERMINI", "GIORNI TERMINI", "DATA SCADENZA"]
-    pag_w = [30, 60, 30, 30, 40]
-
-    for h, w in zip(pag_headers, pag_w):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_font("Helvetica", "", 8)
-    pdf.set_x(10)
-    pdf.cell(pag_w[0], row_height, "CONTANTI", border=1)
-    pdf.cell(pag_w[1], row_height, modalita_pagamento[:40], border=1)
-    pdf.cell(pag_w[2], row_height, "", border=1)
-    pdf.cell(pag_w[3], row_height, "0", border=1, align="C")
-    pdf.cell(pag_w[4], row_height, "", border=1, align="C")
-    pdf.ln(row_height + 2)
-
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, f"TOTALE A PAGARE EUR {_format_val_eur(totale)}", ln=1)
-
-    # FOOTER
-    pdf.set_y(-25)
-    pdf.set_font("Helvetica", "I", 7)
-    pdf.multi_cell(
-        0,
-        4,
-        (
-            "Copia di cortesia priva di valore ai fini fiscali e giuridici ai sensi dell'articolo 21 del D.P.R. 633/72. "
-            "L'originale del documento è consultabile presso l'indirizzo PEC o il codice SDI registrato "
-            "o nell'area riservata Fatture e Corrispettivi."
+def genera_xml_mese(df: pd.DataFrame, anno: int, mese: int) -> None:
+    """
+    XML FatturaPA scritti uno dopo l'altro direttamente nello ZIP. Il nome
+    dell'archivio ha una parte casuale (è servito come file statico) e
+    sostituisce quello generato in precedenza per lo stesso mese.
+    """
+    os.makedirs(XML_DIR, exist_ok=True)
+    prefisso = f"fatture_xml_{anno}_{mese:02d}_"
+    precedenti = [f for f in os.listdir(XML_DIR) if f.startswith(prefisso)]
+    zip_path = os.path.join(XML_DIR, f"{prefisso}{secrets.token_hex(8)}.zip")
+
+    lavori = dati_documenti(df)
+    barra = st.progress(0.0, text=f"0 / {len(lavori)} XML")
+    scritti, errori = genera_xml_in_blocco(
+        lavori,
+        zip_path,
+        in_zip=True,
+        avanzamento=lambda fatti, totale: barra.progress(
+            fatti / totale, text=f"{fatti} / {totale} XML"
         ),
-        align="C",
     )
+    for f in precedenti:
+        os.remove(os.path.join(XML_DIR, f))
+
+    st.success(f"{len(scritti)} XML FatturaPA nell'archivio.")
+    mostra_download(
+        zip_path,
+        f"fatture_xml_{anno}_{mese:02d}.zip",
+        "📥 Scarica ZIP XML",
+        key="dl_xml_mese",
+        mime="application/zip",
+    )
+    _mostra_errori(df, errori, "XML")
+
+
+def importa_pacchetto_ade(zip_caricato) -> None:
+    """
+    Lo ZIP caricato si copia a blocchi in un file temporaneo (i processi lo
+    aprono per nome) e le fatture si registrano man mano che vengono lette.
+    I documenti già importati da pacchetti precedenti vengono saltati.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+        shutil.copyfileobj(zip_caricato, tmp, 1024 * 1024)
+    try:
+        barra = st.progress(0.0, text="Lettura del pacchetto...")
+        registrati, saltate, errori = importa_pacchetto(
+            tmp.name,
+            archivio,
+            avanzamento=lambda fatti, totale: barra.progress(
+                fatti / totale, text=f"{fatti} / {totale} file"
+            ),
+        )
+    except zipfile.BadZipFile:
+        st.error("Il file caricato non è un archivio ZIP valido.")
+        return
+    finally:
+        os.remove(tmp.name)
+
+    st.success(
+        f"{registrati} fatture ricevute registrate, {saltate} già presenti."
+    )
+    if errori:
+        with st.expander(f"⚠️ {len(errori)} file non importati"):
+            st.dataframe(
+                pd.DataFrame(
+                    {"File": list(errori), "Errore": list(errori.values())}
+                ),
+                use_container_width=True,
+                hide_index=True,
+            )
+
+
+def get_next_invoice_number() -> str:
+    # Solo anteprima: il numero definitivo viene assegnato al salvataggio
+    return archivio.prossimo_numero(date.today().year)
+
+
+@st.fragment
+def crea_riepilogo_fatture_emesse(anni: list) -> None:
+    """Prospetto per anno (e cliente): i suoi widget rieseguono solo il frammento."""
+    if not anni:
+        st.info("Nessuna fattura emessa per creare il riepilogo.")
+        return
+
+    anno_default = date.today().year
+    if anno_default not in anni:
+        anno_default = anni[-1]
+
+    col_anni, col_cli = st.columns([3, 1])
+    with col_anni:
+        if len(anni) > 1:
+            anno_da, anno_a = st.select_slider(
+                "Anni",
+                options=anni,
+                value=(anno_default, anno_default),
+                key="anni_riepilogo_emesse",
+            )
+        else:
+            anno_da = anno_a = anni[0]
+    with col_cli:
+        per_cliente = st.checkbox("Dettaglio per cliente", key="riepilogo_per_cliente")
+
+    df_riep = riepilogo_emesse(archivio.versione(), anno_da, anno_a, per_cliente)
+    if df_riep.empty:
+        st.info("Nessuna fattura emessa nel periodo selezionato.")
+        return
+
+    for col in VALORI_RIEPILOGO:
+        df_riep[col] = df_riep[col].map(_format_cent_eur)
+    df_riep = df_riep.rename(
+        columns={"Importo": "Importo a pagare", "Controparte": "Cliente"}
+    )
+    if anno_da == anno_a:
+        df_riep = df_riep.drop(columns="Anno")
 
-    out = pdf.output(dest="S")
-    if isinstance(out, (bytes, bytearray)):
-        return bytes(out)
-    return out.encode("latin1")
+    st.markdown("### Prospetto riepilogativo fatture emesse")
+    st.dataframe(df_riep, use_container_width=True, hide_index=True)
 
 
 # ==========================
@@ -575,12 +1253,11 @@ st.markdown("---")
 # ==========================
 # CONTATORI DOCUMENTI PER MESE (per le tab tipo "Novembre (2)")
 # ==========================
-docs_per_month = {m: 0 for m in range(1, 13)}
-df_tmp = st.session_state.documenti_emessi.copy()
-if not df_tmp.empty:
-    df_tmp["Data"] = pd.to_datetime(df_tmp["Data"], errors="coerce")
-    for m in range(1, 13):
-        docs_per_month[m] = (df_tmp["Data"].dt.month == m).sum()
+# contatori mantenuti dall'archivio a ogni inserimento/eliminazione, in cache
+# per versione dei dati: si rileggono solo dopo una scrittura
+versione_dati = archivio.versione()
+anno_tab = st.session_state.get("anno_lista", date.today().year)
+docs_per_month = conteggi_mensili(versione_dati, anno_tab)
 
 # ==========================
 # BARRA STATO / EMESSE / RICEVUTE
@@ -619,23 +1296,8 @@ if pagina in [
     with col_agg:
         st.button("AGGIORNA")
 
-    nomi_mesi = [
-        "Gennaio",
-        "Febbraio",
-        "Marzo",
-        "Aprile",
-        "Maggio",
-        "Giugno",
-        "Luglio",
-        "Agosto",
-        "Settembre",
-        "Ottobre",
-        "Novembre",
-        "Dicembre",
-    ]
-
     mesi = ["Riepilogo"]
-    for m, nome in enumerate(nomi_mesi, start=1):
+    for m, nome in enumerate(MESI_LABEL, start=1):
         n_doc = docs_per_month.get(m, 0)
         if n_doc > 0:
             mesi.append(f"{nome} ({n_doc})")
@@ -651,253 +1313,136 @@ if pagina in [
 # ==========================
 if pagina == "Lista documenti":
     st.subheader("Lista documenti")
+    mostra_invii()
 
-    df_e_all = st.session_state.documenti_emessi.copy()
+    # esito di Duplica/Elimina, che rieseguono la pagina subito dopo l'azione
+    esito = st.session_state.pop("esito_lista", None)
+    if esito:
+        getattr(st, esito[0])(esito[1])
 
     # selettore anno
-    if not df_e_all.empty:
-        df_e_all["Data"] = pd.to_datetime(df_e_all["Data"], errors="coerce")
-        anni = sorted(df_e_all["Data"].dt.year.dropna().unique())
-    else:
-        anni = []
-
-    if anni:
-        anno_default = date.today().year
-        if anno_default not in anni:
-            anno_default = anni[-1]
-        idx_anno_default = list(anni).index(anno_default)
-        col_anno, _ = st.columns([1, 5])
-        with col_anno:
-            anno_sel = st.selectbox(
-                "Anno",
-                anni,
-                index=idx_anno_default,
-                key="anno_lista",
-            )
-        df_e_all = df_e_all[df_e_all["Data"].dt.year == anno_sel]
-
-    if df_e_all.empty:
+    anni = archivio.anni()
+    if not anni:
         st.info("Nessun documento emesso per l'anno selezionato.")
         st.stop()
 
+    anno_default = date.today().year
+    if anno_default not in anni:
+        anno_default = anni[-1]
+    idx_anno_default = list(anni).index(anno_default)
+    col_anno, _ = st.columns([1, 5])
+    with col_anno:
+        anno_sel = st.selectbox(
+            "Anno",
+            anni,
+            index=idx_anno_default,
+            key="anno_lista",
+        )
+
+    # documento su cui agiscono stato/azioni e il download in fondo
+    riga_sel = None
+
     if tabs is not None:
         with tabs[0]:
-            crea_riepilogo_fatture_emesse(df_e_all)
+            crea_riepilogo_fatture_emesse(anni)
 
         with tabs[idx_mese]:
-            df_e = df_e_all.copy()
-            df_e = df_e[df_e["Data"].dt.month == idx_mese]
+            col_dim, col_pag, col_pos = st.columns([1, 1, 4])
+            with col_dim:
+                dim_pagina = st.selectbox(
+                    "Documenti per pagina",
+                    DIMENSIONI_PAGINA,
+                    index=DIMENSIONI_PAGINA.index(DIMENSIONE_PAGINA_DEFAULT),
+                    key="lista_dim_pagina",
+                )
 
+            # si legge dall'archivio solo la pagina visibile: il totale viene dai
+            # contatori mensili o, con la ricerca, dall'indice full-text
+            # (risultati di tutti gli anni, in ordine di rilevanza)
             if barra_ricerca:
-                mask = (
-                    df_e["Numero"]
-                    .astype(str)
-                    .str.contains(barra_ricerca, case=False, na=False)
-                    | df_e["Controparte"]
-                    .astype(str)
-                    .str.contains(barra_ricerca, case=False, na=False)
+                n_doc = archivio.conta_ricerca(barra_ricerca)
+            else:
+                n_doc = conteggi_mensili(versione_dati, anno_sel)[idx_mese]
+
+            n_pagine = max(1, -(-n_doc // dim_pagina))
+            if st.session_state.get("lista_pagina", 1) > n_pagine:
+                st.session_state.lista_pagina = 1
+            with col_pag:
+                n_pag = st.number_input(
+                    "Pagina", min_value=1, max_value=n_pagine, step=1, key="lista_pagina"
                 )
-                df_e = df_e[mask]
+            with col_pos:
+                if barra_ricerca:
+                    st.caption(
+                        f"{n_doc} risultati per “{barra_ricerca}” in tutti gli anni"
+                        f" · pagina {n_pag} di {n_pagine}"
+                    )
+                else:
+                    st.caption(f"{n_doc} documenti · pagina {n_pag} di {n_pagine}")
+
+            if not barra_ricerca:
+                mostra_blocco_mese(anno_sel, idx_mese)
 
-            if df_e.empty:
+            offset = (n_pag - 1) * dim_pagina
+            if barra_ricerca:
+                df_e = archivio.cerca_documenti(
+                    barra_ricerca, limite=dim_pagina, offset=offset
+                )
+            else:
+                df_e = archivio.documenti(
+                    anno_sel, idx_mese, limite=dim_pagina, offset=offset, decrescente=True
+                )
+
+            if df_e.empty and barra_ricerca:
+                st.info(
+                    "Nessun documento corrisponde alla ricerca "
+                    f"(servono parole di almeno {LUNGHEZZA_MIN_RICERCA} caratteri)."
+                )
+            elif df_e.empty:
                 st.info("Nessun documento emesso per il mese selezionato.")
             else:
+                etichette = {
+                    doc_id: f"{r['Numero']} · {r['Controparte']} · EUR {_format_cent_eur(int(r['Importo']))}"
+                    for doc_id, r in df_e.iterrows()
+                }
+                if st.session_state.get("lista_doc_sel") not in etichette:
+                    st.session_state.pop("lista_doc_sel", None)
+                col_sel, col_azioni = st.columns([4, 3.2])
+                with col_sel:
+                    doc_sel = st.selectbox(
+                        "Documento selezionato",
+                        list(etichette),
+                        format_func=etichette.get,
+                        key="lista_doc_sel",
+                    )
+                riga_sel = df_e.loc[doc_sel]
+                with col_azioni:
+                    mostra_azioni_documento(doc_sel)
+                mostra_invio_multiplo(df_e, etichette)
+
                 st.caption("Elenco fatture emesse (vista tipo Effatta)")
-                df_e = df_e.sort_values("Data", ascending=False)
-
-                for _, row in df_e.iterrows():
-                    row_index = row.name
-                    data_doc = pd.to_datetime(row["Data"])
-                    tipo_xml = (row.get("TipoXML", "") or "TD01").upper()
-                    tipo_label = f"{tipo_xml} - FATTURA"
-
-                    importo = float(row.get("Importo", 0.0) or 0.0)
-                    controparte = row.get("Controparte", "")
-                    stato_corrente = row.get("Stato", "Creazione") or "Creazione"
-                    pdf_path = row.get("PDF", "")
-
-                    piva_cf = ""
-                    cli_df = st.session_state.clienti[
-                        st.session_state.clienti["Denominazione"] == controparte
-                    ]
-                    if not cli_df.empty:
-                        cli_row = cli_df.iloc[0]
-                        piva_val = (cli_row.get("PIVA") or "").strip()
-                        cf_val = (cli_row.get("CF") or "").strip()
-                        if piva_val:
-                            piva_cf = piva_val
-                        elif cf_val:
-                            piva_cf = cf_val
-
-                    with st.container():
-                        st.markdown("---")
-                        col_icon, col_info, col_imp, col_stato, col_menu = st.columns(
-                            [0.6, 4, 1.6, 1.4, 1.8]
-                        )
-
-                        # ICONA A SINISTRA (PDF / B2B)
-                        with col_icon:
-                            if tipo_xml == "TD01" and piva_cf:
-                                st.markdown("🟥 **B2B**")
-                            else:
-                                st.markdown("📄")
-
-                        # BLOCCO CENTRALE
-                        with col_info:
-                            info_lines = []
-                            info_lines.append(f"**{tipo_label}**")
-                            info_lines.append(
-                                f"{row['Numero']} del {data_doc.strftime('%d/%m/%Y')}"
-                            )
-                            info_lines.append("")
-                            info_lines.append("**INVIATO A**")
-                            info_lines.append(controparte)
-                            if piva_cf:
-                                info_lines.append(f"P.IVA/C.F. {piva_cf}")
-                            info_lines.append("CAUSALE")
-                            info_lines.append("SERVIZIO")
-                            st.markdown("  \n".join(info_lines))
-
-                        # IMPORTO + ESIGIBILITÀ
-                        with col_imp:
-                            st.markdown("**IMPORTO (EUR)**")
-                            st.markdown(_format_val_eur(importo))
-                            st.markdown("**ESIGIBILITÀ IVA**")
-                            st.markdown("IMMEDIATA")
-
-                        # STATO
-                        with col_stato:
-                            st.markdown("**Stato**")
-                            possibili_stati = ["Creazione", "Creato", "Inviato"]
-                            if stato_corrente not in possibili_stati:
-                                stato_corrente = "Creazione"
-                            new_stato = st.selectbox(
-                                "",
-                                possibili_stati,
-                                index=possibili_stati.index(stato_corrente),
-                                key=f"stato_{row_index}",
-                                label_visibility="collapsed",
-                            )
-                            st.session_state.documenti_emessi.loc[
-                                row_index, "Stato"
-                            ] = new_stato
-
-                        # MENU A TENDINA AZIONI
-                        with col_menu:
-                            st.markdown("**Azioni**")
-                            with st.popover("▼", use_container_width=True):
-                                st.markdown("**Seleziona azione**")
-
-                                # Visualizza
-                                if st.button("👁 Visualizza", key=f"vis_{row_index}"):
-                                    if pdf_path and os.path.exists(pdf_path):
-                                        with open(pdf_path, "rb") as f:
-                                            pdf_bytes = f.read()
-                                        st.markdown("Anteprima PDF:")
-                                        mostra_anteprima_pdf(pdf_bytes, altezza=400)
-                                    else:
-                                        st.warning("PDF non disponibile su disco.")
-
-                                # Scarica pacchetto (placeholder)
-                                if st.button(
-                                    "📦 Scarica pacchetto", key=f"pac_{row_index}"
-                                ):
-                                    st.info(
-                                        "Funzione 'Scarica pacchetto' non ancora implementata."
-                                    )
-
-                                # Scarica PDF fattura
-                                if st.button(
-                                    "📄 Scarica PDF fattura", key=f"fatt_{row_index}"
-                                ):
-                                    if pdf_path and os.path.exists(pdf_path):
-                                        with open(pdf_path, "rb") as f:
-                                            pdf_bytes = f.read()
-                                        st.download_button(
-                                            "📥 Download PDF",
-                                            data=pdf_bytes,
-                                            file_name=os.path.basename(pdf_path),
-                                            mime="application/pdf",
-                                            key=f"dl_{row_index}",
-                                        )
-                                    else:
-                                        st.warning("PDF non disponibile su disco.")
-
-                                # Scarica PDF proforma (placeholder)
-                                if st.button(
-                                    "📑 Scarica PDF proforma", key=f"prof_{row_index}"
-                                ):
-                                    st.info(
-                                        "Funzione 'PDF proforma' non ancora implementata."
-                                    )
-
-                                # Modifica (placeholder)
-                                if st.button(
-                                    "✏️ Modifica", key=f"mod_{row_index}"
-                                ):
-                                    st.info(
-                                        "Funzione modifica non ancora implementata in questa versione."
-                                    )
-
-                                # Duplica
-                                if st.button("🧬 Duplica", key=f"dup_{row_index}"):
-                                    nuovo_num = get_next_invoice_number()
-                                    nuova_riga = row.copy()
-                                    nuova_riga["Numero"] = nuovo_num
-                                    nuova_riga["Data"] = str(date.today())
-                                    st.session_state.documenti_emessi = pd.concat(
-                                        [
-                                            st.session_state.documenti_emessi,
-                                            pd.DataFrame([nuova_riga]),
-                                        ],
-                                        ignore_index=True,
-                                    )
-                                    st.success(f"Fattura duplicata come {nuovo_num}.")
-                                    st.rerun()
-
-                                # Elimina
-                                if st.button("🗑 Elimina", key=f"del_{row_index}"):
-                                    st.session_state.documenti_emessi = (
-                                        st.session_state.documenti_emessi.drop(
-                                            row_index
-                                        ).reset_index(drop=True)
-                                    )
-                                    st.warning("Fattura eliminata.")
-                                    st.rerun()
-
-                                # Invia (placeholder)
-                                if st.button("📨 Invia", key=f"inv_{row_index}"):
-                                    st.info(
-                                        "Funzione invio a SdI non ancora implementata."
-                                    )
-
-    st.markdown("### 📄 Download PDF fatture emesse")
-    df_e = st.session_state.documenti_emessi
-    if df_e.empty:
-        st.caption("Nessuna fattura emessa salvata nell'app.")
-    else:
-        df_e_pdf = df_e[df_e["PDF"] != ""]
-        if df_e_pdf.empty:
-            st.caption("Le fatture emesse non hanno ancora PDF associati.")
-        else:
-            numeri = df_e_pdf["Numero"].tolist()
-            scelta_num = st.selectbox("Seleziona fattura emessa", numeri)
-            if scelta_num:
-                riga = df_e_pdf[df_e_pdf["Numero"] == scelta_num].iloc[0]
-                pdf_path = riga["PDF"]
-                if os.path.exists(pdf_path):
-                    with open(pdf_path, "rb") as f:
-                        pdf_bytes = f.read()
-                    st.download_button(
-                        label=f"📥 Scarica PDF fattura {scelta_num}",
-                        data=pdf_bytes,
-                        file_name=os.path.basename(pdf_path),
-                        mime="application/pdf",
+                for doc_id, row in df_e.iterrows():
+                    cliente = cliente_documento(row)
+                    mostra_scheda_documento(
+                        row,
+                        piva_cf=cliente.get("PIVA") or cliente.get("CF", ""),
+                        selezionato=doc_id == doc_sel,
                     )
-                    st.markdown("#### Anteprima PDF")
-                    mostra_anteprima_pdf(pdf_bytes, altezza=500)
-                else:
-                    st.warning("Il file PDF indicato non esiste più sul disco.")
+
+    st.markdown("### 📄 Download PDF fattura selezionata")
+    if riga_sel is None:
+        st.caption("Nessuna fattura emessa selezionata.")
+    else:
+        pdf_path = percorso_pdf_documento(riga_sel.name, riga_sel)
+        if pdf_path:
+            mostra_download(
+                pdf_path,
+                nome_file_pdf(riga_sel["Numero"]),
+                f"📥 Scarica PDF fattura {riga_sel['Numero']}",
+                key="dl_sel",
+            )
+            st.markdown("#### Anteprima PDF")
+            mostra_anteprima_pdf(pdf_path, altezza=500)
 
 # ==========================
 # CREA NUOVA FATTURA
@@ -905,24 +1450,14 @@ if pagina == "Lista documenti":
 elif pagina == "Crea nuova fattura":
     st.subheader("Crea nuova fattura emessa")
 
-    denominazioni = ["NUOVO"] + st.session_state.clienti["Denominazione"].tolist()
-
+    # ricerca nella rubrica e una pagina di risultati, non tutta la rubrica
     col1, col2 = st.columns([2, 1])
     with col1:
-        current_label = st.session_state.cliente_corrente_label
-        if current_label not in denominazioni:
-            current_label = "NUOVO"
-        default_idx = denominazioni.index(current_label)
-        cliente_sel = st.selectbox(
-            "Cliente",
-            denominazioni,
-            index=default_idx,
-        )
-        st.session_state.cliente_corrente_label = cliente_sel
+        cliente_sel = scegli_contatto("Cliente", "cliente_corrente_id", {"NUOVO": "NUOVO"})
 
     with col2:
         if st.button("➕ Nuovo cliente"):
-            st.session_state.cliente_corrente_label = "NUOVO"
+            st.session_state.cliente_corrente_id = "NUOVO"
             st.rerun()
 
     if cliente_sel == "NUOVO":
@@ -954,9 +1489,7 @@ elif pagina == "Crea nuova fattura":
             "PEC": cli_pec,
         }
     else:
-        riga_cli = st.session_state.clienti[
-            st.session_state.clienti["Denominazione"] == cliente_sel
-        ].iloc[0]
+        riga_cli = archivio.cliente(cliente_sel)
         cli_den = st.text_input("Denominazione", riga_cli.get("Denominazione", ""))
         cli_piva = st.text_input("P.IVA", riga_cli.get("PIVA", ""))
         cli_cf = st.text_input("Codice Fiscale", riga_cli.get("CF", ""))
@@ -1002,7 +1535,8 @@ elif pagina == "Crea nuova fattura":
 
     coln1, coln2 = st.columns(2)
     with coln1:
-        numero = st.text_input("Numero fattura", get_next_invoice_number())
+        numero_proposto = get_next_invoice_number()
+        numero = st.text_input("Numero fattura", numero_proposto)
     with coln2:
         data_f = st.date_input("Data fattura", date.today())
 
@@ -1012,172 +1546,102 @@ elif pagina == "Crea nuova fattura":
     )
     note = st.text_area("Note / causale (verrà riportata in PDF come CAUSALE)", value="", height=80)
 
-    st.markdown("### Righe fattura")
-    if st.button("➕ Aggiungi riga"):
-        st.session_state.righe_correnti.append(
-            {"desc": "", "qta": 1.0, "prezzo": 0.0, "iva": 22}
-        )
-        st.rerun()
-
-    imponibile = 0.0
-    iva_tot = 0.0
-    for i, r in enumerate(st.session_state.righe_correnti):
-        c1, c2, c3, c4, c5 = st.columns([4, 1, 1, 1, 0.5])
-        with c1:
-            r["desc"] = st.text_input("Descrizione", r["desc"], key=f"desc_{i}")
-        with c2:
-            r["qta"] = st.number_input(
-                "Q.tà", min_value=0.0, value=r["qta"], key=f"qta_{i}"
-            )
-        with c3:
-            r["prezzo"] = st.number_input(
-                "Prezzo", min_value=0.0, value=r["prezzo"], key=f"prz_{i}"
-            )
-        with c4:
-            r["iva"] = st.selectbox(
-                "IVA%",
-                [22, 10, 5, 4, 0],
-                index=[22, 10, 5, 4, 0].index(r["iva"]),
-                key=f"iva_{i}",
-            )
-        with c5:
-            if st.button("🗑️", key=f"del_{i}"):
-                st.session_state.righe_correnti.pop(i)
-                st.rerun()
-
-        imp_riga = r["qta"] * r["prezzo"]
-        iva_riga = imp_riga * r["iva"] / 100
-        imponibile += imp_riga
-        iva_tot += iva_riga
+    mostra_righe_fattura()
+    # totali al centesimo con l'IVA arrotondata per aliquota: gli stessi
+    # valori di archivio, PDF e XML (già calcolati dal frammento delle righe)
+    conti = riepilogo_righe(st.session_state.righe_correnti)
+    imponibile_cent = conti["imponibile"]
+    iva_cent = conti["iva"]
+    totale_cent = conti["totale"]
 
-    totale = imponibile + iva_tot
-
-    col_t1, col_t2, col_t3 = st.columns(3)
-    col_t1.metric("Imponibile", f"EUR {_format_val_eur(imponibile)}")
-    col_t2.metric("IVA", f"EUR {_format_val_eur(iva_tot)}")
-    col_t3.metric("Totale", f"EUR {_format_val_eur(totale)}")
-
-    stato = st.selectbox("Stato", ["Creazione", "Creato", "Inviato"])
+    stato = st.selectbox("Stato", STATI_DOC)
 
     if st.button("💾 Salva fattura emessa", type="primary"):
         if not cliente_corrente["Denominazione"]:
             st.error("Inserisci almeno la denominazione del cliente.")
         elif not st.session_state.righe_correnti:
             st.error("Inserisci almeno una riga di fattura.")
+        elif any(r["iva"] == 0 and not r["natura"] for r in st.session_state.righe_correnti):
+            st.error("Indica la Natura per le righe con IVA 0%.")
         else:
-            if (
-                cliente_corrente["Denominazione"]
-                and cliente_corrente["Denominazione"]
-                not in st.session_state.clienti["Denominazione"].tolist()
-            ):
-                nuovo_cli = pd.DataFrame(
-                    [
-                        {
-                            "Denominazione": cliente_corrente["Denominazione"],
-                            "PIVA": cliente_corrente["PIVA"],
-                            "CF": cliente_corrente["CF"],
-                            "Indirizzo": cliente_corrente["Indirizzo"],
-                            "CAP": cliente_corrente["CAP"],
-                            "Comune": cliente_corrente["Comune"],
-                            "Provincia": cliente_corrente["Provincia"],
-                            "CodiceDestinatario": cliente_corrente[
-                                "CodiceDestinatario"
-                            ],
-                            "PEC": cliente_corrente["PEC"],
-                            "Tipo": "Cliente",
-                        }
-                    ]
-                )
-                st.session_state.clienti = pd.concat(
-                    [st.session_state.clienti, nuovo_cli],
-                    ignore_index=True,
-                )
-            else:
-                mask = (
-                    st.session_state.clienti["Denominazione"]
-                    == cliente_corrente["Denominazione"]
-                )
-                for campo in [
-                    "PIVA",
-                    "CF",
-                    "Indirizzo",
-                    "CAP",
-                    "Comune",
-                    "Provincia",
-                    "CodiceDestinatario",
-                    "PEC",
-                ]:
-                    st.session_state.clienti.loc[mask, campo] = cliente_corrente[campo]
-
-            pdf_bytes = genera_pdf_fattura(
-                numero,
-                data_f,
+            righe_df = tabella_righe(st.session_state.righe_correnti)
+            # aggiorna la rubrica (per id se il cliente è stato scelto, altrimenti
+            # per P.IVA/CF/denominazione) e lega la fattura all'id del cliente
+            cliente_id = archivio.salva_cliente(
                 cliente_corrente,
-                st.session_state.righe_correnti,
-                imponibile,
-                iva_tot,
-                totale,
-                tipo_xml_codice=tipo_xml_codice,
-                modalita_pagamento=modalita_pagamento,
-                note=note,
+                cliente_id=None if cliente_sel == "NUOVO" else cliente_sel,
             )
-            pdf_filename = f"{numero.replace('/', '_')}.pdf"
-            pdf_path = os.path.join(PDF_DIR, pdf_filename)
-            with open(pdf_path, "wb") as f:
-                f.write(pdf_bytes)
 
-            nuova = pd.DataFrame(
-                [
+            # Numero proposto non modificato: assegnazione atomica al salvataggio
+            # (se un'altra sessione lo ha appena usato si passa al successivo)
+            numero = numero.strip()
+            try:
+                doc_id = archivio.inserisci_documento(
                     {
                         "Tipo": "Emessa",
-                        "Numero": numero,
+                        "Numero": "" if numero == numero_proposto else numero,
                         "Data": str(data_f),
                         "Controparte": cliente_corrente["Denominazione"],
-                        "Imponibile": imponibile,
-                        "IVA": iva_tot,
-                        "Importo": totale,
+                        "Imponibile": imponibile_cent,
+                        "IVA": iva_cent,
+                        "Importo": totale_cent,
                         "TipoXML": tipo_xml_codice,
                         "Stato": stato,
                         "UUID": "",
-                        "PDF": pdf_path,
-                    }
-                ],
-                columns=COLONNE_DOC,
-            )
-            st.session_state.documenti_emessi = pd.concat(
-                [st.session_state.documenti_emessi, nuova],
-                ignore_index=True,
-            )
+                        "PDF": "",
+                        "ClienteId": cliente_id,
+                        "Causale": note.strip(),
+                        "ModalitaPagamento": modalita_pagamento.strip(),
+                    },
+                    righe=righe_df,
+                )
+            except NumeroDuplicato:
+                st.error(f"Il numero {numero} è già assegnato a un altro documento.")
+                st.stop()
+            # PDF dai dati registrati (documento, cessionario e righe): identico a
+            # quello rigenerato in seguito dall'archivio
+            riga_doc = archivio.documenti_per_id([doc_id]).iloc[0]
+            numero = riga_doc["Numero"]
+            pdf_path, _ = cache_pdf.percorso(dati_documento(riga_doc))
+            archivio.aggiorna_documento(doc_id, {"PDF": pdf_path})
 
             st.session_state.righe_correnti = []
 
-            st.success("✅ Fattura emessa salvata e PDF generato.")
-            st.download_button(
-                label="📥 Scarica subito il PDF",
-                data=pdf_bytes,
-                file_name=pdf_filename,
-                mime="application/pdf",
+            st.success(f"✅ Fattura {numero} salvata e PDF generato.")
+            mostra_download(
+                pdf_path, nome_file_pdf(numero), "📥 Scarica subito il PDF", key="dl_nuova"
             )
             st.markdown("#### Anteprima PDF generato")
-            mostra_anteprima_pdf(pdf_bytes, altezza=600)
+            mostra_anteprima_pdf(pdf_path, altezza=600)
 
 # ==========================
 # ALTRE PAGINE
 # ==========================
 elif pagina == "Download (documenti inviati)":
-    st.subheader("Download documenti inviati")
-    st.info(
-        "Area placeholder: qui potrai elencare e scaricare i documenti inviati allo SdI."
+    st.subheader("Download documenti")
+    st.caption(
+        "Pacchetto ZIP con XML FatturaPA, PDF di cortesia e indice CSV delle "
+        "fatture emesse."
     )
+    mostra_esportazione()
 
 elif pagina == "Carica pacchetto AdE":
     st.subheader("Carica pacchetto AdE (ZIP da cassetto fiscale)")
     uploaded_zip = st.file_uploader(
         "Carica file ZIP (fatture + metadati)", type=["zip"]
     )
-    if uploaded_zip:
-        st.write("Nome file caricato:", uploaded_zip.name)
-        st.info("Parsing del pacchetto non ancora implementato in questa versione.")
+    if uploaded_zip and st.button("📥 Importa pacchetto", key="importa_ade"):
+        importa_pacchetto_ade(uploaded_zip)
+
+    n_ricevute = archivio.conta_ricevute()
+    if n_ricevute:
+        st.markdown(f"### Fatture ricevute ({n_ricevute})")
+        df_ric = archivio.ricevute(limite=100)
+        for col in VALORI_RIEPILOGO:
+            df_ric[col] = df_ric[col].map(_format_cent_eur)
+        st.dataframe(df_ric, use_container_width=True, hide_index=True)
+        if n_ricevute > len(df_ric):
+            st.caption(f"Mostrate le {len(df_ric)} più recenti.")
 
 elif pagina == "Rubrica":
     st.subheader("Rubrica (Clienti / Fornitori)")
@@ -1210,51 +1674,35 @@ elif pagina == "Rubrica":
             pec = st.text_input("PEC destinatario")
         tipo = st.selectbox("Tipo", ["Cliente", "Fornitore"])
         if st.form_submit_button("💾 Salva contatto"):
-            nuovo = pd.DataFrame(
-                [
-                    {
-                        "Denominazione": den,
-                        "PIVA": piva,
-                        "CF": cf,
-                        "Indirizzo": ind,
-                        "CAP": cap,
-                        "Comune": com,
-                        "Provincia": prov,
-                        "CodiceDestinatario": cod_dest,
-                        "PEC": pec,
-                        "Tipo": tipo,
-                    }
-                ]
-            )
-            st.session_state.clienti = pd.concat(
-                [st.session_state.clienti, nuovo],
-                ignore_index=True,
+            archivio.salva_cliente(
+                {
+                    "Denominazione": den,
+                    "PIVA": piva,
+                    "CF": cf,
+                    "Indirizzo": ind,
+                    "CAP": cap,
+                    "Comune": com,
+                    "Provincia": prov,
+                    "CodiceDestinatario": cod_dest,
+                    "PEC": pec,
+                    "Tipo": tipo,
+                }
             )
             st.success("Contatto salvato")
 
-    df_c = st.session_state.clienti.copy()
-    if not df_c.empty:
-        mask = []
-        for _, r in df_c.iterrows():
-            if r["Tipo"] == "Cliente" and filtra_clienti:
-                mask.append(True)
-            elif r["Tipo"] == "Fornitore" and filtra_fornitori:
-                mask.append(True)
-            else:
-                mask.append(False)
-        df_c = df_c[pd.Series(mask)]
-        st.dataframe(df_c, use_container_width=True)
-    else:
-        st.info("Nessun contatto in rubrica.")
+    tipi = [
+        t
+        for t, mostra in zip(TIPI_CONTATTO, [filtra_clienti, filtra_fornitori])
+        if mostra
+    ]
+    mostra_rubrica(tipi)
 
 else:
     st.subheader("Dashboard")
-    df_e = st.session_state.documenti_emessi
-    num_emesse = len(df_e)
-    tot_emesse = df_e["Importo"].sum() if not df_e.empty else 0.0
+    num_emesse, tot_emesse = archivio.totali()
     col1, col2 = st.columns(2)
     col1.metric("Fatture emesse (app)", num_emesse)
-    col2.metric("Totale emesso", f"EUR {_format_val_eur(tot_emesse)}")
+    col2.metric("Totale emesso", f"EUR {_format_cent_eur(tot_emesse)}")
 
 st.markdown("---")
 st.caption(
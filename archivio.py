@@ -0,0 +1,1470 @@
+"""
+Archivio persistente dei documenti (SQLite embedded).
+"""
+import json
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import date
+from typing import Iterator, Optional, Sequence
+
+import pandas as pd
+
+# ==========================
+# SCHEMA
+# ==========================
+COLONNE_DOC = [
+    "Tipo",
+    "Numero",
+    "Data",
+    "Controparte",
+    "Imponibile",
+    "IVA",
+    "Importo",
+    "TipoXML",
+    "Stato",
+    "UUID",
+    "PDF",
+    "ClienteId",
+    "Causale",
+    "ModalitaPagamento",
+    "Cessionario",
+]
+
+CLIENTI_COLONNE = [
+    "Denominazione",
+    "PIVA",
+    "CF",
+    "Indirizzo",
+    "CAP",
+    "Comune",
+    "Provincia",
+    "CodiceDestinatario",
+    "PEC",
+    "Tipo",
+]
+# Anagrafica del cessionario fissata nel documento al salvataggio (JSON in
+# Cessionario): modifiche successive alla rubrica non toccano le fatture emesse
+CAMPI_CESSIONARIO = CLIENTI_COLONNE[:-1]
+
+TIPI_CONTATTO = ["Cliente", "Fornitore"]
+
+# Registro delle fatture ricevute (importate dai pacchetti AdE)
+COLONNE_RICEVUTE = [
+    "IdentificativoSdI",
+    "NomeFile",
+    "Fornitore",
+    "PIVA",
+    "CF",
+    "TipoXML",
+    "Numero",
+    "Data",
+    "Imponibile",
+    "IVA",
+    "Importo",
+    "Causale",
+]
+
+# Righe dei documenti (tabella righe_documenti, chiave DocumentoId + Riga):
+# Prezzo unitario in centesimi, Quantita e AliquotaIVA decimali
+COLONNE_RIGHE = ["Descrizione", "Quantita", "Prezzo", "AliquotaIVA", "Natura"]
+
+# Importi sempre in centesimi interi (int64), sia su disco sia nei DataFrame
+COLONNE_IMPORTI = ["Imponibile", "IVA", "Importo"]
+
+# Dati riportati nel PDF di cortesia: modificarli invalida il PDF registrato
+COLONNE_PDF = [
+    "Numero",
+    "Data",
+    "Controparte",
+    "Imponibile",
+    "IVA",
+    "Importo",
+    "TipoXML",
+    "ClienteId",
+    "Causale",
+    "ModalitaPagamento",
+    "Cessionario",
+]
+
+TIPI_DOC = ["Emessa", "Ricevuta"]
+TIPI_XML = ["TD01", "TD02", "TD04", "TD05"]
+# dopo "Inviato" gli stati arrivano dalle notifiche SdI (vedi invio_sdi)
+STATI_DOC = [
+    "Creazione",
+    "Creato",
+    "Inviato",
+    "Consegnato",
+    "Mancata consegna",
+    "Scartato",
+    "Decorrenza termini",
+    "Accettato",
+    "Rifiutato",
+]
+
+# Avanzamento di ogni stato nel ciclo SdI: invio e notifiche portano solo
+# avanti (una notifica in ritardo o un invio registrato due volte non
+# riportano un documento consegnato o scartato a "Inviato"); gli stati
+# con lo stesso rango sono esiti alternativi
+RANGO_STATI = {
+    "Inviato": 1,
+    "Consegnato": 2,
+    "Mancata consegna": 2,
+    "Scartato": 2,
+    "Decorrenza termini": 3,
+    "Accettato": 3,
+    "Rifiutato": 3,
+}
+_RANGO_STATO_SQL = (
+    "CASE Stato "
+    + " ".join(f"WHEN '{stato}' THEN {rango}" for stato, rango in RANGO_STATI.items())
+    + " ELSE 0 END"
+)
+
+# Colonne a valori ricorrenti: codici categorici invece di stringhe per riga
+CATEGORIE_DOC = {
+    "Tipo": pd.CategoricalDtype(TIPI_DOC),
+    "TipoXML": pd.CategoricalDtype(TIPI_XML),
+    "Stato": pd.CategoricalDtype(STATI_DOC),
+}
+
+SEZIONALE_DEFAULT = "FT"
+
+# Numero = sezionale + anno + progressivo (es. FT2025001)
+_RE_NUMERO = re.compile(r"^([A-Za-z]*)(\d{4})(\d+)$")
+
+# Trigger che tengono allineati i contatori mensili ai documenti
+_TRIGGER_CONTATORI = """
+    CREATE TRIGGER trg_contatori_ins AFTER INSERT ON documenti
+    WHEN NEW.Data != ''
+    BEGIN
+        INSERT INTO contatori_mensili (anno, mese, n, Imponibile, IVA, Importo)
+        VALUES (
+            CAST(substr(NEW.Data, 1, 4) AS INTEGER),
+            CAST(substr(NEW.Data, 6, 2) AS INTEGER),
+            1, NEW.Imponibile, NEW.IVA, NEW.Importo
+        )
+        ON CONFLICT (anno, mese) DO UPDATE SET
+            n = n + 1,
+            Imponibile = Imponibile + excluded.Imponibile,
+            IVA = IVA + excluded.IVA,
+            Importo = Importo + excluded.Importo;
+    END;
+    CREATE TRIGGER trg_contatori_del AFTER DELETE ON documenti
+    WHEN OLD.Data != ''
+    BEGIN
+        UPDATE contatori_mensili SET
+            n = n - 1,
+            Imponibile = Imponibile - OLD.Imponibile,
+            IVA = IVA - OLD.IVA,
+            Importo = Importo - OLD.Importo
+        WHERE anno = CAST(substr(OLD.Data, 1, 4) AS INTEGER)
+          AND mese = CAST(substr(OLD.Data, 6, 2) AS INTEGER);
+        DELETE FROM contatori_mensili WHERE n <= 0;
+    END;
+    CREATE TRIGGER trg_contatori_upd_old
+    AFTER UPDATE OF Data, Imponibile, IVA, Importo ON documenti
+    WHEN OLD.Data != ''
+    BEGIN
+        UPDATE contatori_mensili SET
+            n = n - 1,
+            Imponibile = Imponibile - OLD.Imponibile,
+            IVA = IVA - OLD.IVA,
+            Importo = Importo - OLD.Importo
+        WHERE anno = CAST(substr(OLD.Data, 1, 4) AS INTEGER)
+          AND mese = CAST(substr(OLD.Data, 6, 2) AS INTEGER);
+        DELETE FROM contatori_mensili WHERE n <= 0;
+    END;
+    CREATE TRIGGER trg_contatori_upd_new
+    AFTER UPDATE OF Data, Imponibile, IVA, Importo ON documenti
+    WHEN NEW.Data != ''
+    BEGIN
+        INSERT INTO contatori_mensili (anno, mese, n, Imponibile, IVA, Importo)
+        VALUES (
+            CAST(substr(NEW.Data, 1, 4) AS INTEGER),
+            CAST(substr(NEW.Data, 6, 2) AS INTEGER),
+            1, NEW.Imponibile, NEW.IVA, NEW.Importo
+        )
+        ON CONFLICT (anno, mese) DO UPDATE SET
+            n = n + 1,
+            Imponibile = Imponibile + excluded.Imponibile,
+            IVA = IVA + excluded.IVA,
+            Importo = Importo + excluded.Importo;
+        DELETE FROM contatori_mensili WHERE n <= 0;
+    END;
+"""
+
+# Ogni voce porta lo schema alla versione successiva (PRAGMA user_version):
+# le migrazioni già applicate non vengono mai rieseguite.
+_MIGRAZIONI = [
+    """
+    CREATE TABLE documenti (
+        id          INTEGER PRIMARY KEY,
+        Tipo        TEXT NOT NULL DEFAULT '',
+        Numero      TEXT NOT NULL DEFAULT '',
+        Data        TEXT NOT NULL DEFAULT '',
+        Controparte TEXT NOT NULL DEFAULT '',
+        Imponibile  REAL NOT NULL DEFAULT 0,
+        IVA         REAL NOT NULL DEFAULT 0,
+        Importo     REAL NOT NULL DEFAULT 0,
+        TipoXML     TEXT NOT NULL DEFAULT '',
+        Stato       TEXT NOT NULL DEFAULT '',
+        UUID        TEXT NOT NULL DEFAULT '',
+        PDF         TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX idx_documenti_numero ON documenti (Numero);
+    CREATE INDEX idx_documenti_data ON documenti (Data);
+    CREATE INDEX idx_documenti_controparte ON documenti (Controparte);
+    """,
+    """
+    CREATE TABLE numerazione (
+        anno      INTEGER NOT NULL,
+        sezionale TEXT NOT NULL,
+        ultimo    INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (anno, sezionale)
+    ) WITHOUT ROWID;
+    INSERT INTO numerazione (anno, sezionale, ultimo)
+    SELECT CAST(substr(Numero, 3, 4) AS INTEGER),
+           'FT',
+           MAX(CAST(substr(Numero, 7) AS INTEGER))
+    FROM documenti
+    WHERE Numero GLOB 'FT[0-9][0-9][0-9][0-9][0-9]*'
+      AND substr(Numero, 7) NOT GLOB '*[^0-9]*'
+    GROUP BY 1;
+    """,
+    """
+    CREATE TABLE contatori_mensili (
+        anno       INTEGER NOT NULL,
+        mese       INTEGER NOT NULL,
+        n          INTEGER NOT NULL DEFAULT 0,
+        Imponibile REAL NOT NULL DEFAULT 0,
+        IVA        REAL NOT NULL DEFAULT 0,
+        Importo    REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (anno, mese)
+    ) WITHOUT ROWID;
+    INSERT INTO contatori_mensili (anno, mese, n, Imponibile, IVA, Importo)
+    SELECT CAST(substr(Data, 1, 4) AS INTEGER),
+           CAST(substr(Data, 6, 2) AS INTEGER),
+           COUNT(*), SUM(Imponibile), SUM(IVA), SUM(Importo)
+    FROM documenti
+    WHERE Data != ''
+    GROUP BY 1, 2;
+    """
+    + _TRIGGER_CONTATORI,
+    # importi in centesimi interi (nessuna deriva da arrotondamenti float)
+    """
+    DROP TRIGGER trg_contatori_ins;
+    DROP TRIGGER trg_contatori_del;
+    DROP TRIGGER trg_contatori_upd_old;
+    DROP TRIGGER trg_contatori_upd_new;
+    CREATE TABLE documenti_cent (
+        id          INTEGER PRIMARY KEY,
+        Tipo        TEXT NOT NULL DEFAULT '',
+        Numero      TEXT NOT NULL DEFAULT '',
+        Data        TEXT NOT NULL DEFAULT '',
+        Controparte TEXT NOT NULL DEFAULT '',
+        Imponibile  INTEGER NOT NULL DEFAULT 0,
+        IVA         INTEGER NOT NULL DEFAULT 0,
+        Importo     INTEGER NOT NULL DEFAULT 0,
+        TipoXML     TEXT NOT NULL DEFAULT '',
+        Stato       TEXT NOT NULL DEFAULT '',
+        UUID        TEXT NOT NULL DEFAULT '',
+        PDF         TEXT NOT NULL DEFAULT ''
+    );
+    INSERT INTO documenti_cent
+    SELECT id, Tipo, Numero, Data, Controparte,
+           CAST(ROUND(Imponibile * 100) AS INTEGER),
+           CAST(ROUND(IVA * 100) AS INTEGER),
+           CAST(ROUND(Importo * 100) AS INTEGER),
+           TipoXML, Stato, UUID, PDF
+    FROM documenti;
+    DROP TABLE documenti;
+    ALTER TABLE documenti_cent RENAME TO documenti;
+    CREATE INDEX idx_documenti_numero ON documenti (Numero);
+    CREATE INDEX idx_documenti_data ON documenti (Data);
+    CREATE INDEX idx_documenti_controparte ON documenti (Controparte);
+    DROP TABLE contatori_mensili;
+    CREATE TABLE contatori_mensili (
+        anno       INTEGER NOT NULL,
+        mese       INTEGER NOT NULL,
+        n          INTEGER NOT NULL DEFAULT 0,
+        Imponibile INTEGER NOT NULL DEFAULT 0,
+        IVA        INTEGER NOT NULL DEFAULT 0,
+        Importo    INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (anno, mese)
+    ) WITHOUT ROWID;
+    INSERT INTO contatori_mensili (anno, mese, n, Imponibile, IVA, Importo)
+    SELECT CAST(substr(Data, 1, 4) AS INTEGER),
+           CAST(substr(Data, 6, 2) AS INTEGER),
+           COUNT(*), SUM(Imponibile), SUM(IVA), SUM(Importo)
+    FROM documenti
+    WHERE Data != ''
+    GROUP BY 1, 2;
+    """
+    + _TRIGGER_CONTATORI,
+    # rubrica: i documenti puntano al cliente per id, Controparte resta come
+    # denominazione al momento dell'emissione
+    """
+    CREATE TABLE clienti (
+        id                 INTEGER PRIMARY KEY,
+        Denominazione      TEXT NOT NULL DEFAULT '',
+        PIVA               TEXT NOT NULL DEFAULT '',
+        CF                 TEXT NOT NULL DEFAULT '',
+        Indirizzo          TEXT NOT NULL DEFAULT '',
+        CAP                TEXT NOT NULL DEFAULT '',
+        Comune             TEXT NOT NULL DEFAULT '',
+        Provincia          TEXT NOT NULL DEFAULT '',
+        CodiceDestinatario TEXT NOT NULL DEFAULT '',
+        PEC                TEXT NOT NULL DEFAULT '',
+        Tipo               TEXT NOT NULL DEFAULT 'Cliente'
+    );
+    CREATE INDEX idx_clienti_denominazione ON clienti (Denominazione);
+    CREATE INDEX idx_clienti_piva ON clienti (PIVA);
+    CREATE INDEX idx_clienti_cf ON clienti (CF);
+    ALTER TABLE documenti ADD COLUMN ClienteId INTEGER REFERENCES clienti (id);
+    CREATE INDEX idx_documenti_cliente ON documenti (ClienteId);
+    INSERT INTO clienti (Denominazione)
+    SELECT DISTINCT Controparte FROM documenti WHERE Controparte != '';
+    UPDATE documenti SET ClienteId = (
+        SELECT id FROM clienti WHERE clienti.Denominazione = documenti.Controparte
+    )
+    WHERE Controparte != '';
+    """,
+    # indice full-text (trigrammi) per la barra di ricerca: numero,
+    # controparte, P.IVA/CF, causale e descrizioni delle righe
+    """
+    ALTER TABLE documenti ADD COLUMN Causale TEXT NOT NULL DEFAULT '';
+    CREATE VIRTUAL TABLE ricerca_documenti USING fts5 (
+        Numero, Controparte, PivaCf, Causale, Descrizioni,
+        tokenize = 'trigram'
+    );
+    INSERT INTO ricerca_documenti
+        (rowid, Numero, Controparte, PivaCf, Causale, Descrizioni)
+    SELECT d.id, d.Numero, d.Controparte,
+           COALESCE(c.PIVA || ' ' || c.CF, ''), d.Causale, ''
+    FROM documenti d LEFT JOIN clienti c ON c.id = d.ClienteId;
+    CREATE TRIGGER trg_ricerca_ins AFTER INSERT ON documenti
+    BEGIN
+        INSERT INTO ricerca_documenti
+            (rowid, Numero, Controparte, PivaCf, Causale, Descrizioni)
+        VALUES (
+            NEW.id, NEW.Numero, NEW.Controparte,
+            COALESCE(
+                (SELECT PIVA || ' ' || CF FROM clienti WHERE id = NEW.ClienteId), ''
+            ),
+            NEW.Causale, ''
+        );
+    END;
+    CREATE TRIGGER trg_ricerca_del AFTER DELETE ON documenti
+    BEGIN
+        DELETE FROM ricerca_documenti WHERE rowid = OLD.id;
+    END;
+    CREATE TRIGGER trg_ricerca_upd
+    AFTER UPDATE OF Numero, Controparte, ClienteId, Causale ON documenti
+    BEGIN
+        UPDATE ricerca_documenti SET
+            Numero = NEW.Numero,
+            Controparte = NEW.Controparte,
+            PivaCf = COALESCE(
+                (SELECT PIVA || ' ' || CF FROM clienti WHERE id = NEW.ClienteId), ''
+            ),
+            Causale = NEW.Causale
+        WHERE rowid = NEW.id;
+    END;
+    CREATE TRIGGER trg_ricerca_clienti AFTER UPDATE OF PIVA, CF ON clienti
+    BEGIN
+        UPDATE ricerca_documenti SET PivaCf = NEW.PIVA || ' ' || NEW.CF
+        WHERE rowid IN (SELECT id FROM documenti WHERE ClienteId = NEW.id);
+    END;
+    """,
+    # registro fatture ricevute: numerazione dei fornitori, non la nostra,
+    # quindi tabella separata da documenti (niente contatori né sezionali)
+    """
+    CREATE TABLE fatture_ricevute (
+        id                INTEGER PRIMARY KEY,
+        IdentificativoSdI TEXT NOT NULL DEFAULT '',
+        NomeFile          TEXT NOT NULL DEFAULT '',
+        Fornitore         TEXT NOT NULL DEFAULT '',
+        PIVA              TEXT NOT NULL DEFAULT '',
+        CF                TEXT NOT NULL DEFAULT '',
+        TipoXML           TEXT NOT NULL DEFAULT '',
+        Numero            TEXT NOT NULL DEFAULT '',
+        Data              TEXT NOT NULL DEFAULT '',
+        Imponibile        INTEGER NOT NULL DEFAULT 0,
+        IVA               INTEGER NOT NULL DEFAULT 0,
+        Importo           INTEGER NOT NULL DEFAULT 0,
+        Causale           TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX idx_ricevute_data ON fatture_ricevute (Data);
+    CREATE INDEX idx_ricevute_piva ON fatture_ricevute (PIVA);
+    """,
+    # indice dei file già importati dai pacchetti AdE (fatture e metadati),
+    # per saltarli prima di leggerli quando si ricarica un pacchetto
+    """
+    CREATE TABLE file_ricevuti (
+        Impronta          TEXT PRIMARY KEY,
+        NomeFile          TEXT NOT NULL,
+        Metadati          INTEGER NOT NULL DEFAULT 0,
+        IdentificativoSdI TEXT NOT NULL DEFAULT ''
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_file_ricevuti_metadati ON file_ricevuti (NomeFile)
+        WHERE Metadati = 1;
+    CREATE INDEX idx_ricevute_sdi ON fatture_ricevute (IdentificativoSdI)
+        WHERE IdentificativoSdI != '';
+    """,
+    # notifiche SdI: cursore di lettura salvato e ricerca dei documenti per UUID
+    """
+    CREATE TABLE cursori (
+        Nome   TEXT PRIMARY KEY,
+        Valore TEXT NOT NULL DEFAULT ''
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_documenti_uuid ON documenti (UUID) WHERE UUID != '';
+    """,
+    # rubrica: indice a trigrammi su denominazione, P.IVA e comune (contenuto
+    # letto da clienti) e indice per l'ordinamento per comune
+    """
+    CREATE INDEX idx_clienti_comune ON clienti (Comune);
+    CREATE VIRTUAL TABLE ricerca_clienti USING fts5 (
+        Denominazione, PIVA, Comune,
+        content = 'clienti', content_rowid = 'id', tokenize = 'trigram'
+    );
+    INSERT INTO ricerca_clienti (ricerca_clienti) VALUES ('rebuild');
+    CREATE TRIGGER trg_rubrica_ins AFTER INSERT ON clienti
+    BEGIN
+        INSERT INTO ricerca_clienti (rowid, Denominazione, PIVA, Comune)
+        VALUES (NEW.id, NEW.Denominazione, NEW.PIVA, NEW.Comune);
+    END;
+    CREATE TRIGGER trg_rubrica_del AFTER DELETE ON clienti
+    BEGIN
+        INSERT INTO ricerca_clienti (ricerca_clienti, rowid, Denominazione, PIVA, Comune)
+        VALUES ('delete', OLD.id, OLD.Denominazione, OLD.PIVA, OLD.Comune);
+    END;
+    CREATE TRIGGER trg_rubrica_upd AFTER UPDATE OF Denominazione, PIVA, Comune ON clienti
+    BEGIN
+        INSERT INTO ricerca_clienti (ricerca_clienti, rowid, Denominazione, PIVA, Comune)
+        VALUES ('delete', OLD.id, OLD.Denominazione, OLD.PIVA, OLD.Comune);
+        INSERT INTO ricerca_clienti (rowid, Denominazione, PIVA, Comune)
+        VALUES (NEW.id, NEW.Denominazione, NEW.PIVA, NEW.Comune);
+    END;
+    """,
+    # righe delle fatture, una per riga di dettaglio: PDF e XML si rigenerano
+    # dall'archivio e i totali si ricalcolano da qui
+    """
+    CREATE TABLE righe_documenti (
+        DocumentoId INTEGER NOT NULL REFERENCES documenti (id),
+        Riga        INTEGER NOT NULL,
+        Descrizione TEXT NOT NULL DEFAULT '',
+        Quantita    REAL NOT NULL DEFAULT 1,
+        Prezzo      INTEGER NOT NULL DEFAULT 0,
+        AliquotaIVA REAL NOT NULL DEFAULT 0,
+        Natura      TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (DocumentoId, Riga)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER trg_righe_del AFTER DELETE ON documenti
+    BEGIN
+        DELETE FROM righe_documenti WHERE DocumentoId = OLD.id;
+    END;
+    """,
+    # versione dei dati: cresce a ogni modifica di documenti o rubrica, anche
+    # da altri processi; i dati derivati (contatori, riepiloghi) si tengono in
+    # cache per versione
+    """
+    CREATE TABLE versione_dati (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        n  INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT INTO versione_dati (id, n) VALUES (1, 0);
+    CREATE TRIGGER trg_versione_doc_ins AFTER INSERT ON documenti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    CREATE TRIGGER trg_versione_doc_del AFTER DELETE ON documenti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    CREATE TRIGGER trg_versione_doc_upd AFTER UPDATE ON documenti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    CREATE TRIGGER trg_versione_cli_ins AFTER INSERT ON clienti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    CREATE TRIGGER trg_versione_cli_del AFTER DELETE ON clienti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    CREATE TRIGGER trg_versione_cli_upd AFTER UPDATE ON clienti
+    BEGIN
+        UPDATE versione_dati SET n = n + 1;
+    END;
+    """,
+    # modalità di pagamento riportata nel PDF: salvata col documento perché il
+    # PDF rigenerato dall'archivio sia identico a quello del salvataggio
+    """
+    ALTER TABLE documenti ADD COLUMN ModalitaPagamento TEXT NOT NULL DEFAULT '';
+    """,
+    # cessionario fissato nel documento; i documenti già salvati prendono
+    # l'anagrafica attuale della rubrica
+    """
+    ALTER TABLE documenti ADD COLUMN Cessionario TEXT NOT NULL DEFAULT '';
+    UPDATE documenti SET Cessionario = (
+        SELECT json_object(
+            'Denominazione', Denominazione, 'PIVA', PIVA, 'CF', CF,
+            'Indirizzo', Indirizzo, 'CAP', CAP, 'Comune', Comune,
+            'Provincia', Provincia, 'CodiceDestinatario', CodiceDestinatario,
+            'PEC', PEC
+        )
+        FROM clienti WHERE clienti.id = documenti.ClienteId
+    )
+    WHERE ClienteId IN (SELECT id FROM clienti);
+    """,
+]
+
+# L'indice a trigrammi trova solo sottostringhe di almeno 3 caratteri
+LUNGHEZZA_MIN_RICERCA = 3
+
+# Pesi bm25 delle colonne di ricerca_documenti: un numero o una P.IVA
+# trovati contano più di una parola nella causale
+_PESI_RICERCA = (10.0, 3.0, 5.0, 1.0, 1.0)
+
+# Rubrica: colonne di ricerca (indice ricerca_clienti) e di ordinamento
+COLONNE_RICERCA_CONTATTI = ["Denominazione", "PIVA", "Comune"]
+ORDINI_CONTATTI = ["Denominazione", "PIVA", "Comune"]
+
+# Ricerca approssimata nella rubrica: candidati letti dall'indice e quota
+# minima dei trigrammi cercati da ritrovare in un campo
+CANDIDATI_SIMILI = 200
+SOGLIA_SIMILI = 0.5
+
+
+class NumeroDuplicato(ValueError):
+    """Il numero documento è già presente in archivio."""
+
+
+class DataNonValida(ValueError):
+    """Data documento mancante o non nel formato AAAA-MM-GG."""
+
+
+class ArchivioDocumenti:
+    """
+    Archivio su disco dei documenti emessi, con lo schema COLONNE_DOC.
+
+    Le date sono salvate in formato ISO (AAAA-MM-GG), così l'indice su
+    Data serve anche per i filtri per anno/mese; gli importi sono in
+    centesimi interi. I DataFrame restituiti sono già tipizzati (vedi
+    tipizza_documenti). Ogni operazione apre una propria connessione:
+    l'oggetto può essere condiviso tra sessioni e thread di Streamlit, e
+    più processi possono usare lo stesso file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connessione() as conn:
+            self._migra(conn)
+
+    # --------------------------
+    # CONNESSIONE / TRANSAZIONI
+    # --------------------------
+    @contextmanager
+    def _connessione(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transazione(self) -> Iterator[sqlite3.Connection]:
+        """
+        Transazione in scrittura: BEGIN IMMEDIATE prende subito il lock,
+        quindi letture e scritture al suo interno sono atomiche anche tra
+        processi diversi.
+        """
+        with self._connessione() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _migra(self, conn: sqlite3.Connection) -> None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            versione = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, script in enumerate(_MIGRAZIONI[versione:], start=versione + 1):
+                for istruzione in _istruzioni(script):
+                    conn.execute(istruzione)
+                conn.execute(f"PRAGMA user_version = {i}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --------------------------
+    # SCRITTURA
+    # --------------------------
+    def inserisci_documento(
+        self,
+        doc: dict,
+        sezionale: str = SEZIONALE_DEFAULT,
+        descrizioni: str = "",
+        righe: Optional[pd.DataFrame] = None,
+    ) -> int:
+        """
+        Inserimento in coda (append-only): costo indipendente dalla
+        dimensione dell'archivio. Restituisce l'id del documento.
+
+        Se Numero è vuoto viene assegnato il progressivo successivo del
+        sezionale per l'anno della data documento, nella stessa
+        transazione dell'inserimento: due sessioni non possono ottenere
+        lo stesso numero. Un numero già usato solleva NumeroDuplicato, una
+        Data mancante o non valida DataNonValida.
+        Senza Cessionario vi si fissa l'anagrafica attuale del cliente
+        ClienteId, come fa aggiorna_documento quando cambia il cliente.
+        Le righe (DataFrame con COLONNE_RIGHE) si registrano nella stessa
+        transazione; le loro descrizioni, o descrizioni se indicato,
+        finiscono anche nell'indice di ricerca.
+        """
+        valori = _valori_documento(doc)
+        anno = _controlla_data(valori[COLONNE_DOC.index("Data")]).year
+        with self.transazione() as conn:
+            numero = valori[COLONNE_DOC.index("Numero")]
+            if not numero:
+                numero = _assegna_numero(conn, anno, sezionale)
+                valori = _con_numero(valori, numero)
+            else:
+                _registra_numero(conn, numero)
+            doc_id = _inserisci(conn, _con_cessionario(conn, valori))
+            if righe is not None:
+                conn.executemany(
+                    "INSERT INTO righe_documenti "
+                    f"(DocumentoId, Riga, {', '.join(COLONNE_RIGHE)}) "
+                    f"VALUES (?, ?, {', '.join('?' for _ in COLONNE_RIGHE)})",
+                    _valori_righe(doc_id, righe),
+                )
+                descrizioni = descrizioni or " ".join(
+                    d for d in righe["Descrizione"].tolist() if d
+                )
+            if descrizioni:
+                conn.execute(
+                    "UPDATE ricerca_documenti SET Descrizioni = ? WHERE rowid = ?",
+                    (descrizioni, doc_id),
+                )
+            return doc_id
+
+    def assegna_numero(self, anno: int, sezionale: str = SEZIONALE_DEFAULT) -> str:
+        """Riserva e restituisce il prossimo numero del sezionale per l'anno."""
+        with self.transazione() as conn:
+            return _assegna_numero(conn, anno, sezionale)
+
+    def aggiorna_stato(self, doc_id: int, stato: str) -> None:
+        with self.transazione() as conn:
+            conn.execute(
+                "UPDATE documenti SET Stato = ? WHERE id = ?", (stato, int(doc_id))
+            )
+
+    def registra_invio(self, doc_id: int, uuid: str) -> None:
+        """
+        Esito positivo dell'invio SdI: UUID dell'intermediario e stato
+        Inviato, se il documento non è già più avanti (vedi RANGO_STATI).
+        """
+        with self.transazione() as conn:
+            conn.execute(
+                "UPDATE documenti SET UUID = ?, Stato = CASE WHEN "
+                f"{_RANGO_STATO_SQL} < ? THEN 'Inviato' ELSE Stato END WHERE id = ?",
+                (uuid, RANGO_STATI["Inviato"], int(doc_id)),
+            )
+
+    def applica_notifiche(self, stati: list, cursore: str, valore: str) -> int:
+        """
+        Stati da notifiche SdI [(UUID, Stato)], nell'ordine di arrivo, e
+        nuova posizione del cursore, in una transazione: una notifica non si
+        applica due volte né si perde, e uno stato non torna indietro
+        (RANGO_STATI). Ritorna i documenti aggiornati.
+        """
+        with self.transazione() as conn:
+            cur = conn.executemany(
+                "UPDATE documenti SET Stato = ? WHERE UUID = ? AND UUID != '' "
+                f"AND {_RANGO_STATO_SQL} < ?",
+                [(stato, uuid, RANGO_STATI.get(stato, 0)) for uuid, stato in stati],
+            )
+            conn.execute(
+                "INSERT INTO cursori (Nome, Valore) VALUES (?, ?) "
+                "ON CONFLICT (Nome) DO UPDATE SET Valore = excluded.Valore",
+                (cursore, valore),
+            )
+        return cur.rowcount
+
+    def cursore(self, nome: str) -> str:
+        with self._connessione() as conn:
+            riga = conn.execute(
+                "SELECT Valore FROM cursori WHERE Nome = ?", (nome,)
+            ).fetchone()
+        return riga[0] if riga else ""
+
+    def aggiorna_documento(self, doc_id: int, campi: dict) -> None:
+        colonne = [c for c in campi if c in COLONNE_DOC and c != "Numero"]
+        if not colonne:
+            return
+        valori = dict(zip(COLONNE_DOC, _valori_documento(campi)))
+        if "Data" in colonne:
+            _controlla_data(valori["Data"])
+        if "ClienteId" in colonne and "Cessionario" not in colonne:
+            colonne.append("Cessionario")
+        if "PDF" not in colonne and set(colonne) & set(COLONNE_PDF):
+            colonne.append("PDF")
+        with self.transazione() as conn:
+            if "ClienteId" in colonne:
+                valori = dict(
+                    zip(COLONNE_DOC, _con_cessionario(conn, tuple(valori.values())))
+                )
+            conn.execute(
+                f"UPDATE documenti SET {', '.join(f'{c} = ?' for c in colonne)} "
+                "WHERE id = ?",
+                tuple(valori[c] for c in colonne) + (int(doc_id),),
+            )
+
+    def registra_pdf(self, percorsi: dict) -> None:
+        """Percorso del PDF per più documenti {id: percorso}, in una transazione."""
+        with self.transazione() as conn:
+            conn.executemany(
+                "UPDATE documenti SET PDF = ? WHERE id = ?",
+                [(percorso, int(doc_id)) for doc_id, percorso in percorsi.items()],
+            )
+
+    def elimina_documento(self, doc_id: int) -> None:
+        with self.transazione() as conn:
+            conn.execute("DELETE FROM documenti WHERE id = ?", (int(doc_id),))
+
+    # --------------------------
+    # LETTURA
+    # --------------------------
+    def documenti(
+        self,
+        anno: Optional[int] = None,
+        mese: Optional[int] = None,
+        limite: Optional[int] = None,
+        offset: int = 0,
+        decrescente: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Documenti come DataFrame indicizzato per id, filtrati per anno e
+        (opzionalmente) mese tramite range sull'indice di Data. Con limite
+        e offset si legge solo una pagina, nell'ordine dell'indice.
+        """
+        sql = f"SELECT id, {', '.join(COLONNE_DOC)} FROM documenti"
+        params: tuple = ()
+        if anno is not None:
+            inizio, fine = _intervallo_date(anno, mese)
+            sql += " WHERE Data >= ? AND Data < ?"
+            params = (inizio, fine)
+        sql += " ORDER BY Data DESC, id DESC" if decrescente else " ORDER BY Data, id"
+        if limite is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += (int(limite), int(offset))
+        with self._connessione() as conn:
+            df = pd.read_sql_query(sql, conn, params=params, index_col="id")
+        return tipizza_documenti(df)
+
+    def documenti_per_id(self, doc_ids) -> pd.DataFrame:
+        """Documenti richiesti come DataFrame tipizzato indicizzato per id (una query)."""
+        sql = (
+            f"SELECT id, {', '.join(COLONNE_DOC)} FROM documenti "
+            "WHERE id IN (SELECT value FROM json_each(?))"
+        )
+        with self._connessione() as conn:
+            df = pd.read_sql_query(
+                sql, conn, params=(json.dumps([int(i) for i in doc_ids]),), index_col="id"
+            )
+        return tipizza_documenti(df)
+
+    def righe(self, doc_ids) -> pd.DataFrame:
+        """
+        Righe dei documenti richiesti in un solo DataFrame tipizzato
+        (DocumentoId, Riga e COLONNE_RIGHE), per documento e numero di riga.
+        """
+        with self._connessione() as conn:
+            df = pd.read_sql_query(
+                f"SELECT DocumentoId, Riga, {', '.join(COLONNE_RIGHE)} "
+                "FROM righe_documenti "
+                "WHERE DocumentoId IN (SELECT value FROM json_each(?)) "
+                "ORDER BY DocumentoId, Riga",
+                conn,
+                params=(json.dumps([int(i) for i in doc_ids]),),
+            )
+        return tipizza_righe(df)
+
+    def cerca_documenti(
+        self, testo: str, limite: int = 50, offset: int = 0
+    ) -> pd.DataFrame:
+        """
+        Ricerca su tutti gli anni tramite l'indice a trigrammi: documenti
+        tipizzati in ordine di rilevanza (bm25), poi per data decrescente.
+        """
+        filtro, params, ordine = _filtro_ricerca(testo)
+        colonne = ", ".join(f"d.{c}" for c in COLONNE_DOC)
+        sql = (
+            f"SELECT d.id, {colonne} FROM ricerca_documenti r "
+            "JOIN documenti d ON d.id = r.rowid "
+            f"WHERE {filtro} ORDER BY {ordine}d.Data DESC, d.id DESC "
+            "LIMIT ? OFFSET ?"
+        )
+        with self._connessione() as conn:
+            df = pd.read_sql_query(
+                sql, conn, params=params + (int(limite), int(offset)), index_col="id"
+            )
+        return tipizza_documenti(df)
+
+    def documenti_filtrati(
+        self,
+        da: str,
+        a: str,
+        cliente_id: Optional[int] = None,
+        stati: Sequence[str] = (),
+        tipo: str = "Emessa",
+        blocco: int = 500,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Documenti dal giorno da al giorno a (inclusi, "YYYY-MM-DD"), per
+        cliente e stati se indicati, in ordine di data: DataFrame tipizzati
+        di al più blocco righe, letti uno alla volta.
+        """
+        filtro, params = _filtro_documenti(da, a, cliente_id, stati, tipo)
+        with self._connessione() as conn:
+            for df in pd.read_sql_query(
+                f"SELECT id, {', '.join(COLONNE_DOC)} FROM documenti "
+                f"WHERE {filtro} ORDER BY Data, id",
+                conn,
+                params=params,
+                index_col="id",
+                chunksize=blocco,
+            ):
+                yield tipizza_documenti(df)
+
+    def conta_filtrati(
+        self,
+        da: str,
+        a: str,
+        cliente_id: Optional[int] = None,
+        stati: Sequence[str] = (),
+        tipo: str = "Emessa",
+    ) -> int:
+        filtro, params = _filtro_documenti(da, a, cliente_id, stati, tipo)
+        with self._connessione() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM documenti WHERE {filtro}", params
+            ).fetchone()[0]
+
+    def conta_ricerca(self, testo: str) -> int:
+        filtro, params, _ = _filtro_ricerca(testo)
+        with self._connessione() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM ricerca_documenti r WHERE {filtro}", params
+            ).fetchone()[0]
+
+    def documento(self, doc_id: int) -> Optional[dict]:
+        with self._connessione() as conn:
+            cur = conn.execute(
+                f"SELECT {', '.join(COLONNE_DOC)} FROM documenti WHERE id = ?",
+                (int(doc_id),),
+            )
+            riga = cur.fetchone()
+        if riga is None:
+            return None
+        return dict(zip(COLONNE_DOC, riga))
+
+    def prossimo_numero(self, anno: int, sezionale: str = SEZIONALE_DEFAULT) -> str:
+        """
+        Anteprima del prossimo numero (lettura O(1) del contatore): non
+        lo riserva, l'assegnazione definitiva avviene all'inserimento.
+        """
+        with self._connessione() as conn:
+            riga = conn.execute(
+                "SELECT ultimo FROM numerazione WHERE anno = ? AND sezionale = ?",
+                (anno, sezionale),
+            ).fetchone()
+        return _formatta_numero(sezionale, anno, (riga[0] if riga else 0) + 1)
+
+    def versione(self) -> int:
+        """
+        Versione dei dati di documenti e rubrica: cambia a ogni scrittura,
+        quindi è la chiave per le cache dei dati derivati.
+        """
+        with self._connessione() as conn:
+            return conn.execute("SELECT n FROM versione_dati").fetchone()[0]
+
+    def anni(self) -> list:
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT DISTINCT anno FROM contatori_mensili ORDER BY 1"
+            ).fetchall()
+        return [r[0] for r in righe]
+
+    def conteggi_mensili(self, anno: int) -> dict:
+        """Numero documenti per mese dell'anno, dai contatori (al più 12 righe)."""
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT mese, n FROM contatori_mensili WHERE anno = ?", (anno,)
+            ).fetchall()
+        conteggi = {m: 0 for m in range(1, 13)}
+        conteggi.update(dict(righe))
+        return conteggi
+
+    def totali_mensili(
+        self, anno_da: int, anno_a: int, per_cliente: bool = False
+    ) -> pd.DataFrame:
+        """
+        Somme di Importo, Imponibile e IVA per (Anno, [Controparte,] Mese).
+        Senza dettaglio cliente si leggono i contatori mensili; con il
+        dettaglio serve un'unica aggregazione sul range di Data indicizzato.
+        """
+        if not per_cliente:
+            with self._connessione() as conn:
+                return pd.read_sql_query(
+                    "SELECT anno AS Anno, mese AS Mese, Importo, Imponibile, IVA "
+                    "FROM contatori_mensili WHERE anno BETWEEN ? AND ?",
+                    conn,
+                    params=(anno_da, anno_a),
+                )
+        sql = (
+            "SELECT CAST(substr(Data, 1, 4) AS INTEGER) AS Anno, "
+            "CAST(substr(Data, 6, 2) AS INTEGER) AS Mese, Controparte, "
+            "SUM(Importo) AS Importo, SUM(Imponibile) AS Imponibile, "
+            "SUM(IVA) AS IVA "
+            "FROM documenti WHERE Data >= ? AND Data < ? "
+            "GROUP BY Anno, Controparte, Mese"
+        )
+        params = (_intervallo_date(anno_da)[0], _intervallo_date(anno_a)[1])
+        with self._connessione() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    # --------------------------
+    # RUBRICA
+    # --------------------------
+    def salva_cliente(self, cliente: dict, cliente_id: Optional[int] = None) -> int:
+        """
+        Inserisce o aggiorna un contatto e ne restituisce l'id stabile.
+        Senza cliente_id il contatto esistente si cerca per P.IVA, poi per
+        codice fiscale; per denominazione solo se non sono indicati né l'una
+        né l'altro, e solo tra i contatti senza P.IVA e CF (altrimenti se ne
+        crea uno nuovo). In aggiornamento si scrivono solo i campi presenti.
+        """
+        campi = {
+            c: str(cliente.get(c) or "").strip()
+            for c in CLIENTI_COLONNE
+            if c in cliente
+        }
+        with self.transazione() as conn:
+            if cliente_id is None:
+                cliente_id = _trova_cliente(
+                    conn,
+                    campi.get("PIVA", ""),
+                    campi.get("CF", ""),
+                    campi.get("Denominazione", ""),
+                )
+            if cliente_id is None:
+                campi.setdefault("Tipo", TIPI_CONTATTO[0])
+                cur = conn.execute(
+                    f"INSERT INTO clienti ({', '.join(campi)}) "
+                    f"VALUES ({', '.join('?' for _ in campi)})",
+                    tuple(campi.values()),
+                )
+                return int(cur.lastrowid)
+            if campi:
+                conn.execute(
+                    f"UPDATE clienti SET {', '.join(f'{c} = ?' for c in campi)} "
+                    "WHERE id = ?",
+                    tuple(campi.values()) + (int(cliente_id),),
+                )
+            return int(cliente_id)
+
+    def cliente(self, cliente_id: int) -> Optional[dict]:
+        with self._connessione() as conn:
+            riga = conn.execute(
+                f"SELECT {', '.join(CLIENTI_COLONNE)} FROM clienti WHERE id = ?",
+                (int(cliente_id),),
+            ).fetchone()
+        if riga is None:
+            return None
+        return dict(zip(CLIENTI_COLONNE, riga))
+
+    def cerca_cliente(
+        self, piva: str = "", cf: str = "", denominazione: str = ""
+    ) -> Optional[int]:
+        with self._connessione() as conn:
+            return _trova_cliente(conn, piva.strip(), cf.strip(), denominazione.strip())
+
+    def clienti(self) -> pd.DataFrame:
+        """Rubrica completa come DataFrame indicizzato per id."""
+        with self._connessione() as conn:
+            return pd.read_sql_query(
+                f"SELECT id, {', '.join(CLIENTI_COLONNE)} FROM clienti "
+                "ORDER BY Denominazione, id",
+                conn,
+                index_col="id",
+            )
+
+    def contatti(
+        self,
+        testo: str = "",
+        tipi: Sequence[str] = TIPI_CONTATTO,
+        ordine: str = "Denominazione",
+        decrescente: bool = False,
+        limite: int = 50,
+        offset: int = 0,
+    ) -> pd.DataFrame:
+        """
+        Una pagina della rubrica, ordinata e filtrata dal database: contatti
+        dei tipi richiesti con tutte le parole di testo in denominazione,
+        P.IVA o comune (vedi _filtro_contatti).
+        """
+        if ordine not in ORDINI_CONTATTI:
+            raise ValueError(f"ordinamento non previsto: {ordine}")
+        filtro, params = _filtro_contatti(testo, tipi)
+        verso = "DESC" if decrescente else "ASC"
+        with self._connessione() as conn:
+            return pd.read_sql_query(
+                f"SELECT id, {', '.join(CLIENTI_COLONNE)} FROM clienti c "
+                f"WHERE {filtro} ORDER BY {ordine} {verso}, id {verso} LIMIT ? OFFSET ?",
+                conn,
+                params=params + (int(limite), int(offset)),
+                index_col="id",
+            )
+
+    def conta_contatti(self, testo: str = "", tipi: Sequence[str] = TIPI_CONTATTO) -> int:
+        filtro, params = _filtro_contatti(testo, tipi)
+        with self._connessione() as conn:
+            return int(
+                conn.execute(f"SELECT COUNT(*) FROM clienti c WHERE {filtro}", params)
+                .fetchone()[0]
+            )
+
+    def contatti_simili(
+        self, testo: str, tipi: Sequence[str] = TIPI_CONTATTO, limite: int = 10
+    ) -> pd.DataFrame:
+        """
+        Ricerca approssimata, per gli errori di battitura: i CANDIDATI_SIMILI
+        contatti con più trigrammi del testo in comune (bm25), tenuti se
+        denominazione, P.IVA e comune insieme ne contengono almeno
+        SOGLIA_SIMILI. In ordine di somiglianza.
+        """
+        cercati = _trigrammi(testo)
+        if not cercati:
+            return pd.DataFrame(columns=CLIENTI_COLONNE).rename_axis("id")
+        colonne = ", ".join(f"c.{c}" for c in CLIENTI_COLONNE)
+        filtro, params = _filtro_contatti("", tipi)
+        with self._connessione() as conn:
+            df = pd.read_sql_query(
+                f"SELECT c.id, {colonne} FROM ricerca_clienti r "
+                "JOIN clienti c ON c.id = r.rowid "
+                f"WHERE ricerca_clienti MATCH ? AND {filtro} "
+                "ORDER BY bm25(ricerca_clienti) LIMIT ?",
+                conn,
+                params=(" OR ".join(map(_frase_fts, cercati)),) + params + (CANDIDATI_SIMILI,),
+                index_col="id",
+            )
+        if df.empty:
+            return df
+        somiglianza = (
+            df[COLONNE_RICERCA_CONTATTI]
+            .agg(" ".join, axis=1)
+            .map(lambda v: len(cercati & _trigrammi(v)) / len(cercati))
+        )
+        ordine = somiglianza[somiglianza >= SOGLIA_SIMILI].sort_values(
+            ascending=False, kind="stable"
+        )
+        return df.loc[ordine.index[:limite]]
+
+    # --------------------------
+    # FATTURE RICEVUTE
+    # --------------------------
+    def inserisci_ricevute(self, righe: list, file: list = ()) -> int:
+        """
+        Inserimento in blocco nel registro, insieme ai file da cui provengono
+        (tuple Impronta, NomeFile, Metadati, IdentificativoSdI), in una sola
+        transazione; ritorna il numero di righe.
+        """
+        valori = [_valori_ricevuta(r) for r in righe]
+        with self.transazione() as conn:
+            conn.executemany(
+                f"INSERT INTO fatture_ricevute ({', '.join(COLONNE_RICEVUTE)}) "
+                f"VALUES ({', '.join('?' for _ in COLONNE_RICEVUTE)})",
+                valori,
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO file_ricevuti "
+                "(Impronta, NomeFile, Metadati, IdentificativoSdI) VALUES (?, ?, ?, ?)",
+                file,
+            )
+        return len(valori)
+
+    def file_ricevuti_noti(self, impronte) -> set:
+        """Impronte già importate, tra quelle richieste (una query, anche per molte)."""
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT Impronta FROM file_ricevuti "
+                "WHERE Impronta IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(impronte)),),
+            ).fetchall()
+        return {r[0] for r in righe}
+
+    def id_sdi_metadati(self, nomi_file) -> dict:
+        """{NomeFile: IdentificativoSdI} dai metadati importati in precedenza."""
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT NomeFile, IdentificativoSdI FROM file_ricevuti "
+                "WHERE Metadati = 1 AND NomeFile IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(nomi_file)),),
+            ).fetchall()
+        return dict(righe)
+
+    def id_sdi_ricevuti(self, id_sdi) -> set:
+        """Identificativi SdI già presenti nel registro, tra quelli richiesti."""
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT DISTINCT IdentificativoSdI FROM fatture_ricevute "
+                "WHERE IdentificativoSdI != '' "
+                "AND IdentificativoSdI IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(id_sdi)),),
+            ).fetchall()
+        return {r[0] for r in righe}
+
+    def ricevute(
+        self,
+        anno: Optional[int] = None,
+        limite: Optional[int] = None,
+        offset: int = 0,
+    ) -> pd.DataFrame:
+        """Registro ricevute per data decrescente, indicizzato per id (una pagina con limite)."""
+        sql = f"SELECT id, {', '.join(COLONNE_RICEVUTE)} FROM fatture_ricevute"
+        params: tuple = ()
+        if anno is not None:
+            sql += " WHERE Data >= ? AND Data < ?"
+            params = _intervallo_date(anno)
+        sql += " ORDER BY Data DESC, id DESC"
+        if limite is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += (int(limite), int(offset))
+        with self._connessione() as conn:
+            df = pd.read_sql_query(sql, conn, params=params, index_col="id")
+        return tipizza_ricevute(df)
+
+    def ricevute_filtrate(
+        self, da: str, a: str, blocco: int = 500
+    ) -> Iterator[pd.DataFrame]:
+        """Registro ricevute dal giorno da al giorno a (inclusi), a blocchi, in ordine di data."""
+        with self._connessione() as conn:
+            for df in pd.read_sql_query(
+                f"SELECT id, {', '.join(COLONNE_RICEVUTE)} FROM fatture_ricevute "
+                "WHERE Data >= ? AND Data <= ? ORDER BY Data, id",
+                conn,
+                params=(str(da), str(a)),
+                index_col="id",
+                chunksize=blocco,
+            ):
+                yield tipizza_ricevute(df)
+
+    def conta_ricevute(self, anno: Optional[int] = None) -> int:
+        sql, params = "SELECT COUNT(*) FROM fatture_ricevute", ()
+        if anno is not None:
+            sql += " WHERE Data >= ? AND Data < ?"
+            params = _intervallo_date(anno)
+        with self._connessione() as conn:
+            return int(conn.execute(sql, params).fetchone()[0])
+
+    def conta_ricevute_filtrate(self, da: str, a: str) -> int:
+        with self._connessione() as conn:
+            return int(
+                conn.execute(
+                    "SELECT COUNT(*) FROM fatture_ricevute WHERE Data >= ? AND Data <= ?",
+                    (str(da), str(a)),
+                ).fetchone()[0]
+            )
+
+    def totali(self) -> tuple:
+        """(numero documenti, totale Importo in centesimi) sull'intero archivio."""
+        with self._connessione() as conn:
+            n, tot = conn.execute(
+                "SELECT COALESCE(SUM(n), 0), COALESCE(SUM(Importo), 0) "
+                "FROM contatori_mensili"
+            ).fetchone()
+        return int(n), int(tot)
+
+
+# ==========================
+# SUPPORTO
+# ==========================
+def tipizza_documenti(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte un DataFrame con colonne COLONNE_DOC nei tipi nativi: Data
+    datetime64 (parsing una sola volta, formato fisso), importi int64 in
+    centesimi, Tipo/TipoXML/Stato categorici. Valori non validi -> NaT/NaN.
+    """
+    df["Data"] = pd.to_datetime(df["Data"], format="%Y-%m-%d", errors="coerce")
+    for col in COLONNE_IMPORTI:
+        df[col] = df[col].astype("int64")
+    for col, dtype in CATEGORIE_DOC.items():
+        df[col] = df[col].astype(dtype)
+    for col in [
+        "Numero",
+        "Controparte",
+        "UUID",
+        "PDF",
+        "Causale",
+        "ModalitaPagamento",
+        "Cessionario",
+    ]:
+        df[col] = df[col].astype("string")
+    df["ClienteId"] = df["ClienteId"].astype("Int64")
+    return df
+
+
+def tipizza_ricevute(df: pd.DataFrame) -> pd.DataFrame:
+    """Registro ricevute nei tipi nativi: Data datetime64, importi int64 in centesimi."""
+    df["Data"] = pd.to_datetime(df["Data"], format="%Y-%m-%d", errors="coerce")
+    for col in COLONNE_IMPORTI:
+        df[col] = df[col].astype("int64")
+    return df
+
+
+def tipizza_righe(df: pd.DataFrame) -> pd.DataFrame:
+    """Righe nei tipi nativi: prezzo int64 in centesimi, quantità e aliquota float64."""
+    for col in ["DocumentoId", "Riga", "Prezzo"]:
+        df[col] = df[col].astype("int64")
+    for col in ["Quantita", "AliquotaIVA"]:
+        df[col] = df[col].astype("float64")
+    for col in ["Descrizione", "Natura"]:
+        df[col] = df[col].astype("string")
+    return df
+
+
+def _istruzioni(script: str) -> Iterator[str]:
+    """Divide uno script SQL in istruzioni complete (anche con trigger)."""
+    corrente = ""
+    for pezzo in script.split(";"):
+        corrente += pezzo + ";"
+        if sqlite3.complete_statement(corrente):
+            if corrente.strip(" \n;"):
+                yield corrente
+            corrente = ""
+
+
+def _valori_documento(doc: dict) -> tuple:
+    valori = []
+    for col in COLONNE_DOC:
+        val = doc.get(col)
+        if col in COLONNE_IMPORTI:
+            valori.append(0 if pd.isna(val) else int(val))
+        elif col == "ClienteId":
+            valori.append(None if pd.isna(val) else int(val))
+        elif col == "Data":
+            valori.append("" if pd.isna(val) or not val else str(val)[:10])
+        else:
+            valori.append("" if pd.isna(val) else str(val))
+    return tuple(valori)
+
+
+def _controlla_data(valore: str) -> date:
+    """Data ISO del documento; l'anno serve anche per numerazione e contatori."""
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", valore):
+        try:
+            return date.fromisoformat(valore)
+        except ValueError:
+            pass
+    raise DataNonValida(f"data documento non valida: {valore!r} (atteso AAAA-MM-GG)")
+
+
+def _valori_righe(doc_id: int, righe: pd.DataFrame) -> list:
+    return [
+        (int(doc_id), n, str(desc), float(qta), int(prezzo), float(aliquota), str(natura))
+        for n, (desc, qta, prezzo, aliquota, natura) in enumerate(
+            zip(*(righe[c].tolist() for c in COLONNE_RIGHE)), start=1
+        )
+    ]
+
+
+def _valori_ricevuta(riga: dict) -> tuple:
+    return tuple(
+        int(riga.get(col) or 0) if col in COLONNE_IMPORTI else str(riga.get(col) or "")
+        for col in COLONNE_RICEVUTE
+    )
+
+
+def _filtro_ricerca(testo: str) -> tuple:
+    """
+    (condizione WHERE, parametri, prefisso di ORDER BY) per
+    ricerca_documenti con alias r. Ogni parola deve comparire in almeno un
+    campo: quelle da 3 caratteri in su passano dall'indice a trigrammi, le
+    più corte (non indicizzabili) filtrano con LIKE solo le righe trovate.
+    Senza parole indicizzabili la ricerca non restituisce nulla.
+    """
+    lunghe = [p for p in testo.split() if len(p) >= LUNGHEZZA_MIN_RICERCA]
+    corte = [p for p in testo.split() if len(p) < LUNGHEZZA_MIN_RICERCA]
+    if not lunghe:
+        return "0", (), ""
+    filtri = ["ricerca_documenti MATCH ?"]
+    params = [" AND ".join(_frase_fts(p) for p in lunghe)]
+    campi = " || ' ' || ".join(
+        f"r.{c}" for c in ["Numero", "Controparte", "PivaCf", "Causale", "Descrizioni"]
+    )
+    for parola in corte:
+        filtri.append(f"({campi}) LIKE ?")
+        params.append(f"%{parola}%")
+    pesi = ", ".join(map(str, _PESI_RICERCA))
+    return " AND ".join(filtri), tuple(params), f"bm25(ricerca_documenti, {pesi}), "
+
+
+def _filtro_contatti(testo: str, tipi: Sequence[str]) -> tuple:
+    """
+    (condizione WHERE, parametri) sulla tabella clienti con alias c. Le
+    parole da 3 caratteri in su si cercano come sottostringhe nell'indice a
+    trigrammi; le più corte come inizio di parola (con LIKE).
+    """
+    filtri, params = [], []
+    if set(tipi) != set(TIPI_CONTATTO):
+        filtri.append("c.Tipo IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(tipi)))
+    lunghe = [p for p in testo.split() if len(p) >= LUNGHEZZA_MIN_RICERCA]
+    corte = [p for p in testo.split() if len(p) < LUNGHEZZA_MIN_RICERCA]
+    if lunghe:
+        filtri.append(
+            "c.id IN (SELECT rowid FROM ricerca_clienti WHERE ricerca_clienti MATCH ?)"
+        )
+        params.append(" AND ".join(_frase_fts(p) for p in lunghe))
+    campi = " || ' ' || ".join(f"c.{c}" for c in COLONNE_RICERCA_CONTATTI)
+    for parola in corte:
+        filtri.append(f"(' ' || {campi}) LIKE ?")
+        params.append(f"% {parola}%")
+    return " AND ".join(filtri) or "1", tuple(params)
+
+
+def _trigrammi(testo: str) -> set:
+    """Trigrammi delle parole di testo, senza distinguere maiuscole."""
+    return {
+        parola[i : i + 3]
+        for parola in str(testo).lower().split()
+        for i in range(len(parola) - 2)
+    }
+
+
+def _frase_fts(parola: str) -> str:
+    # ogni parola come stringa FTS5 tra virgolette: niente operatori dall'utente
+    return '"' + parola.replace('"', '""') + '"'
+
+
+def _trova_cliente(
+    conn: sqlite3.Connection, piva: str, cf: str, denominazione: str
+) -> Optional[int]:
+    # con P.IVA o CF indicati decidono solo quelli; la denominazione identifica
+    # solo contatti senza P.IVA né CF (omonimi con altri dati sono altri soggetti)
+    if piva or cf:
+        ricerche = [
+            (f"{colonna} = ?", (valore,))
+            for colonna, valore in (("PIVA", piva), ("CF", cf))
+            if valore
+        ]
+    elif denominazione:
+        ricerche = [("Denominazione = ? AND PIVA = '' AND CF = ''", (denominazione,))]
+    else:
+        return None
+    for filtro, params in ricerche:
+        riga = conn.execute(
+            f"SELECT id FROM clienti WHERE {filtro} ORDER BY id LIMIT 1", params
+        ).fetchone()
+        if riga:
+            return int(riga[0])
+    return None
+
+
+def _con_numero(valori: tuple, numero: str) -> tuple:
+    idx = COLONNE_DOC.index("Numero")
+    return valori[:idx] + (numero,) + valori[idx + 1 :]
+
+
+def _con_cessionario(conn: sqlite3.Connection, valori: tuple) -> tuple:
+    """Valori del documento con Cessionario, se vuoto, dall'anagrafica attuale del cliente."""
+    idx = COLONNE_DOC.index("Cessionario")
+    cliente_id = valori[COLONNE_DOC.index("ClienteId")]
+    if valori[idx] or cliente_id is None:
+        return valori
+    riga = conn.execute(
+        f"SELECT {', '.join(CAMPI_CESSIONARIO)} FROM clienti WHERE id = ?",
+        (cliente_id,),
+    ).fetchone()
+    if riga is None:
+        return valori
+    cessionario = json.dumps(dict(zip(CAMPI_CESSIONARIO, riga)), ensure_ascii=False)
+    return valori[:idx] + (cessionario,) + valori[idx + 1 :]
+
+
+def _formatta_numero(sezionale: str, anno: int, seq: int) -> str:
+    return f"{sezionale}{anno}{seq:03d}"
+
+
+def _assegna_numero(conn: sqlite3.Connection, anno: int, sezionale: str) -> str:
+    seq = conn.execute(
+        "INSERT INTO numerazione (anno, sezionale, ultimo) VALUES (?, ?, 1) "
+        "ON CONFLICT (anno, sezionale) DO UPDATE SET ultimo = ultimo + 1 "
+        "RETURNING ultimo",
+        (anno, sezionale),
+    ).fetchone()[0]
+    return _formatta_numero(sezionale, anno, seq)
+
+
+def _registra_numero(conn: sqlite3.Connection, numero: str) -> None:
+    """
+    Numero scelto a mano: rifiuta i duplicati e, se segue lo schema
+    sezionale+anno+progressivo, allinea il contatore perché non venga
+    riassegnato in seguito.
+    """
+    esiste = conn.execute(
+        "SELECT 1 FROM documenti WHERE Numero = ? LIMIT 1", (numero,)
+    ).fetchone()
+    if esiste:
+        raise NumeroDuplicato(numero)
+    m = _RE_NUMERO.match(numero)
+    if m:
+        sezionale, anno, seq = m.group(1), int(m.group(2)), int(m.group(3))
+        conn.execute(
+            "INSERT INTO numerazione (anno, sezionale, ultimo) VALUES (?, ?, ?) "
+            "ON CONFLICT (anno, sezionale) DO UPDATE "
+            "SET ultimo = MAX(ultimo, excluded.ultimo)",
+            (anno, sezionale, seq),
+        )
+
+
+def _inserisci(conn: sqlite3.Connection, valori: tuple) -> int:
+    cur = conn.execute(
+        f"INSERT INTO documenti ({', '.join(COLONNE_DOC)}) "
+        f"VALUES ({', '.join('?' for _ in COLONNE_DOC)})",
+        valori,
+    )
+    return int(cur.lastrowid)
+
+
+def _filtro_documenti(
+    da: str, a: str, cliente_id: Optional[int], stati: Sequence[str], tipo: str
+) -> tuple:
+    """(condizione WHERE, parametri) per documenti_filtrati / conta_filtrati."""
+    condizioni = ["Data >= ?", "Data <= ?", "Tipo = ?"]
+    params = [str(da), str(a), tipo]
+    if cliente_id is not None:
+        condizioni.append("ClienteId = ?")
+        params.append(int(cliente_id))
+    if stati:
+        condizioni.append("Stato IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(stati)))
+    return " AND ".join(condizioni), tuple(params)
+
+
+def _intervallo_date(anno: int, mese: Optional[int] = None) -> tuple:
+    if mese is None:
+        return f"{anno:04d}-01-01", f"{anno + 1:04d}-01-01"
+    if mese == 12:
+        return f"{anno:04d}-12-01", f"{anno + 1:04d}-01-01"
+    return f"{anno:04d}-{mese:02d}-01", f"{anno:04d}-{mese + 1:02d}-01"
@@ -0,0 +1,204 @@
+"""
+Calcoli vettoriali su documenti e importi (riepiloghi per periodo, totali
+e riepiloghi IVA dalle righe di fattura).
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+MESI_LABEL = [
+    "Gennaio",
+    "Febbraio",
+    "Marzo",
+    "Aprile",
+    "Maggio",
+    "Giugno",
+    "Luglio",
+    "Agosto",
+    "Settembre",
+    "Ottobre",
+    "Novembre",
+    "Dicembre",
+]
+
+TRIMESTRI_LABEL = ["1° Trimestre", "2° Trimestre", "3° Trimestre", "4° Trimestre"]
+
+PERIODI_LABEL = MESI_LABEL + TRIMESTRI_LABEL + ["Annuale"]
+
+VALORI_RIEPILOGO = ["Importo", "Imponibile", "IVA"]
+
+ALIQUOTE_IVA = [22, 10, 5, 4, 0]
+
+# Codici Natura FatturaPA (obbligatori con aliquota 0), con riferimento breve
+NATURE_IVA = {
+    "N1": "Escluse ex art. 15",
+    "N2.1": "Non soggette artt. 7-7septies",
+    "N2.2": "Non soggette - altri casi",
+    "N3.1": "Non imponibili - esportazioni",
+    "N3.2": "Non imponibili - cessioni intra UE",
+    "N3.3": "Non imponibili - verso San Marino",
+    "N3.4": "Non imponibili - assimilate export",
+    "N3.5": "Non imponibili - dich. d'intento",
+    "N3.6": "Non imponibili - altre",
+    "N4": "Esenti",
+    "N5": "Regime del margine",
+    "N6.1": "Reverse charge - rottami",
+    "N6.2": "Reverse charge - oro e argento",
+    "N6.3": "Reverse charge - subappalto edilizia",
+    "N6.4": "Reverse charge - cessione fabbricati",
+    "N6.5": "Reverse charge - telefoni cellulari",
+    "N6.6": "Reverse charge - prodotti elettronici",
+    "N6.7": "Reverse charge - comparto edile",
+    "N6.8": "Reverse charge - settore energetico",
+    "N6.9": "Reverse charge - altri casi",
+    "N7": "IVA assolta in altro stato UE",
+}
+
+
+# ==========================
+# IMPORTI IN CENTESIMI
+# ==========================
+def formato_eur(val: float) -> str:
+    """1234.5 -> "1.234,50" (formato italiano)."""
+    return (
+        f"{val:,.2f}"
+        .replace(",", "X")
+        .replace(".", ",")
+        .replace("X", ".")
+    )
+
+
+def in_centesimi(valore) -> int:
+    """Euro -> centesimi interi, arrotondamento commerciale (0,005 -> 0,01)."""
+    cent = Decimal(str(valore or 0)).scaleb(2)
+    return int(cent.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def arrotonda_quantita(valore) -> Decimal:
+    """Quantità di riga a 8 decimali (il massimo in FatturaPA), arrotondamento commerciale."""
+    return Decimal(str(valore or 0)).quantize(Decimal("1E-8"), rounding=ROUND_HALF_UP)
+
+
+# ==========================
+# RIEPILOGO MESI / TRIMESTRI / ANNO
+# ==========================
+def riepilogo_periodi(
+    mensili: pd.DataFrame, chiavi: Sequence[str] = ("Anno",)
+) -> pd.DataFrame:
+    """
+    Dai totali mensili (una riga per chiavi + Mese, con Importo,
+    Imponibile e IVA) costruisce per ogni gruppo 12 mesi, 4 trimestri e
+    il totale annuale. Trimestri e anno sono somme dei mesi, non nuovi
+    passaggi sui documenti.
+    """
+    chiavi = list(chiavi)
+    if mensili.empty:
+        return pd.DataFrame(columns=chiavi + ["Periodo"] + VALORI_RIEPILOGO)
+
+    codici, gruppi = pd.factorize(pd.MultiIndex.from_frame(mensili[chiavi]))
+    valori = mensili[VALORI_RIEPILOGO].to_numpy()
+    mesi = mensili["Mese"].to_numpy(dtype=np.int64) - 1
+
+    cubo = np.zeros((len(gruppi), 12, len(VALORI_RIEPILOGO)), dtype=valori.dtype)
+    np.add.at(cubo, (codici, mesi), valori)
+    trimestri = cubo.reshape(len(gruppi), 4, 3, -1).sum(axis=2)
+    anno = trimestri.sum(axis=1, keepdims=True)
+    periodi = np.concatenate([cubo, trimestri, anno], axis=1)
+
+    n_periodi = len(PERIODI_LABEL)
+    out = pd.DataFrame(
+        periodi.reshape(-1, len(VALORI_RIEPILOGO)), columns=VALORI_RIEPILOGO
+    )
+    chiavi_df = pd.DataFrame(list(gruppi), columns=chiavi).loc[
+        np.repeat(np.arange(len(gruppi)), n_periodi)
+    ]
+    for col in reversed(chiavi):
+        out.insert(0, col, chiavi_df[col].to_numpy())
+    out.insert(len(chiavi), "Periodo", np.tile(PERIODI_LABEL, len(gruppi)))
+    return out.sort_values(chiavi, kind="stable", ignore_index=True)
+
+
+# ==========================
+# RIGHE DI FATTURA
+# ==========================
+def tabella_righe(righe: list) -> pd.DataFrame:
+    """
+    Righe nella forma di genera_pdf_fattura (desc, qta, prezzo in euro, iva,
+    natura) -> DataFrame colonnare come in archivio (COLONNE_RIGHE, prezzo
+    in centesimi).
+    """
+    return pd.DataFrame(
+        {
+            "Descrizione": [str(r.get("desc") or "").strip() for r in righe],
+            "Quantita": np.array([float(r.get("qta") or 0) for r in righe], dtype="float64"),
+            "Prezzo": np.array([in_centesimi(r.get("prezzo")) for r in righe], dtype="int64"),
+            "AliquotaIVA": np.array([float(r.get("iva") or 0) for r in righe], dtype="float64"),
+            "Natura": [str(r.get("natura") or "").strip() for r in righe],
+        }
+    )
+
+
+def righe_fattura(righe: pd.DataFrame) -> list:
+    """Inverso di tabella_righe: righe per genera_pdf_fattura e l'XML."""
+    colonne = ["Descrizione", "Quantita", "Prezzo", "AliquotaIVA", "Natura"]
+    return [
+        {"desc": desc, "qta": qta, "prezzo": prezzo / 100, "iva": aliquota, "natura": natura}
+        for desc, qta, prezzo, aliquota, natura in zip(
+            *(righe[c].tolist() for c in colonne)
+        )
+    ]
+
+
+def arrotonda_centesimi(valori: np.ndarray) -> np.ndarray:
+    """Arrotondamento commerciale vettoriale all'intero (0,5 -> 1, -0,5 -> -1)."""
+    # prima si toglie l'errore di rappresentazione binaria (es. 3 x 0,1)
+    valori = np.round(np.asarray(valori, dtype="float64"), 6)
+    return (np.sign(valori) * np.floor(np.abs(valori) + 0.5)).astype("int64")
+
+
+def riepilogo_fattura(righe: list) -> dict:
+    """
+    Conti di una fattura dalle righe (forma di genera_pdf_fattura), in
+    centesimi: "linee" (imponibile di ogni riga), "riepiloghi" [(aliquota,
+    natura, imponibile, imposta)] per aliquota decrescente, "imponibile",
+    "iva" e "totale". Un solo calcolo per editor, PDF e XML: quantità a 8
+    decimali e prezzi in centesimi, come scritti in Quantita e PrezzoUnitario.
+    """
+    # imponibile arrotondato riga per riga, imposta sul totale di ogni
+    # aliquota/natura, come nei DatiRiepilogo FatturaPA; senza DataFrame: una
+    # fattura ha poche righe e un groupby costerebbe più del PDF
+    quantita = np.array(
+        [float(arrotonda_quantita(r.get("qta"))) for r in righe], dtype="float64"
+    )
+    prezzi = np.array([in_centesimi(r.get("prezzo")) for r in righe], dtype="int64")
+    linee = arrotonda_centesimi(quantita * prezzi)
+    codici: dict = {}
+    gruppo = np.array(
+        [
+            codici.setdefault(
+                (float(r.get("iva") or 0), str(r.get("natura") or "").strip()), len(codici)
+            )
+            for r in righe
+        ],
+        dtype="int64",
+    )
+    somme = np.bincount(gruppo, weights=linee, minlength=len(codici)).astype("int64")
+    chiavi = sorted(codici, key=lambda k: (-k[0], k[1]))
+    imponibili = somme[[codici[k] for k in chiavi]] if chiavi else somme
+    imposte = arrotonda_centesimi(imponibili * np.array([k[0] for k in chiavi]) / 100)
+    imponibile = int(imponibili.sum())
+    iva = int(imposte.sum())
+    return {
+        "linee": linee.tolist(),
+        "riepiloghi": [
+            (aliquota, natura, imp, imposta)
+            for (aliquota, natura), imp, imposta in zip(
+                chiavi, imponibili.tolist(), imposte.tolist()
+            )
+        ],
+        "imponibile": imponibile,
+        "iva": iva,
+        "totale": imponibile + iva,
+    }
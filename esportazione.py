@@ -0,0 +1,278 @@
+"""
+Esportazioni in blocco.
+
+- Pacchetto di documenti da consegnare (es. al commercialista): un archivio
+  ZIP con gli XML FatturaPA, i PDF di cortesia e un indice CSV.
+- Registri (fatture emesse o ricevute) in CSV, Excel (XLSX) o Parquet.
+
+Tutto si scrive su file un blocco alla volta, mai per intero in memoria: i
+documenti arrivano a lotti dall'archivio, quindi anche un anno intero
+occupa in memoria un lotto alla volta.
+"""
+import csv
+import io
+import os
+import re
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Iterable
+from xml.sax.saxutils import escape
+
+import pandas as pd
+
+from archivio import COLONNE_IMPORTI
+from fattura_xml import nome_file_xml, progressivo_invio, scrivi_xml_in_zip
+from pdf_fattura import nome_file_pdf
+
+COLONNE_INDICE = [
+    "Numero",
+    "Data",
+    "Cliente",
+    "PIVA/CF",
+    "Causale",
+    "Imponibile",
+    "IVA",
+    "Importo",
+    "Stato",
+    "UUID",
+    "XML",
+    "PDF",
+]
+
+NOME_INDICE = "indice.csv"
+
+
+# ==========================
+# PACCHETTO XML + PDF + INDICE
+# ==========================
+def scrivi_pacchetto(zip_path: str, lotti: Iterable[list]) -> tuple:
+    """
+    Scrive il pacchetto in zip_path (file provvisorio rinominato a fine
+    lavoro). Ogni lotto è una lista di voci {"doc_id", "dati" (argomenti di
+    genera_pdf_fattura), "pdf" (percorso, o "" se manca), "indice" (colonne
+    di COLONNE_INDICE tranne XML e PDF)}. L'errore su un documento non
+    interrompe gli altri: resta nell'indice senza il file.
+    Ritorna (documenti esportati, {doc_id: messaggio di errore}).
+    """
+    n, errori = 0, {}
+    provvisorio = f"{zip_path}.{os.getpid()}.tmp"
+    # indice in memoria finché piccolo, poi su disco
+    with tempfile.SpooledTemporaryFile(1024 * 1024, mode="w+", newline="") as indice:
+        scrittore = csv.DictWriter(indice, COLONNE_INDICE, delimiter=";")
+        scrittore.writeheader()
+        with zipfile.ZipFile(provvisorio, "w", zipfile.ZIP_DEFLATED) as zf:
+            for lotto in lotti:
+                for voce in lotto:
+                    riga = dict(voce["indice"], XML="", PDF="")
+                    doc_id = voce["doc_id"]
+                    try:
+                        progressivo = progressivo_invio(doc_id)
+                        nome = nome_file_xml(voce["dati"]["emittente"], progressivo)
+                        scrivi_xml_in_zip(zf, f"xml/{nome}", progressivo, voce["dati"])
+                        riga["XML"] = f"xml/{nome}"
+                        if voce["pdf"]:
+                            nome = f"pdf/{nome_file_pdf(voce['dati']['numero'])}"
+                            # PDF già compressi: copiati senza ricomprimerli
+                            zf.write(voce["pdf"], nome, compress_type=zipfile.ZIP_STORED)
+                            riga["PDF"] = nome
+                        n += 1
+                    except Exception as exc:
+                        errori[doc_id] = f"{type(exc).__name__}: {exc}"
+                    scrittore.writerow(riga)
+            indice.seek(0)
+            # BOM: Excel apre il CSV come UTF-8
+            with zf.open(NOME_INDICE, "w") as voce, io.TextIOWrapper(
+                voce, encoding="utf-8-sig", newline=""
+            ) as testo:
+                while blocco := indice.read(64 * 1024):
+                    testo.write(blocco)
+    os.replace(provvisorio, zip_path)
+    return n, errori
+
+
+# ==========================
+# REGISTRI (CSV / XLSX / PARQUET)
+# ==========================
+# etichetta -> estensione del file
+FORMATI_REGISTRO = {"CSV": "csv", "Excel (XLSX)": "xlsx", "Parquet": "parquet"}
+
+# Righe per foglio Excel (intestazione compresa)
+MAX_RIGHE_XLSX = 1_048_576
+
+
+def scrivi_registro(percorso: str, blocchi: Iterable[pd.DataFrame], formato: str) -> int:
+    """
+    Registro nel formato "csv", "xlsx" o "parquet", scritto un blocco
+    (DataFrame) alla volta con le colonne del primo; importi in euro. File
+    provvisorio rinominato a fine lavoro. Ritorna le righe scritte.
+    """
+    scrivi = {"csv": _registro_csv, "xlsx": _registro_xlsx, "parquet": _registro_parquet}
+    provvisorio = f"{percorso}.{os.getpid()}.tmp"
+    try:
+        righe = scrivi[formato](provvisorio, (_in_euro(df) for df in blocchi))
+    except BaseException:
+        if os.path.exists(provvisorio):
+            os.remove(provvisorio)
+        raise
+    os.replace(provvisorio, percorso)
+    return righe
+
+
+def _in_euro(df: pd.DataFrame) -> pd.DataFrame:
+    for col in COLONNE_IMPORTI:
+        if col in df.columns:
+            df[col] = df[col] / 100
+    return df
+
+
+def _registro_csv(percorso: str, blocchi: Iterable[pd.DataFrame]) -> int:
+    # separatore ";" e virgola decimale, come lo apre Excel in italiano
+    righe, intestazione = 0, True
+    with open(percorso, "w", encoding="utf-8-sig", newline="") as f:
+        for df in blocchi:
+            df.to_csv(
+                f,
+                sep=";",
+                decimal=",",
+                float_format="%.2f",
+                index=False,
+                header=intestazione,
+                date_format="%d/%m/%Y",
+            )
+            righe += len(df)
+            intestazione = False
+    return righe
+
+
+def _registro_parquet(percorso: str, blocchi: Iterable[pd.DataFrame]) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    righe, scrittore = 0, None
+    try:
+        for df in blocchi:
+            # un row group per blocco, stesso schema del primo
+            tabella = pa.Table.from_pandas(
+                df,
+                schema=scrittore.schema if scrittore else None,
+                preserve_index=False,
+            )
+            if scrittore is None:
+                scrittore = pq.ParquetWriter(percorso, tabella.schema, compression="zstd")
+            scrittore.write_table(tabella)
+            righe += len(df)
+    finally:
+        if scrittore is not None:
+            scrittore.close()
+    if scrittore is None:
+        pq.write_table(pa.table({}), percorso)
+    return righe
+
+
+# --------------------------
+# XLSX scritto in streaming (SpreadsheetML minimo, un foglio)
+# --------------------------
+_NS_FOGLIO = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+_TIPO_OOXML = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+_INTESTAZIONE_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_PARTI_XLSX = {
+    "[Content_Types].xml": (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        f'<Override PartName="/xl/workbook.xml" ContentType="{_TIPO_OOXML}.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        f'ContentType="{_TIPO_OOXML}.worksheet+xml"/>'
+        f'<Override PartName="/xl/styles.xml" ContentType="{_TIPO_OOXML}.styles+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        f'<Relationships xmlns="{_NS_PKG_REL}">'
+        f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    ),
+    "xl/workbook.xml": (
+        f'<workbook xmlns="{_NS_FOGLIO}" xmlns:r="{_NS_REL}"><sheets>'
+        '<sheet name="Registro" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        f'<Relationships xmlns="{_NS_PKG_REL}">'
+        f'<Relationship Id="rId1" Type="{_NS_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+        "</Relationships>"
+    ),
+    # stili: 0 normale, 1 data, 2 importo, 3 intestazione in grassetto
+    "xl/styles.xml": (
+        f'<styleSheet xmlns="{_NS_FOGLIO}">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy"/></numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="4">'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+        "</cellXfs>"
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        "</styleSheet>"
+    ),
+}
+
+_EPOCA_EXCEL = datetime(1899, 12, 30)
+
+# caratteri di controllo non ammessi in XML 1.0
+_NON_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _cella_testo(valore: str, stile: int = 0) -> str:
+    testo = escape(_NON_XML.sub("", valore))
+    return f'<c t="inlineStr" s="{stile}"><is><t xml:space="preserve">{testo}</t></is></c>'
+
+
+def _celle_colonna(serie: pd.Series) -> list:
+    """Celle XML di una colonna, per tipo (una scelta per colonna, non per cella)."""
+    mancanti = serie.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        seriali = ((serie - _EPOCA_EXCEL) / pd.Timedelta(days=1)).to_numpy()
+        celle = [f'<c s="1"><v>{v:g}</v></c>' for v in seriali]
+    elif pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+        stile = 2 if serie.name in COLONNE_IMPORTI else 0
+        valori = serie.astype("float64").tolist()
+        celle = [f'<c s="{stile}"><v>{v!r}</v></c>' for v in valori]
+    else:
+        celle = [_cella_testo(str(v)) for v in serie.astype("object").to_numpy()]
+    return ["" if m else c for c, m in zip(celle, mancanti)]
+
+
+def _registro_xlsx(percorso: str, blocchi: Iterable[pd.DataFrame]) -> int:
+    righe = 0
+    with zipfile.ZipFile(percorso, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome, contenuto in _PARTI_XLSX.items():
+            zf.writestr(nome, _INTESTAZIONE_XML + contenuto)
+        with zf.open("xl/worksheets/sheet1.xml", "w") as voce, io.TextIOWrapper(
+            io.BufferedWriter(voce, 256 * 1024), encoding="utf-8"
+        ) as foglio:
+            foglio.write(_INTESTAZIONE_XML + f'<worksheet xmlns="{_NS_FOGLIO}"><sheetData>')
+            for df in blocchi:
+                if righe == 0:
+                    celle = "".join(_cella_testo(str(c), 3) for c in df.columns)
+                    foglio.write(f"<row>{celle}</row>")
+                if righe + len(df) + 1 > MAX_RIGHE_XLSX:
+                    raise ValueError(
+                        f"oltre {MAX_RIGHE_XLSX - 1} righe: troppe per un foglio Excel, "
+                        "usare CSV o Parquet"
+                    )
+                colonne = [_celle_colonna(df[c]) for c in df.columns]
+                foglio.writelines(f"<row>{''.join(r)}</row>" for r in zip(*colonne))
+                righe += len(df)
+            foglio.write("</sheetData></worksheet>")
+    return righe
@@ -0,0 +1,359 @@
+"""
+XML FatturaPA (tracciato 1.2) delle fatture emesse: singolo documento e
+generazione in blocco verso una cartella o un archivio ZIP.
+
+Il documento viene scritto in sequenza su un flusso (XMLGenerator), senza
+costruire l'albero in memoria. I dati sono gli stessi di genera_pdf_fattura
+(documento, emittente, cliente, righe).
+"""
+import io
+import os
+import zipfile
+from decimal import Decimal
+from typing import BinaryIO, Callable, Optional
+from xml.sax.saxutils import XMLGenerator
+
+from calcoli import arrotonda_quantita, in_centesimi, riepilogo_fattura
+
+NS_FATTURA = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
+
+# Codice destinatario a 6 caratteri = ufficio della Pubblica Amministrazione
+CODICE_DESTINATARIO_PEC = "0000000"
+
+# Lunghezza massima di un elemento Causale (ripetibile)
+LUNGHEZZA_CAUSALE = 200
+
+# Campi obbligatori della Sede di cedente e cessionario
+CAMPI_SEDE = ("Indirizzo", "CAP", "Comune")
+
+
+# ==========================
+# SUPPORTO
+# ==========================
+def _importo(cent: int) -> str:
+    """Centesimi -> "1234.50" (formato decimale FatturaPA)."""
+    segno = "-" if cent < 0 else ""
+    return f"{segno}{abs(cent) // 100}.{abs(cent) % 100:02d}"
+
+
+def _decimale(valore) -> str:
+    return f"{Decimal(str(valore or 0)):.2f}"
+
+
+def _quantita(valore) -> str:
+    """
+    Quantità da 2 a 8 decimali, la precisione con cui riepilogo_fattura
+    calcola PrezzoTotale (con 2 soli decimali Quantita per PrezzoUnitario non
+    tornerebbe con PrezzoTotale e lo SdI scarta).
+    """
+    intero, _, decimali = f"{arrotonda_quantita(valore):f}".partition(".")
+    return f"{intero}.{decimali.rstrip('0').ljust(2, '0')}"
+
+
+def _piva(valore: str) -> str:
+    valore = (valore or "").strip().upper()
+    return valore[2:] if valore.startswith("IT") else valore
+
+
+def progressivo_invio(doc_id: int) -> str:
+    """Progressivo di invio (max 5 caratteri alfanumerici) dall'id documento."""
+    cifre = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    n, testo = int(doc_id), ""
+    while n:
+        n, resto = divmod(n, 36)
+        testo = cifre[resto] + testo
+    return testo.rjust(5, "0")
+
+
+def nome_file_xml(emittente: dict, progressivo: str) -> str:
+    """Nome file SdI: IT<P.IVA trasmittente>_<progressivo>.xml."""
+    return f"IT{_piva(emittente['PIVA'])}_{progressivo}.xml"
+
+
+def _linee(righe: list, causale: str) -> list:
+    """
+    Righe normalizzate (quantità, prezzo, aliquota, natura). Controllo fatto
+    prima di scrivere: un documento non valido non lascia file a metà.
+    """
+    linee = []
+    for n, r in enumerate(righe, start=1):
+        qta = Decimal(str(r.get("qta", 0) or 0))
+        prezzo = Decimal(str(r.get("prezzo", 0) or 0))
+        aliquota = Decimal(str(r.get("iva", 0) or 0))
+        natura = (r.get("natura") or "").strip()
+        if aliquota == 0 and not natura:
+            raise ValueError(f"riga {n}: aliquota IVA 0 senza codice Natura")
+        linee.append(
+            {
+                "desc": (r.get("desc") or "").strip() or causale,
+                "qta": qta,
+                "prezzo": prezzo,
+                "aliquota": aliquota,
+                "natura": natura,
+            }
+        )
+    if not linee:
+        raise ValueError("fattura senza righe")
+    return linee
+
+
+def _controlla_soggetti(emittente: dict, cliente: dict) -> None:
+    """
+    Dati anagrafici obbligatori di cedente e cessionario, controllati come le
+    righe prima di scrivere: niente valori inventati al posto di quelli mancanti.
+    """
+    if not str(emittente.get("PIVA") or "").strip():
+        raise ValueError("emittente senza Partita IVA")
+    if not any(str(cliente.get(c) or "").strip() for c in ("PIVA", "CF")):
+        raise ValueError("cliente senza Partita IVA né Codice Fiscale")
+    for ruolo, soggetto in (("emittente", emittente), ("cliente", cliente)):
+        mancanti = [c for c in CAMPI_SEDE if not str(soggetto.get(c) or "").strip()]
+        if mancanti:
+            raise ValueError(f"{ruolo}: sede senza {', '.join(mancanti)}")
+
+
+class _Scrittore:
+    """XMLGenerator con scorciatoie per blocchi ed elementi foglia."""
+
+    def __init__(self, out: BinaryIO):
+        self.gen = XMLGenerator(out, encoding="UTF-8", short_empty_elements=True)
+
+    def apri(self, nome: str, attributi: Optional[dict] = None) -> None:
+        self.gen.startElement(nome, attributi or {})
+
+    def chiudi(self, nome: str) -> None:
+        self.gen.endElement(nome)
+
+    def campo(self, nome: str, valore) -> None:
+        """Elemento foglia; i valori vuoti non vengono scritti (campi facoltativi)."""
+        if valore is None or valore == "":
+            return
+        self.gen.startElement(nome, {})
+        self.gen.characters(str(valore))
+        self.gen.endElement(nome)
+
+    def sede(self, soggetto: dict) -> None:
+        self.apri("Sede")
+        for campo in CAMPI_SEDE:
+            self.campo(campo, str(soggetto[campo]).strip())
+        self.campo("Provincia", (soggetto.get("Provincia") or "").upper()[:2])
+        self.campo("Nazione", soggetto.get("Nazione") or "IT")
+        self.chiudi("Sede")
+
+    def id_fiscale(self, piva: str) -> None:
+        self.apri("IdFiscaleIVA")
+        self.campo("IdPaese", "IT")
+        self.campo("IdCodice", _piva(piva))
+        self.chiudi("IdFiscaleIVA")
+
+
+# ==========================
+# SINGOLO DOCUMENTO
+# ==========================
+def scrivi_xml_fattura(
+    out: BinaryIO,
+    progressivo: str,
+    numero: str,
+    data_f,
+    emittente: dict,
+    cliente: dict,
+    righe: list,
+    totale: float,
+    tipo_xml_codice: str = "TD01",
+    note: str = "",
+    **_,
+) -> None:
+    """
+    Scrive su out (flusso binario) il file FatturaPA del documento. Accetta
+    gli stessi argomenti di genera_pdf_fattura (quelli non usati nell'XML,
+    come modalita_pagamento, sono ignorati).
+    """
+    causale = (note or "").strip()
+    linee = _linee(righe, causale or "SERVIZIO")
+    _controlla_soggetti(emittente, cliente)
+    # importi di riga e riepiloghi IVA dallo stesso calcolo di editor e PDF
+    conti = riepilogo_fattura(righe)
+
+    codice_dest = (cliente.get("CodiceDestinatario") or CODICE_DESTINATARIO_PEC).upper()
+    formato = "FPA12" if len(codice_dest) == 6 else "FPR12"
+
+    x = _Scrittore(out)
+    x.gen.startDocument()
+    x.apri(
+        "p:FatturaElettronica",
+        {
+            "versione": formato,
+            "xmlns:p": NS_FATTURA,
+            "xmlns:ds": "http://www.w3.org/2000/09/xmldsig#",
+            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+        },
+    )
+
+    # -------------------------
+    # INTESTAZIONE
+    # -------------------------
+    x.apri("FatturaElettronicaHeader")
+
+    x.apri("DatiTrasmissione")
+    x.apri("IdTrasmittente")
+    x.campo("IdPaese", "IT")
+    x.campo("IdCodice", _piva(emittente.get("IdTrasmittente") or emittente["PIVA"]))
+    x.chiudi("IdTrasmittente")
+    x.campo("ProgressivoInvio", progressivo)
+    x.campo("FormatoTrasmissione", formato)
+    x.campo("CodiceDestinatario", codice_dest)
+    if codice_dest == CODICE_DESTINATARIO_PEC:
+        x.campo("PECDestinatario", cliente.get("PEC", ""))
+    x.chiudi("DatiTrasmissione")
+
+    x.apri("CedentePrestatore")
+    x.apri("DatiAnagrafici")
+    x.id_fiscale(emittente["PIVA"])
+    x.campo("CodiceFiscale", emittente.get("CF", ""))
+    x.apri("Anagrafica")
+    x.campo("Denominazione", emittente["Denominazione"])
+    x.chiudi("Anagrafica")
+    x.campo("RegimeFiscale", emittente.get("RegimeFiscale") or "RF01")
+    x.chiudi("DatiAnagrafici")
+    x.sede(emittente)
+    x.chiudi("CedentePrestatore")
+
+    x.apri("CessionarioCommittente")
+    x.apri("DatiAnagrafici")
+    if cliente.get("PIVA"):
+        x.id_fiscale(cliente["PIVA"])
+    x.campo("CodiceFiscale", (cliente.get("CF") or "").upper())
+    x.apri("Anagrafica")
+    x.campo("Denominazione", cliente.get("Denominazione", ""))
+    x.chiudi("Anagrafica")
+    x.chiudi("DatiAnagrafici")
+    x.sede(cliente)
+    x.chiudi("CessionarioCommittente")
+
+    x.chiudi("FatturaElettronicaHeader")
+
+    # -------------------------
+    # CORPO
+    # -------------------------
+    x.apri("FatturaElettronicaBody")
+
+    x.apri("DatiGenerali")
+    x.apri("DatiGeneraliDocumento")
+    x.campo("TipoDocumento", tipo_xml_codice)
+    x.campo("Divisa", "EUR")
+    x.campo("Data", data_f.isoformat()[:10])
+    x.campo("Numero", numero)
+    x.campo("ImportoTotaleDocumento", _importo(in_centesimi(totale)))
+    for i in range(0, len(causale), LUNGHEZZA_CAUSALE):
+        x.campo("Causale", causale[i : i + LUNGHEZZA_CAUSALE])
+    x.chiudi("DatiGeneraliDocumento")
+    x.chiudi("DatiGenerali")
+
+    x.apri("DatiBeniServizi")
+    for n, (linea, totale_linea) in enumerate(zip(linee, conti["linee"]), start=1):
+        x.apri("DettaglioLinee")
+        x.campo("NumeroLinea", n)
+        x.campo("Descrizione", linea["desc"][:1000])
+        # prezzo in centesimi, come nel calcolo di PrezzoTotale
+        x.campo("Quantita", _quantita(linea["qta"]))
+        x.campo("PrezzoUnitario", _importo(in_centesimi(linea["prezzo"])))
+        x.campo("PrezzoTotale", _importo(totale_linea))
+        x.campo("AliquotaIVA", _decimale(linea["aliquota"]))
+        x.campo("Natura", linea["natura"])
+        x.chiudi("DettaglioLinee")
+    for aliquota, natura, imponibile, imposta in conti["riepiloghi"]:
+        x.apri("DatiRiepilogo")
+        x.campo("AliquotaIVA", _decimale(aliquota))
+        x.campo("Natura", natura)
+        x.campo("ImponibileImporto", _importo(imponibile))
+        x.campo("Imposta", _importo(imposta))
+        if not natura:
+            x.campo("EsigibilitaIVA", "I")
+        x.chiudi("DatiRiepilogo")
+    x.chiudi("DatiBeniServizi")
+
+    x.chiudi("FatturaElettronicaBody")
+    x.chiudi("p:FatturaElettronica")
+    x.gen.endDocument()
+
+
+def xml_fattura(progressivo: str, dati: dict) -> bytes:
+    """XML di un singolo documento come bytes (dati: argomenti di genera_pdf_fattura)."""
+    buffer = io.BytesIO()
+    scrivi_xml_fattura(buffer, progressivo, **dati)
+    return buffer.getvalue()
+
+
+def scrivi_xml_in_zip(
+    zf: zipfile.ZipFile, nome: str, progressivo: str, dati: dict
+) -> None:
+    """
+    XML di un documento scritto direttamente nella voce nome dello ZIP. Le
+    righe e le anagrafiche si controllano prima di aprire la voce: un
+    documento non valido non lascia voci a metà nell'archivio.
+    """
+    _linee(dati["righe"], "")
+    _controlla_soggetti(dati["emittente"], dati["cliente"])
+    # buffer davanti alla voce: XMLGenerator fa molte scritture piccole,
+    # ognuna sarebbe una chiamata al compressore
+    with zf.open(nome, "w") as voce, io.BufferedWriter(voce) as buf:
+        scrivi_xml_fattura(buf, progressivo, **dati)
+
+
+# ==========================
+# GENERAZIONE IN BLOCCO
+# ==========================
+def genera_xml_in_blocco(
+    lavori: dict,
+    destinazione: str,
+    in_zip: bool = False,
+    avanzamento: Optional[Callable[[int, int], None]] = None,
+) -> tuple:
+    """
+    XML di più documenti, ciascuno scritto direttamente sul file di destinazione
+    (o sulla voce dell'archivio ZIP) man mano che viene prodotto.
+
+    lavori: {id documento: argomenti di genera_pdf_fattura}; l'id dà il
+    progressivo di invio e quindi il nome file. destinazione è una cartella
+    oppure, con in_zip, il percorso dell'archivio (scritto in un file
+    provvisorio e rinominato a fine lavoro). L'errore su un documento non
+    interrompe gli altri.
+    Ritorna ({id: nome file}, {id: messaggio di errore}).
+    """
+    scritti, errori = {}, {}
+    totale = len(lavori)
+
+    def esegui(scrivi: Callable[[str, dict], None]) -> None:
+        for doc_id, dati in lavori.items():
+            nome = nome_file_xml(dati["emittente"], progressivo_invio(doc_id))
+            try:
+                scrivi(nome, dati, progressivo_invio(doc_id))
+                scritti[doc_id] = nome
+            except Exception as exc:
+                errori[doc_id] = f"{type(exc).__name__}: {exc}"
+            if avanzamento is not None:
+                avanzamento(len(scritti) + len(errori), totale)
+
+    if in_zip:
+        provvisorio = f"{destinazione}.{os.getpid()}.tmp"
+        with zipfile.ZipFile(provvisorio, "w", zipfile.ZIP_DEFLATED) as zf:
+            esegui(
+                lambda nome, dati, progressivo: scrivi_xml_in_zip(
+                    zf, nome, progressivo, dati
+                )
+            )
+        os.replace(provvisorio, destinazione)
+    else:
+        os.makedirs(destinazione, exist_ok=True)
+
+        def su_file(nome: str, dati: dict, progressivo: str) -> None:
+            # prima di aprire il file
+            _linee(dati["righe"], "")
+            _controlla_soggetti(dati["emittente"], dati["cliente"])
+            percorso = os.path.join(destinazione, nome)
+            with open(f"{percorso}.tmp", "wb") as f:
+                scrivi_xml_fattura(f, progressivo, **dati)
+            os.replace(f"{percorso}.tmp", percorso)
+
+        esegui(su_file)
+    return scritti, errori
@@ -0,0 +1,451 @@
+"""
+Invio delle fatture allo SdI tramite intermediario, in background.
+
+Una CodaInvii tiene un event loop asyncio in un thread dedicato: la pagina
+Streamlit accoda gli id dei documenti e torna subito, i lavoratori del loop
+preparano l'XML, lo inviano con tentativi ripetuti (attesa esponenziale)
+entro un limite di richieste al secondo e registrano l'esito sul documento.
+Sullo stesso loop (e con lo stesso trasporto) un lettore di notifiche SdI
+scarica a lotti le notifiche successive a un cursore salvato e aggiorna lo
+stato dei soli documenti interessati.
+
+Il trasporto è intercambiabile: TrasportoOpenapi parla con l'API HTTP,
+sdi_simulato fa da intermediario locale per provare tutto senza rete.
+"""
+import asyncio
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Callable
+from urllib.parse import urlencode, urlsplit
+
+# Notifica SdI -> stato del documento (NE: esito del committente PA)
+STATI_NOTIFICA = {
+    "RC": "Consegnato",
+    "MC": "Mancata consegna",
+    "AT": "Mancata consegna",
+    "NS": "Scartato",
+    "DT": "Decorrenza termini",
+    ("NE", "EC01"): "Accettato",
+    ("NE", "EC02"): "Rifiutato",
+}
+
+CURSORE_NOTIFICHE = "notifiche_sdi"
+
+
+def stato_notifica(tipo: str, esito: str = "") -> str:
+    """Stato del documento per una notifica SdI; "" se la notifica non lo cambia."""
+    return STATI_NOTIFICA.get((tipo, esito)) or STATI_NOTIFICA.get(tipo, "")
+
+
+class ErroreInvio(Exception):
+    """Invio rifiutato dall'intermediario: ripetere non serve."""
+
+
+class ErroreIncerto(ErroreInvio):
+    """
+    Richiesta inviata per intero senza risposta (timeout, connessione caduta):
+    l'intermediario può averla accettata. L'invio non è idempotente, quindi
+    non si ripete: prima di reinviare va controllato l'esito.
+    """
+
+
+class ErroreTemporaneo(Exception):
+    """
+    Errore transitorio (rete prima dell'invio della richiesta, 429, 5xx):
+    l'invio si ripete più tardi.
+    """
+
+    def __init__(self, messaggio: str, attesa: float = 0.0):
+        super().__init__(messaggio)
+        self.attesa = attesa
+
+
+# ==========================
+# TRASPORTI
+# ==========================
+class Trasporto:
+    """
+    Interfaccia verso l'intermediario: invia ritorna l'UUID assegnato,
+    notifiche le notifiche successive al cursore, come
+    ([(UUID, tipo, esito)], nuovo cursore).
+    """
+
+    async def invia(self, nome_file: str, xml: bytes) -> str:
+        raise NotImplementedError
+
+    async def notifiche(self, cursore: str, lotto: int) -> tuple:
+        raise NotImplementedError
+
+    async def chiudi(self) -> None:
+        pass
+
+
+class _SenzaRisposta(Exception):
+    """Errore di rete dopo che la richiesta è stata scritta per intero."""
+
+
+def _secondi_retry_after(valore: str) -> float:
+    """
+    Attesa indicata da Retry-After: secondi oppure data HTTP. Un valore non
+    interpretabile (o una data già passata) vale 0.
+    """
+    valore = (valore or "").strip()
+    try:
+        secondi = float(valore)
+    except ValueError:
+        try:
+            secondi = parsedate_to_datetime(valore).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0.0
+    return secondi if math.isfinite(secondi) and secondi > 0 else 0.0
+
+
+class _PoolConnessioni:
+    """
+    Connessioni HTTPS persistenti (keep-alive) verso un host, riusate tra
+    le richieste: al più dimensione restano aperte in attesa di riuso.
+    """
+
+    def __init__(self, url: str, dimensione: int, timeout: float):
+        parti = urlsplit(url)
+        classe = (
+            http.client.HTTPSConnection
+            if parti.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._nuova = lambda: classe(parti.hostname, parti.port, timeout=timeout)
+        self.percorso = parti.path.rstrip("/")
+        self.dimensione = dimensione
+        self._libere = []
+        self._lock = threading.Lock()
+
+    def richiesta(
+        self, metodo: str, percorso: str, corpo, intestazioni: dict
+    ) -> tuple:
+        """
+        (stato HTTP, intestazioni, corpo) della risposta, letta per intero.
+        Gli errori di rete prima che la richiesta sia scritta per intero
+        (connessione, DNS, invio) passano così come sono: il server non l'ha
+        ricevuta. Quelli successivi diventano _SenzaRisposta.
+        """
+        with self._lock:
+            conn = self._libere.pop() if self._libere else self._nuova()
+        try:
+            conn.request(metodo, self.percorso + percorso, body=corpo, headers=intestazioni)
+        except BaseException:
+            conn.close()  # stato del socket incerto: non si riusa
+            raise
+        try:
+            risposta = conn.getresponse()
+            dati = risposta.read()
+        except (OSError, http.client.HTTPException) as exc:
+            conn.close()
+            raise _SenzaRisposta(f"{type(exc).__name__}: {exc}") from exc
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if risposta.will_close or len(self._libere) >= self.dimensione:
+                conn.close()
+            else:
+                self._libere.append(conn)
+        return risposta.status, risposta.headers, dati
+
+    def chiudi(self) -> None:
+        with self._lock:
+            libere, self._libere = self._libere, []
+        for conn in libere:
+            conn.close()
+
+
+class TrasportoOpenapi(Trasporto):
+    """
+    API SDI di Openapi: POST /invoices con l'XML FatturaPA, GET /notifications
+    con il cursore. Le letture sono condizionali (If-None-Match): se non c'è
+    nulla di nuovo la risposta è un 304 senza corpo.
+    """
+
+    URL = "https://sdi.openapi.it"
+    URL_PROVA = "https://test.sdi.openapi.it"
+
+    def __init__(
+        self, token: str, url: str = URL, timeout: float = 30.0, connessioni: int = 4
+    ):
+        self.token = token
+        self._pool = _PoolConnessioni(url, connessioni, timeout)
+        self._etag = {}
+
+    async def invia(self, nome_file: str, xml: bytes) -> str:
+        return await asyncio.to_thread(self._invia, nome_file, xml)
+
+    async def chiudi(self) -> None:
+        self._pool.chiudi()
+
+    async def notifiche(self, cursore: str, lotto: int) -> tuple:
+        return await asyncio.to_thread(self._notifiche, cursore, lotto)
+
+    def _richiesta(self, metodo: str, percorso: str, corpo=None, **intestazioni) -> tuple:
+        intestazioni.update(
+            {"Authorization": f"Bearer {self.token}", "Accept": "application/json"}
+        )
+        try:
+            stato, risposta, dati = self._pool.richiesta(metodo, percorso, corpo, intestazioni)
+        except (OSError, http.client.HTTPException) as exc:
+            raise ErroreTemporaneo(f"{type(exc).__name__}: {exc}") from exc
+        except _SenzaRisposta as exc:
+            # letture ripetibili; un POST potrebbe essere già stato accettato
+            if metodo == "GET":
+                raise ErroreTemporaneo(str(exc)) from exc
+            raise ErroreIncerto(
+                f"nessuna risposta dopo l'invio ({exc}): verificare l'esito "
+                "presso l'intermediario prima di reinviare"
+            ) from exc
+        if stato >= 400:
+            messaggio = f"HTTP {stato}: {dati[:500].decode('utf-8', 'replace')}"
+            # 429 e 503: richiesta non elaborata; gli altri 5xx di un POST
+            # (es. 502, 504 di un gateway) non escludono che sia stata accettata
+            if metodo != "GET" and stato >= 500 and stato != 503:
+                raise ErroreIncerto(
+                    f"{messaggio}: verificare l'esito presso l'intermediario "
+                    "prima di reinviare"
+                )
+            if stato == 429 or stato >= 500:
+                raise ErroreTemporaneo(
+                    messaggio, _secondi_retry_after(risposta.get("Retry-After"))
+                )
+            raise ErroreInvio(messaggio)
+        return stato, risposta, dati
+
+    def _invia(self, nome_file: str, xml: bytes) -> str:
+        _, _, corpo = self._richiesta(
+            "POST", "/invoices", xml, **{"Content-Type": "application/xml"}
+        )
+        try:
+            return json.loads(corpo)["data"]["uuid"]
+        except (ValueError, KeyError, TypeError):
+            raise ErroreInvio(f"risposta senza uuid: {corpo[:200]!r}") from None
+
+    def _notifiche(self, cursore: str, lotto: int) -> tuple:
+        percorso = "/notifications?" + urlencode({"since": cursore, "limit": lotto})
+        condizione = {}
+        if percorso in self._etag:
+            condizione["If-None-Match"] = self._etag[percorso]
+        stato, risposta, corpo = self._richiesta("GET", percorso, **condizione)
+        if stato == 304:
+            return [], cursore
+        if risposta.get("ETag"):
+            self._etag = {percorso: risposta["ETag"]}  # serve solo per l'ultimo cursore
+        try:
+            dati = json.loads(corpo)
+            notifiche = [
+                (n["uuid"], n["type"], n.get("outcome") or "") for n in dati["data"]
+            ]
+            return notifiche, str(dati.get("cursor") or cursore)
+        except (ValueError, KeyError, TypeError):
+            raise ErroreTemporaneo(f"risposta non valida: {corpo[:200]!r}") from None
+
+
+# ==========================
+# LIMITE DI RICHIESTE
+# ==========================
+class _Limite:
+    """Secchiello di gettoni: al più al_secondo richieste al secondo, a regime."""
+
+    def __init__(self, al_secondo: float):
+        self.intervallo = 1.0 / al_secondo
+        self._prossimo = 0.0
+        self._lock = asyncio.Lock()
+
+    async def attendi(self) -> None:
+        async with self._lock:
+            adesso = time.monotonic()
+            attesa = self._prossimo - adesso
+            self._prossimo = max(adesso, self._prossimo) + self.intervallo
+        if attesa > 0:
+            await asyncio.sleep(attesa)
+
+
+# ==========================
+# CODA DI INVIO
+# ==========================
+class CodaInvii:
+    """
+    Coda di invio in background. prepara(doc_id) -> (nome file, XML) e
+    esito(doc_id, uuid, errore) girano in un thread a parte (leggono e
+    scrivono l'archivio); uuid è "" se l'invio è fallito. Con
+    avvia_notifiche lo stesso loop legge anche le notifiche SdI.
+    """
+
+    def __init__(
+        self,
+        trasporto: Trasporto,
+        prepara: Callable[[int], tuple],
+        esito: Callable[[int, str, str], None],
+        concorrenza: int = 4,
+        al_secondo: float = 5.0,
+        tentativi: int = 5,
+        attesa_base: float = 1.0,
+    ):
+        self.trasporto = trasporto
+        self._prepara = prepara
+        self._esito = esito
+        self.tentativi = tentativi
+        self.attesa_base = attesa_base
+        self._lock = threading.Lock()
+        self._attesa = set()
+        self._inviati = 0
+        self._errori = {}
+        self._esiti = {}
+        self._notificati = 0
+        self._errore_notifiche = ""
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever, name="coda-invii-sdi", daemon=True
+        ).start()
+        asyncio.run_coroutine_threadsafe(
+            self._avvia(concorrenza, al_secondo), self._loop
+        ).result()
+
+    async def _avvia(self, concorrenza: int, al_secondo: float) -> None:
+        # un thread per lavoratore (preparazione, HTTP bloccante, esito) più
+        # uno per la lettura delle notifiche
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(concorrenza + 1, thread_name_prefix="invio-sdi")
+        )
+        self._coda = asyncio.Queue()
+        self._limite = _Limite(al_secondo)
+        self._lavoratori = [
+            asyncio.create_task(self._lavora()) for _ in range(concorrenza)
+        ]
+
+    def avvia_notifiche(
+        self,
+        leggi_cursore: Callable[[], str],
+        applica: Callable[[list, str], int],
+        intervallo: float = 60.0,
+        lotto: int = 200,
+    ) -> None:
+        """
+        Lettura periodica delle notifiche SdI. applica([(UUID, stato)], nuovo
+        cursore) registra gli stati e il cursore insieme; un lotto pieno fa
+        leggere subito il successivo, altrimenti si attende intervallo.
+        """
+
+        async def avvia():
+            lettore = self._leggi_notifiche(leggi_cursore, applica, intervallo, lotto)
+            self._lavoratori.append(asyncio.create_task(lettore))
+
+        asyncio.run_coroutine_threadsafe(avvia(), self._loop).result()
+
+    def accoda(self, doc_ids) -> int:
+        """Accoda i documenti non già in attesa; ritorna quanti sono stati accodati."""
+        with self._lock:
+            nuovi = [int(d) for d in doc_ids if int(d) not in self._attesa]
+            self._attesa.update(nuovi)
+            for doc_id in nuovi:
+                self._errori.pop(doc_id, None)
+                self._esiti[doc_id] = "in coda"
+        for doc_id in nuovi:
+            self._loop.call_soon_threadsafe(self._coda.put_nowait, doc_id)
+        return len(nuovi)
+
+    def stato(self) -> dict:
+        """
+        Istantanea: documenti in attesa, inviati finora, {doc_id: errore},
+        documenti aggiornati dalle notifiche e ultimo errore di lettura.
+        """
+        with self._lock:
+            return {
+                "in_attesa": set(self._attesa),
+                "inviati": self._inviati,
+                "errori": dict(self._errori),
+                "notificati": self._notificati,
+                "errore_notifiche": self._errore_notifiche,
+            }
+
+    def esiti(self, doc_ids) -> dict:
+        """{doc_id: "in coda" / "inviato, UUID ..." / "errore: ..."} dei documenti accodati."""
+        with self._lock:
+            return {int(d): self._esiti[int(d)] for d in doc_ids if int(d) in self._esiti}
+
+    def chiudi(self) -> None:
+        async def ferma():
+            for lavoratore in self._lavoratori:
+                lavoratore.cancel()
+            await self.trasporto.chiudi()
+
+        asyncio.run_coroutine_threadsafe(ferma(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _lavora(self) -> None:
+        while True:
+            doc_id = await self._coda.get()
+            identificativo, errore = "", ""
+            try:
+                nome_file, xml = await asyncio.to_thread(self._prepara, doc_id)
+                identificativo = await self._invia(nome_file, xml)
+            except (ErroreInvio, ValueError) as exc:
+                errore = str(exc)
+            except Exception as exc:  # un documento non deve fermare il lavoratore
+                errore = f"{type(exc).__name__}: {exc}"
+            try:
+                await asyncio.to_thread(self._esito, doc_id, identificativo, errore)
+            except Exception as exc:
+                errore = errore or f"esito non registrato: {exc}"
+            with self._lock:
+                self._attesa.discard(doc_id)
+                if errore:
+                    self._errori[doc_id] = errore
+                    self._esiti[doc_id] = f"errore: {errore}"
+                else:
+                    self._inviati += 1
+                    self._esiti[doc_id] = f"inviato, UUID {identificativo}"
+
+    async def _leggi_notifiche(
+        self, leggi_cursore, applica, intervallo: float, lotto: int
+    ) -> None:
+        cursore = await asyncio.to_thread(leggi_cursore)
+        errori = 0
+        while True:
+            try:
+                notifiche, nuovo = await self.trasporto.notifiche(cursore, lotto)
+                stati = [
+                    (uuid, stato)
+                    for uuid, tipo, esito in notifiche
+                    if (stato := stato_notifica(tipo, esito))
+                ]
+                if nuovo != cursore:
+                    aggiornati = await asyncio.to_thread(applica, stati, nuovo)
+                    cursore = nuovo
+                    with self._lock:
+                        self._notificati += aggiornati
+                errori = 0
+            except Exception as exc:  # si riprova al giro successivo, con attesa crescente
+                errori += 1
+                with self._lock:
+                    self._errore_notifiche = f"{type(exc).__name__}: {exc}"
+                await asyncio.sleep(min(intervallo, self.attesa_base * 2**errori))
+                continue
+            with self._lock:
+                self._errore_notifiche = ""
+            if len(notifiche) < lotto:
+                await asyncio.sleep(intervallo)
+
+    async def _invia(self, nome_file: str, xml: bytes) -> str:
+        for tentativo in range(self.tentativi):
+            await self._limite.attendi()
+            try:
+                return await self.trasporto.invia(nome_file, xml)
+            except ErroreTemporaneo as exc:
+                if tentativo == self.tentativi - 1:
+                    raise ErroreInvio(f"{exc} (dopo {self.tentativi} tentativi)") from exc
+                # attesa esponenziale con variazione casuale, o quella indicata
+                ritardo = self.attesa_base * 2**tentativo * random.uniform(0.5, 1.0)
+                await asyncio.sleep(max(ritardo, exc.attesa))
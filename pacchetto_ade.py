@@ -0,0 +1,389 @@
+"""
+Importazione dei pacchetti ZIP di fatture ricevute scaricati dal cassetto
+fiscale (AdE): file XML FatturaPA, firmati .p7m o in chiaro, più i file di
+metadati con l'identificativo SdI.
+
+I membri dello ZIP si leggono in streaming (nessuna estrazione su disco) e
+l'XML si analizza con iterparse, liberando gli elementi già letti. L'analisi
+è distribuita su un pool di processi: ognuno apre lo ZIP una volta e riceve
+solo blocchi di nomi, quindi la memoria dipende dal numero di processi e non
+dalla dimensione del pacchetto.
+
+I file già importati si riconoscono prima di leggerli: dall'indice centrale
+dello ZIP (nome, CRC-32 e dimensione) e dall'identificativo SdI dei metadati.
+Ricaricare un pacchetto cumulativo costa quindi solo i documenti nuovi.
+"""
+import base64
+import io
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import ExitStack
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Optional
+from xml.etree.ElementTree import iterparse
+
+from calcoli import in_centesimi
+from parallelo import pool_processi, processi_disponibili
+
+# Membri per blocco inviato a un processo: abbastanza da ammortizzare la
+# comunicazione, abbastanza pochi da tenere piccolo ogni risultato
+MEMBRI_PER_BLOCCO = 250
+
+# Blocchi in lavorazione per processo (il resto attende nella coda del main)
+BLOCCHI_IN_VOLO = 2
+
+# Radici XML dei file di metadati SdI
+_RADICI_METADATI = {"FileMetadati", "MetadatiInvioFile"}
+
+# Percorso (senza radice) -> campo del registro, per intestazione e corpo
+_CAMPI_INTESTAZIONE = {
+    ("CedentePrestatore", "DatiAnagrafici", "IdFiscaleIVA", "IdCodice"): "PIVA",
+    ("CedentePrestatore", "DatiAnagrafici", "CodiceFiscale"): "CF",
+    ("CedentePrestatore", "DatiAnagrafici", "Anagrafica", "Denominazione"): "Fornitore",
+    ("CedentePrestatore", "DatiAnagrafici", "Anagrafica", "Nome"): "Nome",
+    ("CedentePrestatore", "DatiAnagrafici", "Anagrafica", "Cognome"): "Cognome",
+}
+_CAMPI_CORPO = {
+    ("DatiGenerali", "DatiGeneraliDocumento", "TipoDocumento"): "TipoXML",
+    ("DatiGenerali", "DatiGeneraliDocumento", "Data"): "Data",
+    ("DatiGenerali", "DatiGeneraliDocumento", "Numero"): "Numero",
+    ("DatiGenerali", "DatiGeneraliDocumento", "ImportoTotaleDocumento"): "Importo",
+    ("DatiGenerali", "DatiGeneraliDocumento", "Causale"): "Causale",
+    ("DatiBeniServizi", "DatiRiepilogo", "ImponibileImporto"): "Imponibile",
+    ("DatiBeniServizi", "DatiRiepilogo", "Imposta"): "IVA",
+}
+_IMPORTI = {"Imponibile", "IVA", "Importo"}
+
+
+# ==========================
+# BUSTA FIRMATA .P7M (CAdES)
+# ==========================
+def _intestazione(dati: bytes, pos: int) -> tuple:
+    """TLV BER in pos: (costruito, inizio contenuto, lunghezza o None se indefinita)."""
+    primo = dati[pos]
+    pos += 1
+    if primo & 0x1F == 0x1F:  # tag su più byte
+        while dati[pos] & 0x80:
+            pos += 1
+        pos += 1
+    lunghezza = dati[pos]
+    pos += 1
+    if lunghezza == 0x80:
+        return bool(primo & 0x20), pos, None
+    if lunghezza & 0x80:
+        n = lunghezza & 0x7F
+        lunghezza = int.from_bytes(dati[pos : pos + n], "big")
+        pos += n
+    return bool(primo & 0x20), pos, lunghezza
+
+
+def _fine(dati: bytes, pos: int) -> int:
+    _, inizio, lunghezza = _intestazione(dati, pos)
+    if lunghezza is not None:
+        return inizio + lunghezza
+    p = inizio
+    while dati[p : p + 2] != b"\0\0":  # fine del contenuto a lunghezza indefinita
+        p = _fine(dati, p)
+    return p + 2
+
+
+def _figli(dati: bytes, pos: int):
+    """Posizioni degli elementi contenuti nel TLV costruito in pos."""
+    _, p, lunghezza = _intestazione(dati, pos)
+    fine = p + lunghezza if lunghezza is not None else None
+    while (p < fine) if fine is not None else dati[p : p + 2] != b"\0\0":
+        yield p
+        p = _fine(dati, p)
+
+
+def _ottetti(dati: bytes, pos: int) -> bytes:
+    """Contenuto di un OCTET STRING, anche spezzato in più parti (BER costruito)."""
+    costruito, inizio, lunghezza = _intestazione(dati, pos)
+    if not costruito:
+        return dati[inizio : inizio + lunghezza]
+    return b"".join(_ottetti(dati, p) for p in _figli(dati, pos))
+
+
+def estrai_p7m(dati: bytes) -> bytes:
+    """
+    Documento contenuto in una busta PKCS#7/CAdES (.p7m), in DER o in
+    base64/PEM. Non verifica la firma: serve solo il contenuto.
+    ContentInfo -> [0] SignedData -> encapContentInfo -> [0] eContent.
+    """
+    if not dati.startswith(b"\x30"):
+        righe = [r for r in dati.splitlines() if not r.startswith(b"-----")]
+        dati = base64.b64decode(b"".join(righe))
+    content_info = _figli(dati, 0)
+    next(content_info)  # OID signedData
+    signed_data = next(_figli(dati, next(content_info)))
+    campi = _figli(dati, signed_data)
+    next(campi)  # version
+    next(campi)  # digestAlgorithms
+    encap = _figli(dati, next(campi))
+    next(encap)  # OID data
+    contenuto = _ottetti(dati, next(_figli(dati, next(encap))))
+    # busta nella busta (firme multiple annidate)
+    return estrai_p7m(contenuto) if contenuto.startswith(b"\x30") else contenuto
+
+
+# ==========================
+# ANALISI XML
+# ==========================
+def _locale(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _importo(testo: str) -> int:
+    try:
+        return in_centesimi(Decimal(testo.strip()))
+    except InvalidOperation:
+        return 0
+
+
+def analizza_xml(flusso, nome_file: str) -> tuple:
+    """
+    Un file XML dal flusso: ("metadati", (NomeFile, IdentificativoSdI)) per
+    i metadati SdI, altrimenti ("fattura", [righe del registro]), una per
+    corpo (i lotti hanno più corpi con la stessa intestazione).
+    """
+    percorso = []
+    radice, e_metadati = None, False
+    intestazione, corpo, righe, metadati = {}, {}, [], {}
+    for evento, elem in iterparse(flusso, events=("start", "end")):
+        if evento == "start":
+            if radice is None:
+                radice = elem
+                e_metadati = _locale(elem.tag) in _RADICI_METADATI
+            else:
+                percorso.append(_locale(elem.tag))
+            continue
+        if elem is radice:
+            break
+        chiave = tuple(percorso[1:])
+        sezione = percorso[0]
+        testo = (elem.text or "").strip()
+        if e_metadati:
+            if sezione in ("IdentificativoSdI", "NomeFile"):
+                metadati[sezione] = testo
+        elif sezione == "FatturaElettronicaHeader" and chiave in _CAMPI_INTESTAZIONE:
+            intestazione[_CAMPI_INTESTAZIONE[chiave]] = testo
+        elif sezione == "FatturaElettronicaBody" and chiave in _CAMPI_CORPO:
+            campo = _CAMPI_CORPO[chiave]
+            if campo in _IMPORTI:
+                corpo[campo] = corpo.get(campo, 0) + _importo(testo)
+            elif campo == "Causale":
+                corpo[campo] = f"{corpo.get(campo, '')} {testo}".strip()
+            else:
+                corpo[campo] = testo
+        elif sezione == "FatturaElettronicaBody" and not chiave:
+            if "Importo" not in corpo:
+                corpo["Importo"] = corpo.get("Imponibile", 0) + corpo.get("IVA", 0)
+            righe.append(corpo)
+            corpo = {}
+        percorso.pop()
+        if not percorso:
+            # sezione di primo livello conclusa: via tutto ciò che è stato letto
+            radice.clear()
+        else:
+            elem.clear()
+
+    if e_metadati:
+        return "metadati", (metadati.get("NomeFile", ""), metadati.get("IdentificativoSdI", ""))
+    if not righe:
+        raise ValueError("nessun FatturaElettronicaBody")
+    fornitore = intestazione.get("Fornitore") or " ".join(
+        filter(None, [intestazione.get("Nome"), intestazione.get("Cognome")])
+    )
+    for riga in righe:
+        riga.update(
+            NomeFile=nome_file,
+            Fornitore=fornitore,
+            PIVA=intestazione.get("PIVA", ""),
+            CF=intestazione.get("CF", ""),
+        )
+    return "fattura", righe
+
+
+# ==========================
+# LAVORO DEI PROCESSI
+# ==========================
+# Solo nei processi di lavoro (uno ZIP per processo): il percorso seriale
+# gira nel server Streamlit, condiviso tra sessioni, e passa il proprio ZIP
+_zip_processo: Optional[zipfile.ZipFile] = None
+
+
+def _apri_zip(zip_path: str) -> None:
+    """Inizializzatore del processo: lo ZIP (indice centrale) si apre una volta sola."""
+    global _zip_processo
+    _zip_processo = zipfile.ZipFile(zip_path)
+
+
+def _analizza_blocco(nomi: list, zf: Optional[zipfile.ZipFile] = None) -> tuple:
+    """
+    Un blocco di membri dello ZIP zf (di default quello del processo):
+    ({membro: (NomeFile, IdentificativoSdI)} dei metadati, {membro: [righe]}
+    delle fatture, {membro: errore}).
+    """
+    zf = zf or _zip_processo
+    metadati, fatture, errori = {}, {}, {}
+    for nome in nomi:
+        nome_file = os.path.basename(nome)
+        try:
+            if nome.lower().endswith(".p7m"):
+                flusso = io.BytesIO(estrai_p7m(zf.read(nome)))
+            else:
+                flusso = zf.open(nome)
+            with flusso:
+                tipo, risultato = analizza_xml(flusso, nome_file)
+        except Exception as exc:  # file illeggibile: si segnala e si prosegue
+            errori[nome] = f"{type(exc).__name__}: {exc}"
+            continue
+        if tipo == "metadati":
+            metadati[nome] = risultato
+        else:
+            fatture[nome] = risultato
+    return metadati, fatture, errori
+
+
+def _impronta(info: zipfile.ZipInfo) -> str:
+    """Impronta del contenuto dall'indice centrale dello ZIP, senza decomprimere."""
+    return f"{os.path.basename(info.filename)}:{info.CRC:08x}:{info.file_size}"
+
+
+def _membri(zip_path: str) -> tuple:
+    """
+    {membro: impronta} dei file XML/P7M dello ZIP, metadati separati dalle
+    fatture. Lo stesso file presente due volte si considera una sola.
+    """
+    metadati, fatture, viste = {}, {}, set()
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            nome = info.filename.lower()
+            if info.is_dir() or not nome.endswith((".xml", ".xml.p7m", ".p7m")):
+                continue
+            impronta = _impronta(info)
+            if impronta in viste:
+                continue
+            viste.add(impronta)
+            if "metadato" in nome or "_mt_" in os.path.basename(nome):
+                metadati[info.filename] = impronta
+            else:
+                fatture[info.filename] = impronta
+    return metadati, fatture
+
+
+def _blocchi(nomi: list) -> list:
+    return [nomi[i : i + MEMBRI_PER_BLOCCO] for i in range(0, len(nomi), MEMBRI_PER_BLOCCO)]
+
+
+def _in_parallelo(pool, processi: int, blocchi: list):
+    """
+    (blocco, risultato) man mano che i processi finiscono, con al più
+    BLOCCHI_IN_VOLO blocchi per processo in attesa di risultato.
+    """
+    in_volo = {}
+    for blocco in blocchi:
+        if len(in_volo) >= processi * BLOCCHI_IN_VOLO:
+            fatti, _ = wait(in_volo, return_when=FIRST_COMPLETED)
+            for futuro in fatti:
+                yield in_volo.pop(futuro), futuro.result()
+        in_volo[pool.submit(_analizza_blocco, blocco)] = blocco
+    for futuro in wait(in_volo).done:
+        yield in_volo[futuro], futuro.result()
+
+
+# ==========================
+# IMPORTAZIONE
+# ==========================
+def importa_pacchetto(
+    zip_path: str,
+    archivio,
+    processi: Optional[int] = None,
+    avanzamento: Optional[Callable[[int, int], None]] = None,
+) -> tuple:
+    """
+    Importa un pacchetto ZIP AdE nel registro delle ricevute di archivio
+    (ArchivioDocumenti): prima i metadati (identificativi SdI), poi le
+    fatture, registrate un blocco alla volta man mano che i processi le
+    restituiscono. I file già importati, riconosciuti per impronta o per
+    identificativo SdI, non vengono letti.
+    avanzamento riceve (membri analizzati, totale da analizzare).
+    Ritorna (documenti registrati, fatture già presenti, {membro: errore}).
+    """
+    metadati, fatture = _membri(zip_path)
+    noti = archivio.file_ricevuti_noti([*metadati.values(), *fatture.values()])
+    metadati = {m: i for m, i in metadati.items() if i not in noti}
+    nuove = {m: i for m, i in fatture.items() if i not in noti}
+    saltate = len(fatture) - len(nuove)
+
+    totale = len(metadati) + len(nuove)
+    if not totale:
+        return 0, saltate, {}
+    processi = min(processi or processi_disponibili(), max(1, totale // MEMBRI_PER_BLOCCO))
+    id_sdi, errori = {}, {}
+    stato = {"analizzati": 0, "registrati": 0}
+
+    def avanza(blocco: list) -> None:
+        stato["analizzati"] += len(blocco)
+        if avanzamento is not None:
+            avanzamento(stato["analizzati"], totale)
+
+    with ExitStack() as risorse:
+        if processi > 1:
+            pool = risorse.enter_context(pool_processi(processi, _apri_zip, (zip_path,)))
+        else:
+            pool = None
+            zf = risorse.enter_context(zipfile.ZipFile(zip_path))
+
+        def analizza(nomi: list):
+            if pool is None:
+                return ((blocco, _analizza_blocco(blocco, zf)) for blocco in _blocchi(nomi))
+            return _in_parallelo(pool, processi, _blocchi(nomi))
+
+        # 1) metadati: servono alle fatture, quindi tutti prima di queste
+        for blocco, (letti, _, errori_blocco) in analizza(list(metadati)):
+            errori.update(errori_blocco)
+            id_sdi.update(letti.values())
+            archivio.inserisci_ricevute(
+                [], [(metadati[m], nome, 1, sdi) for m, (nome, sdi) in letti.items()]
+            )
+            avanza(blocco)
+
+        # 2) fatture con identificativo SdI già nel registro (o ripetuto nel
+        # pacchetto): si annota solo il file, senza leggerlo
+        nomi_file = {m: os.path.basename(m) for m in nuove}
+        senza_id = [n for n in nomi_file.values() if n not in id_sdi]
+        if senza_id:
+            id_sdi.update(archivio.id_sdi_metadati(senza_id))
+        presenti = archivio.id_sdi_ricevuti(
+            {id_sdi[n] for n in nomi_file.values() if id_sdi.get(n)}
+        )
+        da_leggere, doppie = [], []
+        for membro, nome in nomi_file.items():
+            sdi = id_sdi.get(nome, "")
+            if sdi in presenti:
+                doppie.append((nuove[membro], nome, 0, sdi))
+                continue
+            if sdi:
+                presenti.add(sdi)
+            da_leggere.append(membro)
+        if doppie:
+            archivio.inserisci_ricevute([], doppie)
+            saltate += len(doppie)
+            avanza(doppie)
+
+        # 3) fatture nuove
+        for blocco, (_, lette, errori_blocco) in analizza(da_leggere):
+            errori.update(errori_blocco)
+            righe, file = [], []
+            for membro, righe_file in lette.items():
+                sdi = id_sdi.get(nomi_file[membro], "")
+                for riga in righe_file:
+                    riga["IdentificativoSdI"] = sdi
+                righe.extend(righe_file)
+                file.append((nuove[membro], nomi_file[membro], 0, sdi))
+            stato["registrati"] += archivio.inserisci_ricevute(righe, file)
+            avanza(blocco)
+
+    return stato["registrati"], saltate, errori
@@ -0,0 +1,26 @@
+"""
+Pool di processi per le elaborazioni in blocco (PDF, pacchetti AdE).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Optional
+
+
+def processi_disponibili() -> int:
+    """Core effettivamente utilizzabili (affinità/container), non quelli fisici."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def pool_processi(
+    processi: int, inizializza: Optional[Callable] = None, argomenti: tuple = ()
+) -> ProcessPoolExecutor:
+    # "spawn": il server Streamlit è multi-thread, fork non è sicuro
+    return ProcessPoolExecutor(
+        max_workers=processi,
+        mp_context=get_context("spawn"),
+        initializer=inizializza,
+        initargs=argomenti,
+    )
@@ -0,0 +1,858 @@
+"""
+PDF di cortesia delle fatture: generazione singola e in blocco.
+
+Modulo separato da app.py (nessuna dipendenza da Streamlit) perché la
+generazione in blocco lo importa nei processi di lavoro.
+"""
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import as_completed
+from datetime import date
+from io import BytesIO
+from typing import Callable, Optional
+
+from fontTools import subset as ftsubset
+from fontTools import ttLib
+from fpdf import FPDF, FPDF_VERSION
+from fpdf.enums import PDFResourceType
+from fpdf.fonts import SubsetMap, TTFFont
+
+from calcoli import NATURE_IVA, formato_eur, riepilogo_fattura
+from parallelo import pool_processi, processi_disponibili
+
+# Da incrementare a ogni modifica del layout: invalida tutti i PDF in cache
+VERSIONE_MODELLO = 4
+
+# Sotto questa soglia il pool (avvio dei processi) costa più del lavoro
+MIN_LAVORI_POOL = 8
+
+# Strati precompilati e copia dei font usano l'interno di fpdf2, verificato
+# con la serie 2.8 (vedi requirements.txt). Con un'altra versione le parti
+# fisse si ridisegnano a ogni documento e i font si registrano con add_font:
+# solo API pubblica, stesso risultato, più lento.
+INTERNI_FPDF = FPDF_VERSION.startswith("2.8.") and hasattr(FPDF, "_out")
+
+
+# ==========================
+# FONT
+# ==========================
+# Di norma i font base PDF (Helvetica, codifica WinAnsi = cp1252: accenti,
+# euro, virgolette tipografiche), che non si incorporano. Un documento con
+# testi fuori da cp1252 (greco, cirillico, altri simboli) incorpora invece
+# un sottoinsieme di DejaVu Sans: il file TrueType si legge e si riduce una
+# volta per processo (_font_ridotto), ogni documento ne riceve una copia
+# con il proprio sottoinsieme di glifi.
+CODIFICA_BASE = "cp1252"
+FAMIGLIA_BASE = "Helvetica"
+FAMIGLIA_UNICODE = "DejaVu"
+CARTELLA_FONT = os.environ.get("FATTURE_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
+FILE_FONT = {"": "DejaVuSans.ttf", "B": "DejaVuSans-Bold.ttf", "I": "DejaVuSans-Oblique.ttf"}
+
+# Registrati in quest'ordine in ogni documento: i nomi delle risorse
+# (/F1, /F2, ...) nei byte degli strati coincidono con quelli del documento
+STILI = ["", "B", "I"]
+
+# Blocchi conservati nella copia ridotta del font: meno glifi da leggere e
+# da sottoinsiemare a ogni documento
+BLOCCHI_UNICODE = [
+    (0x0020, 0x024F),  # latino, latino esteso A e B
+    (0x0370, 0x03FF),  # greco
+    (0x0400, 0x04FF),  # cirillico
+    (0x2000, 0x206F),  # punteggiatura
+    (0x20A0, 0x20CF),  # valute
+    (0x2100, 0x214F),  # simboli letterali
+]
+
+# Spazio riservato in fondo a ogni pagina alla nota di cortesia
+ALTEZZA_PIEDE = 25
+
+_FONT_RIDOTTI: dict = {}
+
+
+def _file_font(stile: str) -> str:
+    percorso = os.path.join(CARTELLA_FONT, FILE_FONT[stile])
+    if stile and not os.path.exists(percorso):
+        # stile mancante (es. corsivo): si usa il normale
+        percorso = os.path.join(CARTELLA_FONT, FILE_FONT[""])
+    return percorso
+
+
+def font_unicode_disponibile() -> bool:
+    return os.path.exists(_file_font(""))
+
+
+def _serve_unicode(testi: list) -> bool:
+    """True se qualche testo non è rappresentabile con i font base."""
+    try:
+        "".join(testi).encode(CODIFICA_BASE)
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+def _font_ridotto(stile: str) -> tuple:
+    """(TTFFont di riferimento, byte del font ridotto a BLOCCHI_UNICODE), una volta per processo."""
+    voce = _FONT_RIDOTTI.get(stile)
+    if voce is None:
+        font = ttLib.TTFont(_file_font(stile), recalcTimestamp=False)
+        opzioni = ftsubset.Options(
+            glyph_names=True,
+            hinting=False,
+            layout_features=[],
+            notdef_outline=True,
+            recommended_glyphs=True,
+        )
+        # tabelle che fpdf2 scarta comunque all'incorporazione
+        opzioni.drop_tables += ["FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta"]
+        riduzione = ftsubset.Subsetter(opzioni)
+        riduzione.populate(
+            unicodes=[c for inizio, fine in BLOCCHI_UNICODE for c in range(inizio, fine + 1)]
+        )
+        riduzione.subset(font)
+        dati = BytesIO()
+        font.save(dati)
+        dati = dati.getvalue()
+        riferimento = TTFFont(FPDF(), BytesIO(dati), FAMIGLIA_UNICODE.lower() + stile, stile)
+        voce = _FONT_RIDOTTI[stile] = (riferimento, dati)
+    return voce
+
+
+def _registra_font_unicode(pdf: FPDF, stile: str) -> None:
+    """
+    Copia per il documento del font di riferimento: metriche condivise,
+    tabelle TrueType e sottoinsieme propri (fpdf2 li modifica in output).
+    """
+    riferimento, dati = _font_ridotto(stile)
+    font = copy.copy(riferimento)
+    font.i = len(pdf.fonts) + 1
+    # contorni invariati dal sottoinsieme: niente ricalcolo dei riquadri in output
+    font.ttfont = ttLib.TTFont(
+        BytesIO(dati), recalcBBoxes=False, recalcTimestamp=False, lazy=True
+    )
+    font.subset = SubsetMap(font)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    pdf.fonts[font.fontkey] = font
+
+
+class _Pdf(FPDF):
+    """
+    FPDF con i font del modello registrati in ordine fisso (STILI) e il
+    piè di pagina precompilato su ogni pagina.
+    """
+
+    def __init__(self, unicode: bool):
+        super().__init__()
+        self.core_fonts_encoding = CODIFICA_BASE
+        self.famiglia = FAMIGLIA_UNICODE if unicode else FAMIGLIA_BASE
+        # DejaVu Sans è più largo di Helvetica: corpo ridotto, stesse colonne
+        self.scala = 0.9 if unicode else 1
+        self.piede: Optional["_Strato"] = None
+        # il contenuto si ferma sopra il piè di pagina (ALTEZZA_PIEDE dal fondo)
+        self.set_auto_page_break(auto=True, margin=ALTEZZA_PIEDE + 2)
+        for stile in STILI:
+            if unicode and INTERNI_FPDF:
+                _registra_font_unicode(self, stile)
+            elif unicode:
+                self.add_font(FAMIGLIA_UNICODE, stile, _file_font(stile))
+            else:
+                self.set_font(FAMIGLIA_BASE, stile, 8)
+
+    def carattere(self, stile: str, corpo: float) -> None:
+        self.set_font(self.famiglia, stile, corpo * self.scala)
+
+    def normalize_text(self, text: str) -> str:
+        # font base senza font Unicode disponibile: "?" invece dell'errore
+        if not self.is_ttf_font:
+            text = text.encode(CODIFICA_BASE, "replace").decode(CODIFICA_BASE)
+        return super().normalize_text(text)
+
+    def footer(self) -> None:
+        if self.piede is not None:
+            self.piede.applica(self)
+
+
+# ==========================
+# MODELLO: PARTI FISSE PRECOMPILATE
+# ==========================
+# Le parti fisse della pagina (intestazione dell'emittente, barre ed
+# etichette delle tabelle, piè di pagina) si disegnano una volta per
+# emittente e VERSIONE_MODELLO in un documento di appoggio. Del flusso di
+# contenuto prodotto si tengono i byte, che ogni fattura copia nella propria
+# pagina, spostati in verticale dove serve: per fattura si disegnano solo
+# valori e righe. Con il font Unicode i byte contengono i codici del
+# sottoinsieme: ogni documento ripete le scelte di glifi del documento di
+# appoggio, nello stesso ordine, prima di scrivere altro. Usa l'interno di
+# fpdf2 (flusso della pagina, catalogo delle risorse, sottoinsieme dei
+# font); senza INTERNI_FPDF lo strato si ridisegna nella pagina.
+
+BLU = (31, 119, 180)
+ALTEZZA_RIGA = 6
+# Righe di testo nelle celle a capo (descrizione): ALTEZZA_RIGA con una riga
+ALTEZZA_LINEA = 4
+
+# Colonne della tabella righe
+INTESTAZIONI_RIGHE = ["#", "DESCRIZIONE", "U.M.", "PREZZO", "QTA", "TOTALE", "IVA %", "RIT.", "NAT."]
+LARGHEZZE_RIGHE = [8, 68, 10, 28, 12, 28, 12, 10, 14]
+ALLINEAMENTI_RIGHE = "CLCRRRRCC"
+
+# Dati documento / trasmissione: x e larghezza dei due riquadri, quota
+# delle etichette
+RIQUADRO_SX, RIQUADRO_DX, LARGHEZZA_RIQUADRO = 10, 110, 90
+ETICHETTE_SX = ["TIPO", "NUMERO", "DATA", "CAUSALE"]
+ETICHETTE_DX = ["CODICE DESTINATARIO", "PEC DESTINATARIO", "DATA INVIO", "IDENTIFICATIVO SDI"]
+QUOTA_SX, QUOTA_DX = 0.25, 0.4
+
+ETICHETTE_IMPORTI = [
+    "IMPORTO",
+    "TOTALE IMPONIBILE",
+    "IVA (SU IMPONIBILE)",
+    "IMPORTO TOTALE",
+    "NETTO A PAGARE",
+]
+
+INTESTAZIONI_RIEPILOGHI = [
+    "IVA %",
+    "NAT.",
+    "RIFERIMENTO NORMATIVO",
+    "IMPONIBILE",
+    "IMPOSTA",
+    "ESIG. IVA",
+    "ARROT.",
+    "SPESE ACC.",
+    "TOTALE",
+]
+LARGHEZZE_RIEPILOGHI = [14, 14, 40, 24, 20, 20, 14, 24, 24]
+
+INTESTAZIONI_PAGAMENTO = ["MODALITA'", "DETTAGLI", "DATA RIF. TERMINI", "GIORNI TERMINI", "DATA SCADENZA"]
+LARGHEZZE_PAGAMENTO = [30, 60, 30, 30, 40]
+
+TIPI_DOCUMENTO = {
+    "TD01": "TD01 FATTURA - B2B",
+    "TD02": "TD02 ACCONTO/ANTICIPO SU FATTURA",
+    "TD04": "TD04 NOTA DI CREDITO",
+    "TD05": "TD05 NOTA DI DEBITO",
+}
+
+NOTA_CORTESIA = (
+    "Copia di cortesia priva di valore ai fini fiscali e giuridici ai sensi dell'articolo 21 del D.P.R. 633/72. "
+    "L'originale del documento è consultabile presso l'indirizzo PEC o il codice SDI registrato "
+    "o nell'area riservata Fatture e Corrispettivi."
+)
+
+_FONT_USATI = re.compile(rb"/F(\d+) [\d.]+ Tf")
+
+
+class _Strato:
+    """Parte fissa precompilata: byte del flusso di contenuto disegnato da y0."""
+
+    __slots__ = ("disegna", "contenuto", "y0", "altezza", "font")
+
+    def __init__(self, pdf: _Pdf, disegna: Callable[[_Pdf], None]):
+        self.disegna = disegna
+        pdf.add_page()
+        self.y0 = pdf.get_y()
+        if not INTERNI_FPDF:
+            disegna(pdf)
+            self.altezza = pdf.get_y() - self.y0
+            self.contenuto, self.font = b"", set()
+            return
+        # stato diverso da tutto quello usato nel modello: ogni font e colore
+        # scelto dallo strato finisce nel flusso registrato
+        pdf.set_font("Courier", "", 1)
+        pdf.set_text_color(1, 2, 3)
+        pdf.set_fill_color(1, 2, 3)
+        flusso = pdf.pages[pdf.page].contents
+        inizio = len(flusso)
+        disegna(pdf)
+        self.contenuto = bytes(flusso[inizio:])
+        self.altezza = pdf.get_y() - self.y0
+        self.font = {int(i) for i in _FONT_USATI.findall(self.contenuto)}
+
+    def applica(self, pdf: FPDF, y: Optional[float] = None, riserva: float = 0) -> None:
+        """
+        Copia lo strato nella pagina, con l'origine a y (None: dove è stato
+        disegnato) e porta il cursore sotto. Se non c'è spazio per lo strato
+        più riserva (le righe che lo seguono) si va a pagina nuova. Stato
+        grafico salvato e ripristinato (q/Q): fpdf2 resta allineato.
+        """
+        if y is not None and y + self.altezza + riserva > pdf.page_break_trigger:
+            pdf.add_page()
+            y = pdf.get_y()
+        y = self.y0 if y is None else y
+        if not INTERNI_FPDF:
+            with pdf.local_context():
+                pdf.set_xy(pdf.l_margin, y)
+                self.disegna(pdf)
+        else:
+            spostamento = -(y - self.y0) * pdf.k
+            pdf._out(b"q 1 0 0 1 0 %.2f cm\n%bQ" % (spostamento, self.contenuto))
+            for i in self.font:
+                pdf._resource_catalog.add(PDFResourceType.FONT, i, pdf.page)
+        pdf.set_xy(pdf.l_margin, y + self.altezza)
+
+
+def _barra(pdf: _Pdf, testo: str, larghezza: float = 170) -> None:
+    pdf.set_fill_color(*BLU)
+    pdf.set_text_color(255, 255, 255)
+    pdf.carattere("B", 9)
+    pdf.set_x(10)
+    pdf.cell(larghezza, ALTEZZA_RIGA, testo, border=1, ln=1, fill=True)
+
+
+def _intestazioni(pdf: _Pdf, testi: list, larghezze: list) -> None:
+    pdf.set_text_color(0, 0, 0)
+    pdf.carattere("B", 8)
+    pdf.set_x(10)
+    for testo, larghezza in zip(testi, larghezze):
+        pdf.cell(larghezza, ALTEZZA_RIGA, testo, border=1, align="C")
+    pdf.ln(ALTEZZA_RIGA)
+
+
+def _strato_testata(emittente: dict) -> Callable[[_Pdf], None]:
+    def disegna(pdf: _Pdf) -> None:
+        pdf.set_text_color(0, 0, 0)
+        pdf.carattere("B", 14)
+        pdf.cell(0, 8, emittente["Denominazione"], ln=1)
+
+        pdf.carattere("", 9)
+        pdf.cell(0, 5, emittente["Indirizzo"], ln=1)
+        pdf.cell(
+            0,
+            5,
+            f'{emittente["CAP"]} {emittente["Comune"]} ({emittente["Provincia"]}) IT',
+            ln=1,
+        )
+        pdf.cell(0, 5, f'CODICE FISCALE {emittente["CF"]}', ln=1)
+        pdf.cell(0, 5, f'PARTITA IVA {emittente["PIVA"]}', ln=1)
+
+        pdf.set_xy(120, pdf.get_y())
+        pdf.carattere("B", 9)
+        pdf.cell(0, 5, "Spett.le", ln=1)
+
+    return disegna
+
+
+def _strato_dati_documento(pdf: _Pdf) -> None:
+    y = pdf.get_y()
+    pdf.set_fill_color(*BLU)
+    pdf.set_text_color(255, 255, 255)
+    pdf.carattere("B", 9)
+    pdf.set_xy(RIQUADRO_SX, y)
+    pdf.cell(LARGHEZZA_RIQUADRO, ALTEZZA_RIGA, "DATI DOCUMENTO", border=1, fill=True)
+    pdf.set_xy(RIQUADRO_DX, y)
+    pdf.cell(LARGHEZZA_RIQUADRO, ALTEZZA_RIGA, "DATI TRASMISSIONE", border=1, ln=1, fill=True)
+
+    # etichette e riquadri vuoti dei valori
+    pdf.set_text_color(0, 0, 0)
+    pdf.carattere("", 8)
+    for sx, dx in zip(ETICHETTE_SX, ETICHETTE_DX):
+        for x, etichetta, quota in [(RIQUADRO_SX, sx, QUOTA_SX), (RIQUADRO_DX, dx, QUOTA_DX)]:
+            pdf.set_x(x)
+            pdf.cell(LARGHEZZA_RIQUADRO * quota, ALTEZZA_RIGA, etichetta, border=1)
+            pdf.cell(LARGHEZZA_RIQUADRO * (1 - quota), ALTEZZA_RIGA, "", border=1)
+        pdf.ln(ALTEZZA_RIGA)
+    pdf.ln(2)
+
+
+def _strato_dettaglio(pdf: _Pdf) -> None:
+    _barra(pdf, "DETTAGLIO DOCUMENTO")
+    _intestazioni(pdf, INTESTAZIONI_RIGHE, LARGHEZZE_RIGHE)
+
+
+def _strato_importi(pdf: _Pdf) -> None:
+    pdf.set_text_color(0, 0, 0)
+    for etichetta in ETICHETTE_IMPORTI:
+        if etichetta == ETICHETTE_IMPORTI[-1]:
+            pdf.carattere("B", 9)
+        else:
+            pdf.carattere("", 8)
+        pdf.set_x(10)
+        pdf.cell(40, ALTEZZA_RIGA, etichetta, border=1)
+        pdf.cell(50, ALTEZZA_RIGA, "", border=1, ln=1)
+
+
+def _strato_riepiloghi(pdf: _Pdf) -> None:
+    _barra(pdf, "RIEPILOGHI")
+    _intestazioni(pdf, INTESTAZIONI_RIEPILOGHI, LARGHEZZE_RIEPILOGHI)
+
+
+def _strato_pagamento(pdf: _Pdf) -> None:
+    _barra(pdf, "MODALITA' DI PAGAMENTO ACCETTATE: PAGAMENTO COMPLETO")
+    _intestazioni(pdf, INTESTAZIONI_PAGAMENTO, LARGHEZZE_PAGAMENTO)
+    pdf.carattere("", 8)
+    pdf.set_x(10)
+    for testo, larghezza, allinea in zip(
+        ["CONTANTI", "", "", "0", ""], LARGHEZZE_PAGAMENTO, "LLLCC"
+    ):
+        pdf.cell(larghezza, ALTEZZA_RIGA, testo, border=1, align=allinea)
+    pdf.ln(ALTEZZA_RIGA + 2)
+
+
+def _strato_piede(pdf: _Pdf) -> None:
+    pdf.set_text_color(0, 0, 0)
+    # sotto il limite di interruzione di pagina, come nel footer() di fpdf2
+    margine = pdf.b_margin
+    pdf.set_auto_page_break(False)
+    pdf.set_y(-ALTEZZA_PIEDE)
+    pdf.carattere("I", 7)
+    pdf.multi_cell(0, 4, NOTA_CORTESIA, align="C")
+    pdf.set_auto_page_break(True, margin=margine)
+
+
+_STRATI: dict = {}
+
+
+def strati_modello(emittente: dict, unicode: bool = False) -> tuple:
+    """
+    (strati, glifi): parti fisse del modello per l'emittente e, per ogni
+    font Unicode, i glifi scelti nel disegnarle, in ordine. Costruite alla
+    prima fattura del processo.
+    """
+    chiave = impronta({"emittente": emittente, "modello": VERSIONE_MODELLO, "unicode": unicode})
+    voce = _STRATI.get(chiave)
+    if voce is None:
+        carta = _Pdf(unicode)
+        strati = {
+            "testata": _Strato(carta, _strato_testata(emittente)),
+            "dati_documento": _Strato(carta, _strato_dati_documento),
+            "dettaglio": _Strato(carta, _strato_dettaglio),
+            "importi": _Strato(carta, _strato_importi),
+            "riepiloghi": _Strato(carta, _strato_riepiloghi),
+            "pagamento": _Strato(carta, _strato_pagamento),
+            "piede": _Strato(carta, _strato_piede),
+        }
+        glifi = {
+            chiave_font: [glifo for glifo, _ in font.subset.items()]
+            for chiave_font, font in carta.fonts.items()
+            if isinstance(font, TTFFont) and INTERNI_FPDF
+        }
+        voce = _STRATI[chiave] = (strati, glifi)
+    return voce
+
+
+def _nuovo_documento(emittente: dict, unicode: bool) -> tuple:
+    """(pdf, strati): documento con sottoinsiemi allineati agli strati e prima pagina."""
+    strati, glifi = strati_modello(emittente, unicode)
+    pdf = _Pdf(unicode)
+    for chiave_font, elenco in glifi.items():
+        sottoinsieme = pdf.fonts[chiave_font].subset
+        for glifo in elenco:
+            sottoinsieme.pick_glyph(glifo)
+    pdf.piede = strati["piede"]
+    pdf.add_page()
+    return pdf, strati
+
+
+def _linee_descrizione(pdf: _Pdf, testo: str) -> list:
+    """Descrizione divisa in righe sulla larghezza della colonna (font corrente)."""
+    larghezza = LARGHEZZE_RIGHE[1]
+    testo = testo.strip()
+    if "\n" not in testo and pdf.get_string_width(testo) <= larghezza - 2 * pdf.c_margin:
+        return [testo]
+    return pdf.multi_cell(larghezza, ALTEZZA_LINEA, testo, dry_run=True, output="LINES") or [""]
+
+
+def _riga_dettaglio(pdf: _Pdf, valori: list, linee: list) -> None:
+    """Riga della tabella: celle alte quanto le linee della descrizione."""
+    altezza = len(linee) * ALTEZZA_LINEA + (ALTEZZA_RIGA - ALTEZZA_LINEA)
+    y = pdf.get_y()
+    pdf.set_x(10)
+    for valore, larghezza, allinea in zip(valori, LARGHEZZE_RIGHE, ALLINEAMENTI_RIGHE):
+        pdf.cell(larghezza, altezza, valore, border=1, align=allinea)
+    margine = (ALTEZZA_RIGA - ALTEZZA_LINEA) / 2
+    for n, linea in enumerate(linee):
+        pdf.set_xy(10 + LARGHEZZE_RIGHE[0], y + margine + n * ALTEZZA_LINEA)
+        pdf.cell(LARGHEZZE_RIGHE[1], ALTEZZA_LINEA, linea)
+    pdf.set_xy(10, y + altezza)
+
+
+# ==========================
+# GENERAZIONE PDF FATTURA
+# ==========================
+def genera_pdf_fattura(
+    numero: str,
+    data_f: date,
+    emittente: dict,
+    cliente: dict,
+    righe: list,
+    imponibile: float,
+    iva: float,
+    totale: float,
+    tipo_xml_codice: str = "TD01",
+    modalita_pagamento: str = "",
+    note: str = "",
+) -> bytes:
+    """
+    PDF di cortesia con layout tipo Effatta. Le parti fisse vengono dal
+    modello precompilato (strati_modello): qui si scrivono solo i dati.
+    Le righe vanno a capo e la tabella continua sulle pagine seguenti
+    ripetendo le intestazioni.
+    """
+    testi = [str(v) for v in [*emittente.values(), *cliente.values(), numero, note]]
+    testi += [modalita_pagamento or ""]
+    testi += [str(r.get(k) or "") for r in righe for k in ("desc", "natura")]
+    unicode = _serve_unicode(testi) and font_unicode_disponibile()
+    pdf, strati = _nuovo_documento(emittente, unicode)
+    row_height = ALTEZZA_RIGA
+
+    # -------------------------
+    # INTESTAZIONE EMITTENTE
+    # -------------------------
+    strati["testata"].applica(pdf)
+
+    # -------------------------
+    # BLOCCO CLIENTE A DESTRA
+    # -------------------------
+    pdf.set_x(120)
+    pdf.carattere("B", 10)
+    pdf.cell(0, 5, cliente.get("Denominazione", ""), ln=1)
+
+    pdf.carattere("", 9)
+    indirizzo_cli = cliente.get("Indirizzo", "")
+    if indirizzo_cli:
+        pdf.set_x(120)
+        pdf.cell(0, 5, indirizzo_cli, ln=1)
+
+    pdf.set_x(120)
+    pdf.cell(
+        0,
+        5,
+        f"{cliente.get('CAP','')} {cliente.get('Comune','')} ({cliente.get('Provincia','')}) IT",
+        ln=1,
+    )
+
+    if cliente.get("PIVA"):
+        pdf.set_x(120)
+        pdf.cell(0, 5, f"P.IVA {cliente.get('PIVA','')}", ln=1)
+    elif cliente.get("CF"):
+        pdf.set_x(120)
+        pdf.cell(0, 5, f"CF {cliente.get('CF','')}", ln=1)
+
+    pdf.ln(6)
+
+    # -------------------------
+    # DATI DOCUMENTO / TRASMISSIONE
+    # -------------------------
+    y = pdf.get_y()
+    strati["dati_documento"].applica(pdf, y)
+
+    pdf.carattere("", 8)
+    causale = note.strip() if note else "SERVIZIO"
+    valori_sx = [
+        TIPI_DOCUMENTO.get(tipo_xml_codice, tipo_xml_codice),
+        str(numero),
+        data_f.strftime("%d/%m/%Y"),
+        causale,
+    ]
+    valori_dx = [cliente.get("CodiceDestinatario", "0000000"), cliente.get("PEC", ""), "", ""]
+    for n, (sx, dx) in enumerate(zip(valori_sx, valori_dx), start=1):
+        for x, valore, quota in [(RIQUADRO_SX, sx, QUOTA_SX), (RIQUADRO_DX, dx, QUOTA_DX)]:
+            if valore:
+                pdf.set_xy(x + LARGHEZZA_RIQUADRO * quota, y + n * row_height)
+                pdf.cell(LARGHEZZA_RIQUADRO * (1 - quota), row_height, valore)
+    pdf.set_xy(10, y + strati["dati_documento"].altezza)
+
+    # -------------------------
+    # DETTAGLIO DOCUMENTO
+    # -------------------------
+    intestazione = strati["dettaglio"]
+    intestazione.applica(pdf, pdf.get_y(), riserva=row_height)
+    # linee di descrizione che entrano in una pagina sotto le intestazioni
+    bordo = row_height - ALTEZZA_LINEA
+    linee_pagina = int(
+        (pdf.page_break_trigger - pdf.t_margin - intestazione.altezza - bordo) // ALTEZZA_LINEA
+    )
+
+    pdf.set_text_color(0, 0, 0)
+    pdf.carattere("", 8)
+
+    righe_locali = righe if righe else [{"desc": "", "qta": 0, "prezzo": 0.0, "iva": 22}]
+    # importi di riga e riepiloghi IVA dallo stesso calcolo di editor e XML
+    conti = riepilogo_fattura(righe_locali)
+
+    for idx, (r, totale_riga) in enumerate(zip(righe_locali, conti["linee"]), start=1):
+        linee = _linee_descrizione(pdf, r.get("desc") or "")
+        qta = float(r.get("qta", 0) or 0)
+        prezzo = float(r.get("prezzo", 0.0) or 0.0)
+        iva_r = float(r.get("iva", 22) or 0.0)
+        valori = [
+            str(idx),
+            "",
+            "",
+            formato_eur(prezzo),
+            f"{qta:.2f}",
+            formato_eur(totale_riga / 100),
+            f"{iva_r:.2f}",
+            "",
+            r.get("natura") or "",
+        ]
+        while linee:
+            spazio = int((pdf.page_break_trigger - pdf.get_y() - bordo) // ALTEZZA_LINEA)
+            # la riga passa intera alla pagina seguente; solo se non entra
+            # nemmeno in una pagina vuota si divide
+            if len(linee) > spazio and (len(linee) <= linee_pagina or spazio < 1):
+                pdf.add_page()
+                intestazione.applica(pdf, pdf.get_y())
+                pdf.set_text_color(0, 0, 0)
+                pdf.carattere("", 8)
+                continue
+            _riga_dettaglio(pdf, valori, linee[:spazio])
+            linee = linee[spazio:]
+            # il seguito della descrizione senza ripetere gli importi
+            valori = [""] * len(valori)
+
+    # -------------------------
+    # IMPORTI A SINISTRA
+    # -------------------------
+    pdf.ln(2)
+    y = pdf.get_y()
+    strati["importi"].applica(pdf, y)
+    y = pdf.get_y() - strati["importi"].altezza
+    valori = [imponibile, imponibile, iva, totale, totale]
+    for n, valore in enumerate(valori):
+        if n == len(valori) - 1:
+            pdf.carattere("B", 9)
+        else:
+            pdf.carattere("", 8)
+        pdf.set_xy(50, y + n * row_height)
+        pdf.cell(50, row_height, formato_eur(valore), align="R")
+    pdf.set_xy(10, y + strati["importi"].altezza)
+
+    # -------------------------
+    # RIEPILOGHI IVA
+    # -------------------------
+    pdf.ln(3)
+    strati["riepiloghi"].applica(
+        pdf, pdf.get_y(), riserva=len(conti["riepiloghi"]) * row_height
+    )
+
+    # una riga per aliquota / natura
+    riepi_w = LARGHEZZE_RIEPILOGHI
+    pdf.carattere("", 8)
+    for aliquota, natura, imp_gruppo, imposta in conti["riepiloghi"]:
+        pdf.set_x(10)
+        pdf.cell(riepi_w[0], row_height, formato_eur(aliquota), border=1, align="R")
+        pdf.cell(riepi_w[1], row_height, natura, border=1, align="C")
+        pdf.cell(riepi_w[2], row_height, NATURE_IVA.get(natura, "")[:24], border=1)
+        pdf.cell(riepi_w[3], row_height, formato_eur(imp_gruppo / 100), border=1, align="R")
+        pdf.cell(riepi_w[4], row_height, formato_eur(imposta / 100), border=1, align="R")
+        pdf.cell(
+            riepi_w[5], row_height, "" if natura else "IMMEDIATA", border=1, align="C"
+        )
+        pdf.cell(riepi_w[6], row_height, "0,00", border=1, align="R")
+        pdf.cell(riepi_w[7], row_height, "0,00", border=1, align="R")
+        pdf.cell(
+            riepi_w[8], row_height, formato_eur((imp_gruppo + imposta) / 100), border=1, align="R"
+        )
+        pdf.ln(row_height)
+    pdf.ln(2)
+
+    # -------------------------
+    # MODALITÀ DI PAGAMENTO
+    # -------------------------
+    y = pdf.get_y()
+    strati["pagamento"].applica(pdf, y)
+    y = pdf.get_y() - strati["pagamento"].altezza
+    if modalita_pagamento:
+        pdf.carattere("", 8)
+        pdf.set_xy(10 + LARGHEZZE_PAGAMENTO[0], y + 2 * row_height)
+        pdf.cell(LARGHEZZE_PAGAMENTO[1], row_height, modalita_pagamento[:40])
+    pdf.set_xy(10, y + strati["pagamento"].altezza)
+
+    pdf.carattere("B", 9)
+    pdf.set_x(10)
+    pdf.cell(190 - 20, row_height, f"TOTALE A PAGARE EUR {formato_eur(totale)}", ln=1)
+
+    out = pdf.output(dest="S")
+    if isinstance(out, (bytes, bytearray)):
+        return bytes(out)
+    return out.encode("latin1")
+
+
+def nome_file_pdf(numero: str) -> str:
+    return f"{numero.replace('/', '_')}.pdf"
+
+
+def scrivi_pdf(percorso: str, pdf_bytes: bytes) -> None:
+    """Scrittura atomica: chi legge il file non lo vede mai a metà."""
+    provvisorio = f"{percorso}.{os.getpid()}.tmp"
+    with open(provvisorio, "wb") as f:
+        f.write(pdf_bytes)
+    os.replace(provvisorio, percorso)
+
+
+# ==========================
+# CACHE PER CONTENUTO
+# ==========================
+def impronta(dati) -> str:
+    """SHA-256 della serializzazione canonica (chiavi ordinate, date ISO)."""
+    testo = json.dumps(dati, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(testo.encode("utf-8")).hexdigest()
+
+
+class CachePdf:
+    """
+    PDF indirizzati per contenuto: cartella/<emittente+modello>/<impronta>.pdf.
+
+    L'impronta copre tutti gli argomenti di genera_pdf_fattura (dati
+    documento, cliente, righe, emittente) più VERSIONE_MODELLO: a parità di
+    impronta il PDF non viene rigenerato, qualsiasi modifica produce un
+    nuovo file. La sottocartella dipende solo da emittente e modello; un
+    percorso già registrato vale solo se coincide con quello dei dati
+    attuali (percorso_atteso). Oltre limite_byte si eliminano i file usati meno di recente
+    fino al 90% del limite. L'uso aggiorna solo atime: mtime resta quello di
+    generazione, da cui derivano Last-Modified/ETag del servizio statico.
+    """
+
+    def __init__(self, cartella: str, limite_byte: int):
+        self.cartella = cartella
+        self.limite_byte = limite_byte
+        self._lock = threading.Lock()
+        os.makedirs(cartella, exist_ok=True)
+        self._occupati = sum(os.path.getsize(p) for p, _ in self._file())
+
+    def cartella_modello(self, emittente: dict) -> str:
+        chiave = impronta({"emittente": emittente, "modello": VERSIONE_MODELLO})
+        return os.path.join(self.cartella, chiave[:16])
+
+    def percorso_atteso(self, argomenti: dict) -> str:
+        """Percorso del PDF per questi argomenti (esista o no)."""
+        return os.path.join(
+            self.cartella_modello(argomenti["emittente"]), f"{impronta(argomenti)}.pdf"
+        )
+
+    def valido(self, percorso: str, argomenti: dict) -> bool:
+        """Percorso registrato ancora utilizzabile: è quello di questi argomenti, su disco."""
+        if not percorso or percorso != self.percorso_atteso(argomenti):
+            return False
+        return self._usa(percorso)
+
+    def percorso(self, argomenti: dict) -> tuple:
+        """(percorso, generato): il PDF viene generato solo se non è in cache."""
+        percorso = self.percorso_atteso(argomenti)
+        if self._usa(percorso):
+            return percorso, False
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        scrivi_pdf(percorso, genera_pdf_fattura(**argomenti))
+        self.registra([percorso])
+        return percorso, True
+
+    def registra(self, percorsi) -> None:
+        """Contabilizza file scritti in cache (anche da altri processi) e libera spazio."""
+        aggiunti = sum(os.path.getsize(p) for p in percorsi)
+        with self._lock:
+            self._occupati += aggiunti
+            if self._occupati > self.limite_byte:
+                self._libera()
+
+    def _usa(self, percorso: str) -> bool:
+        try:
+            os.utime(percorso, (time.time(), os.stat(percorso).st_mtime))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _file(self) -> list:
+        return [
+            (voce.path, voce.stat())
+            for sotto in os.scandir(self.cartella)
+            if sotto.is_dir()
+            for voce in os.scandir(sotto.path)
+            if voce.name.endswith(".pdf")
+        ]
+
+    def _libera(self) -> None:
+        file = sorted(self._file(), key=lambda f: f[1].st_atime)
+        occupati = sum(st.st_size for _, st in file)
+        obiettivo = int(self.limite_byte * 0.9)
+        for percorso, st in file:
+            if occupati <= obiettivo:
+                break
+            try:
+                os.remove(percorso)
+            except FileNotFoundError:
+                pass
+            occupati -= st.st_size
+        self._occupati = occupati
+
+
+# ==========================
+# GENERAZIONE IN BLOCCO
+# ==========================
+def _genera_su_file(argomenti: dict, percorso: str) -> tuple:
+    """
+    (percorso, "") oppure ("", messaggio). L'errore torna come testo:
+    alcune eccezioni di fpdf non si possono ricostruire (pickle) nel processo
+    principale e manderebbero in errore l'intero pool.
+    """
+    try:
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        scrivi_pdf(percorso, genera_pdf_fattura(**argomenti))
+    except Exception as exc:
+        return "", f"{type(exc).__name__}: {exc}"
+    return percorso, ""
+
+
+def genera_pdf_in_blocco(
+    lavori: dict,
+    cache: CachePdf,
+    processi: Optional[int] = None,
+    avanzamento: Optional[Callable[[int, int], None]] = None,
+) -> tuple:
+    """
+    Genera i PDF di più fatture in parallelo su tutti i core.
+
+    lavori: {chiave (es. id documento): argomenti di genera_pdf_fattura}.
+    I PDF già in cache con la stessa impronta non vengono rigenerati;
+    avanzamento riceve (completati, totale) a ogni fattura conclusa.
+    L'errore su una fattura non interrompe le altre.
+    Ritorna ({chiave: percorso} generati, {chiave: percorso} già in cache,
+    {chiave: messaggio di errore}).
+    """
+    generati, riusati, errori = {}, {}, {}
+    totale = len(lavori)
+
+    def esito(chiave, calcolo) -> None:
+        try:
+            percorso, errore = calcolo()
+        except Exception as exc:  # processo di lavoro terminato
+            percorso, errore = "", f"{type(exc).__name__}: {exc}"
+        if errore:
+            errori[chiave] = errore
+        else:
+            generati[chiave] = percorso
+        if avanzamento is not None:
+            avanzamento(len(generati) + len(riusati) + len(errori), totale)
+
+    da_generare = {}
+    for chiave, argomenti in lavori.items():
+        percorso = cache.percorso_atteso(argomenti)
+        if cache._usa(percorso):
+            riusati[chiave] = percorso
+        else:
+            da_generare[chiave] = (argomenti, percorso)
+    if avanzamento is not None and riusati:
+        avanzamento(len(riusati), totale)
+
+    processi = min(processi or processi_disponibili(), len(da_generare))
+
+    if len(da_generare) < MIN_LAVORI_POOL or processi <= 1:
+        for chiave, lavoro in da_generare.items():
+            esito(chiave, lambda: _genera_su_file(*lavoro))
+    else:
+        with pool_processi(processi) as pool:
+            futuri = {
+                pool.submit(_genera_su_file, *lavoro): chiave
+                for chiave, lavoro in da_generare.items()
+            }
+            for futuro in as_completed(futuri):
+                esito(futuri[futuro], futuro.result)
+
+    cache.registra(generati.values())
+    return generati, riusati, errori
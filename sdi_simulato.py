@@ -0,0 +1,179 @@
+"""
+Intermediario SdI simulato, per provare invio e notifiche senza rete.
+
+IntermediarioSimulato tiene lo stato (fatture ricevute, notifiche prodotte)
+ed è condiviso da due facciate: TrasportoSimulato, usato in processo dalla
+coda di invio (SDI_TRASPORTO=simulato), e ServerSimulato, che espone la
+stessa API HTTP di TrasportoOpenapi su localhost:
+
+    python sdi_simulato.py 8765
+    OPENAPI_TOKEN=prova OPENAPI_URL=http://127.0.0.1:8765 streamlit run app.py
+"""
+import asyncio
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from invio_sdi import ErroreInvio, ErroreTemporaneo, Trasporto
+
+
+class IntermediarioSimulato:
+    """
+    Riceve fatture con un limite di richieste al secondo (oltre: 429) e una
+    quota di errori transitori; per ognuna produce dopo ritardo_esito una
+    notifica RC, o NS per la quota di scarti. Le notifiche hanno un
+    progressivo, che fa da cursore. Gli UUID hanno il prefisso "SIM-".
+    """
+
+    def __init__(
+        self,
+        al_secondo: float = 50.0,
+        errori: float = 0.0,
+        scarti: float = 0.0,
+        ritardo_esito: float = 1.0,
+        seme: Optional[int] = None,
+    ):
+        self.al_secondo = al_secondo
+        self.errori = errori
+        self.scarti = scarti
+        self.ritardo_esito = ritardo_esito
+        self.inviati = {}
+        self._notifiche = []  # (pronta dal, UUID, tipo), in ordine di progressivo
+        self._ultimi = []
+        self._casuale = random.Random(seme)
+        self._lock = threading.Lock()
+
+    def ricevi(self, nome_file: str, xml: bytes) -> str:
+        with self._lock:
+            adesso = time.monotonic()
+            self._ultimi = [t for t in self._ultimi if adesso - t < 1.0]
+            if len(self._ultimi) >= self.al_secondo:
+                attesa = 1.0 - (adesso - self._ultimi[0])
+                raise ErroreTemporaneo("HTTP 429: troppe richieste", attesa)
+            self._ultimi.append(adesso)
+            if self._casuale.random() < self.errori:
+                raise ErroreTemporaneo("HTTP 503: intermediario non disponibile")
+            if not xml.lstrip().startswith(b"<?xml"):
+                raise ErroreInvio("HTTP 422: file non conforme")
+            identificativo = f"SIM-{uuid.uuid4()}"
+            self.inviati[identificativo] = nome_file
+            tipo = "NS" if self._casuale.random() < self.scarti else "RC"
+            self._notifiche.append((adesso + self.ritardo_esito, identificativo, tipo))
+            return identificativo
+
+    def notifiche(self, dopo: int, lotto: int) -> tuple:
+        """Notifiche pronte con progressivo oltre dopo: ([(UUID, tipo, esito)], ultimo progressivo)."""
+        adesso = time.monotonic()
+        with self._lock:
+            pronte = []
+            for pronta, identificativo, tipo in self._notifiche[dopo : dopo + lotto]:
+                if pronta > adesso:
+                    break  # stesso ritardo per tutte: le successive non sono pronte
+                pronte.append((identificativo, tipo, ""))
+        return pronte, dopo + len(pronte)
+
+
+class TrasportoSimulato(Trasporto):
+    """L'intermediario simulato in processo, con latenza di rete casuale."""
+
+    def __init__(
+        self, intermediario: Optional[IntermediarioSimulato] = None, latenza: float = 0.05
+    ):
+        self.intermediario = intermediario or IntermediarioSimulato()
+        self.latenza = latenza
+
+    async def invia(self, nome_file: str, xml: bytes) -> str:
+        await asyncio.sleep(self.latenza * random.uniform(0.5, 1.5))
+        return self.intermediario.ricevi(nome_file, xml)
+
+    async def notifiche(self, cursore: str, lotto: int) -> tuple:
+        await asyncio.sleep(self.latenza)
+        notifiche, ultimo = self.intermediario.notifiche(int(cursore or 0), lotto)
+        return notifiche, str(ultimo)
+
+
+# ==========================
+# SERVER HTTP
+# ==========================
+class _Gestore(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # connessioni persistenti, come l'API reale
+
+    def log_message(self, formato, *argomenti) -> None:
+        pass
+
+    def _rispondi(self, stato: int, dati: Optional[dict] = None, **intestazioni) -> None:
+        corpo = json.dumps(dati).encode() if dati is not None else b""
+        self.send_response(stato)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        for nome, valore in intestazioni.items():
+            self.send_header(nome.replace("_", "-"), valore)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_POST(self) -> None:
+        xml = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if urlsplit(self.path).path != "/invoices":
+            return self._rispondi(404, {"message": "not found"})
+        try:
+            identificativo = self.server.intermediario.ricevi("", xml)
+        except ErroreTemporaneo as exc:
+            stato = 429 if "429" in str(exc) else 503
+            return self._rispondi(stato, {"message": str(exc)}, Retry_After=f"{exc.attesa:.0f}")
+        except ErroreInvio as exc:
+            return self._rispondi(422, {"message": str(exc)})
+        self._rispondi(200, {"success": True, "data": {"uuid": identificativo}})
+
+    def do_GET(self) -> None:
+        parti = urlsplit(self.path)
+        if parti.path != "/notifications":
+            return self._rispondi(404, {"message": "not found"})
+        query = parse_qs(parti.query)
+        dopo = int((query.get("since") or ["0"])[0] or 0)
+        lotto = int((query.get("limit") or ["100"])[0])
+        notifiche, ultimo = self.server.intermediario.notifiche(dopo, lotto)
+        dati = {
+            "data": [{"uuid": u, "type": t, "outcome": e} for u, t, e in notifiche],
+            "cursor": str(ultimo),
+        }
+        etag = '"' + hashlib.sha1(json.dumps(dati).encode()).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._rispondi(304, None, ETag=etag)
+        self._rispondi(200, dati, ETag=etag)
+
+
+class ServerSimulato(ThreadingHTTPServer):
+    """API HTTP dell'intermediario simulato su localhost (porta 0: libera)."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, intermediario: Optional[IntermediarioSimulato] = None, porta: int = 0
+    ):
+        super().__init__(("127.0.0.1", porta), _Gestore)
+        self.intermediario = intermediario or IntermediarioSimulato()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def avvia(self) -> "ServerSimulato":
+        threading.Thread(target=self.serve_forever, name="sdi-simulato", daemon=True).start()
+        return self
+
+    def chiudi(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    server = ServerSimulato(porta=int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f"Intermediario SdI simulato su {server.url}")
+    server.serve_forever()